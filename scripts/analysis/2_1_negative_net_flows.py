@@ -1,10 +1,11 @@
 import pandas as pd
 from bblocks import set_bblocks_data_path
-from bblocks.dataframe_tools.add import add_iso_codes_column
 from bblocks.import_tools.imf_weo import WEO
 import numpy as np
 
 from scripts.config import Paths
+from scripts.data.dimensions import add_iso_codes
+from scripts.data.sources import ensure_source
 
 set_bblocks_data_path(Paths.raw_data)
 
@@ -113,6 +114,8 @@ def _download_gdp_data() -> pd.DataFrame:
     2029.
     """
 
+    ensure_source("weo")
+
     weo = WEO(version="latest")
 
     weo = weo.load_data(indicators="NGDPD")
@@ -120,12 +123,7 @@ def _download_gdp_data() -> pd.DataFrame:
     gdp = weo.get_data()
 
     return (
-        gdp.pipe(
-            add_iso_codes_column,
-            id_column="ref_area",
-            id_type="regex",
-            target_column="iso_3",
-        )
+        gdp.pipe(add_iso_codes, id_column="ref_area", target_column="iso_3")
         .filter(items=["time_period", "obs_value", "iso_3"], axis=1)
         .rename(columns={"time_period": "year", "obs_value": "gdp"})
     )
@@ -235,9 +233,7 @@ def flourish_1_beeswarm_pipeline(df: pd.DataFrame) -> pd.DataFrame:
     df = add_projections_data(df, as_billion=True)
 
     # add iso columns (needed to merge in GDP data in next step)
-    df = add_iso_codes_column(
-        df=df, id_column="country", id_type="regex", target_column="iso_3"
-    )
+    df = add_iso_codes(df=df, id_column="country", target_column="iso_3")
 
     # Add new column for net flows as a share of GDP (using WEO GDP data)
     df = calculate_net_flow_as_share_gdp(df)
@@ -1,71 +1,149 @@
+import functools
 import json
 import os
 
+import numpy as np
 import pandas as pd
 
+from scripts import config
+from scripts.data.common import to_categorical
 
-GROUPS = {
-    "Developing countries": 1,
-    "Low income": 2,
-    "Lower middle income": 3,
-    "Upper middle income": 4,
-    "Africa": 7,
-    "Europe": 8,
-    "Asia": 9,
-    "America": 10,
-    "Oceania": 11,
-}
+# Columns a group definition can filter on (besides a list of countries)
+GROUP_FILTERS: list[str] = ["continent", "income_level"]
 
 
-def create_grouping_totals(
-    data: pd.DataFrame, group_column: str, exclude_cols: list[str]
-) -> pd.DataFrame:
-    """Create group totals as 'country'"""
-
-    dfs = []
-
-    for group in data[group_column].unique():
-        df_ = data.loc[lambda d: d[group_column] == group].copy()
-        df_["country"] = group
-        df_ = (
-            df_.groupby(
-                [c for c in df_.columns if c not in ["value"] + exclude_cols],
-                observed=True,
-                dropna=False,
-            )["value"]
-            .sum()
-            .reset_index()
-        )
+@functools.cache
+def country_groups() -> dict[str, dict]:
+    """The country groups defined in `config.GROUPS_FILE`, sorted by their order.
 
-        dfs.append(df_)
+    Each group is defined by the values of the columns in `GROUP_FILTERS` and/or a
+    list of `countries` its members must have (a group with neither includes all
+    the countries). Groups can overlap.
+    """
+    with open(config.GROUPS_FILE, "r") as f:
+        groups = json.load(f)
 
-    groups = pd.concat(dfs, ignore_index=True)
+    return dict(sorted(groups.items(), key=lambda g: g[1].get("order", 99)))
 
-    return pd.concat([data, groups], ignore_index=True)
 
+def _matches(values: pd.Series, allowed: str | list[str]) -> np.ndarray:
+    return values.isin([allowed] if isinstance(allowed, str) else allowed).to_numpy()
 
-def exclude_outlier_countries(data: pd.DataFrame) -> pd.DataFrame:
-    data = data.loc[lambda d: ~d.country.isin(["China", "Ukraine", "Russia"])]
 
-    return data
+def membership_matrix(
+    entities: pd.DataFrame, groups: dict[str, dict]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Build the sparse matrix of which entities belong to which groups.
 
+    Args:
+        entities (pd.DataFrame): The distinct countries, with their continent and
+            income level.
+        groups (dict[str, dict]): The group definitions, as in `country_groups`.
 
-def create_world_total(data: pd.DataFrame, name: str = "World") -> pd.DataFrame:
-    """Create a world total for the data"""
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The positions of the entities and of the
+        groups of each membership (the non-zero cells, in coordinate format).
+    """
+    rows, columns = [], []
 
-    df = data.copy(deep=True)
-    df["country"] = name
-    df = (
-        df.groupby(
-            [c for c in df.columns if c not in ["income_level", "continent", "value"]],
-            observed=True,
-            dropna=False,
-        )["value"]
-        .sum()
-        .reset_index()
+    for position, definition in enumerate(groups.values()):
+        member = np.ones(len(entities), dtype=bool)
+        for column in GROUP_FILTERS:
+            if column in definition:
+                member &= _matches(entities[column], definition[column])
+        if "countries" in definition:
+            member &= _matches(entities["country"], definition["countries"])
+
+        members = np.flatnonzero(member)
+        rows.append(members)
+        columns.append(np.full(len(members), position))
+
+    return np.concatenate(rows), np.concatenate(columns)
+
+
+def combination_codes(
+    data: pd.DataFrame, columns: list[str]
+) -> tuple[np.ndarray, pd.DataFrame]:
+    """Number the distinct combinations of some columns (in sorted order). Returns
+    the number of each row and the table of combinations."""
+    if not columns:
+        return np.zeros(len(data), dtype=np.int64), pd.DataFrame(index=[0])
+
+    codes = (
+        data.groupby(columns, observed=True, dropna=False).ngroup().to_numpy(np.int64)
+    )
+    _, first = np.unique(codes, return_index=True)
+
+    return codes, data[columns].iloc[first].reset_index(drop=True)
+
+
+def group_totals(
+    data: pd.DataFrame, groups: dict[str, dict] | None = None
+) -> pd.DataFrame:
+    """Sum the data of the countries in each group, as 'country'.
+
+    All the groups are computed in a single pass: the values of each row are
+    multiplied into a sparse country to group membership matrix, so each group
+    only adds the rows of its members (and no copy of the data). The groups keep
+    the continent or income level they are defined by; the others are empty.
+
+    Args:
+        data (pd.DataFrame): Data by country, with a value column.
+        groups (dict[str, dict], optional): The group definitions. Defaults to
+            `country_groups()`.
+    """
+    groups = country_groups() if groups is None else groups
+    entity_columns = [c for c in ["country"] + GROUP_FILTERS if c in data.columns]
+    key_columns = [c for c in data.columns if c not in entity_columns + ["value"]]
+
+    entity, entities = combination_codes(data, entity_columns)
+    key, keys = combination_codes(data, key_columns)
+
+    # The membership matrix in compressed rows, so each row can find its groups
+    member_entity, member_group = membership_matrix(entities, groups)
+    order = np.argsort(member_entity, kind="stable")
+    member_group = member_group[order]
+    count = np.bincount(member_entity, minlength=len(entities))
+    start = np.cumsum(count) - count
+
+    # One entry per row and group the row's country belongs to
+    per_row = count[entity]
+    row = np.repeat(np.arange(len(data)), per_row)
+    offset = np.arange(len(row)) - np.repeat(np.cumsum(per_row) - per_row, per_row)
+    group = member_group[start[entity[row]] + offset]
+
+    # Sum by group and key (missing values count as zero, as in a groupby sum)
+    cells, inverse = np.unique(group * len(keys) + key[row], return_inverse=True)
+    values = data["value"].fillna(0).to_numpy(dtype="float64")[row]
+    group, key = np.divmod(cells, len(keys))
+
+    totals = keys.iloc[key].reset_index(drop=True)
+    totals["country"] = np.array(list(groups), dtype=object)[group]
+    for column in entity_columns[1:]:
+        labels = [
+            d[column] if isinstance(d.get(column), str) else np.nan
+            for d in groups.values()
+        ]
+        totals[column] = np.array(labels, dtype=object)[group]
+    totals["value"] = np.bincount(inverse, weights=values, minlength=len(cells))
+
+    return totals.filter(data.columns).pipe(to_categorical)
+
+
+def add_group_totals(
+    data: pd.DataFrame, groups: dict[str, dict] | None = None
+) -> pd.DataFrame:
+    """Add the totals of each group to the country data"""
+
+    return pd.concat([data, group_totals(data, groups)], ignore_index=True).pipe(
+        to_categorical
     )
 
-    return pd.concat([data, df], ignore_index=True)
+
+def exclude_outlier_countries(data: pd.DataFrame) -> pd.DataFrame:
+    data = data.loc[lambda d: ~d.country.isin(["China", "Ukraine", "Russia"])]
+
+    return data
 
 
 def add_china_as_counterpart_type(df: pd.DataFrame) -> pd.DataFrame:
@@ -81,7 +159,7 @@ def add_china_as_counterpart_type(df: pd.DataFrame) -> pd.DataFrame:
     df = df.loc[lambda d: d.counterpart_area != "China"]
 
     # Concatenate the data
-    return pd.concat([df, china], ignore_index=True)
+    return pd.concat([df, china], ignore_index=True).pipe(to_categorical)
 
 
 def convert_to_net_flows(data: pd.DataFrame) -> pd.DataFrame:
@@ -99,7 +177,7 @@ def convert_to_net_flows(data: pd.DataFrame) -> pd.DataFrame:
 
     data["indicator_type"] = "net_flow"
 
-    return data
+    return to_categorical(data)
 
 
 def summarise_by_country(data: pd.DataFrame) -> pd.DataFrame:
@@ -129,29 +207,17 @@ def summarise_by_country(data: pd.DataFrame) -> pd.DataFrame:
 
 
 def create_groupings(data: pd.DataFrame) -> pd.DataFrame:
-    # Create world totals
-    data_grouped = create_world_total(data, "Developing countries")
-
-    # Create continent totals
-    data_grouped = create_grouping_totals(
-        data_grouped, group_column="continent", exclude_cols=["income_level"]
-    )
-
-    # Create income_level totals
-    data_grouped = create_grouping_totals(
-        data_grouped, group_column="income_level", exclude_cols=["continent"]
-    )
-
-    # remove individual country data
-    data_grouped = data_grouped.loc[lambda d: d.country.isin(GROUPS)]
+    """Create the totals of the country groups (without the individual countries)"""
 
-    return data_grouped
+    return group_totals(data)
 
 
 def reorder_countries(df: pd.DataFrame, counterpart_type: bool = False) -> pd.DataFrame:
     """Reorder countries by continent and income level"""
 
-    df["order"] = df["country"].map(GROUPS).fillna(99)
+    # Categorical columns map to categoricals, so convert before filling
+    order = {name: group.get("order", 99) for name, group in country_groups().items()}
+    df["order"] = df["country"].map(order).astype("float").fillna(99)
 
     counterpart_order = {
         "Bilateral": 1,
@@ -162,7 +228,7 @@ def reorder_countries(df: pd.DataFrame, counterpart_type: bool = False) -> pd.Da
 
     if counterpart_type:
         df["order_counterpart"] = (
-            df["counterpart_type"].map(counterpart_order).fillna(99)
+            df["counterpart_type"].map(counterpart_order).astype("float").fillna(99)
         )
 
     df = (
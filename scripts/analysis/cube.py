@@ -0,0 +1,157 @@
+"""An in-memory cube of the flows, with precomputed rollups.
+
+The cube holds the flows by country and by country group (the `level` dimension)
+over year, counterpart area and type, indicator, indicator type and prices. When it
+is built, a set of rollups (grouping sets) is computed once, each from the smallest
+rollup already computed which contains it. Queries are then answered from the
+smallest rollup which has all the dimensions they group or filter by, so most of
+them never read the base flows.
+
+Country, continent and income level describe the same entity, so they are kept in
+every rollup. Country groups overlap, so the values of different groups should not
+be added up.
+"""
+
+import numpy as np
+import pandas as pd
+
+from scripts.analysis.common import group_totals
+from scripts.data.common import to_categorical
+
+# The dimensions of the cube (the columns which are in the data are used)
+DIMENSIONS: list[str] = [
+    "level",
+    "year",
+    "country",
+    "continent",
+    "income_level",
+    "counterpart_area",
+    "counterpart_type",
+    "prices",
+    "indicator",
+    "indicator_type",
+]
+
+# Dimensions which are kept in every rollup
+ENTITY: list[str] = ["level", "country", "continent", "income_level"]
+
+# Rollups which are computed when the cube is built: the dimensions each one keeps,
+# besides the entity
+ROLLUPS: dict[str, list[str]] = {
+    "net_flows": [
+        "year",
+        "counterpart_area",
+        "counterpart_type",
+        "prices",
+        "indicator",
+    ],
+    "counterpart_type": ["year", "counterpart_type", "prices", "indicator_type"],
+    "summary": ["year", "prices", "indicator_type"],
+    "summary_net_flows": ["year", "prices"],
+}
+
+Cube = dict[tuple[str, ...], pd.DataFrame]
+
+
+def _sum_by(data: pd.DataFrame, dimensions: list[str]) -> pd.DataFrame:
+    return (
+        data.groupby(dimensions, observed=True, dropna=False)["value"]
+        .sum()
+        .reset_index()
+    )
+
+
+def _smallest_containing(cube: Cube, dimensions: set[str]) -> tuple[str, ...]:
+    """The smallest rollup in the cube which has all the dimensions"""
+    candidates = [d for d in cube if dimensions <= set(d)]
+
+    if not candidates:
+        raise ValueError(f"No rollup of the cube has the dimensions {dimensions}")
+
+    return min(candidates, key=lambda d: len(cube[d]))
+
+
+def build_cube(
+    data: pd.DataFrame,
+    rollups: dict[str, list[str]] | None = None,
+    groups: dict[str, dict] | None = None,
+) -> Cube:
+    """Build a cube of flows by country and group, computing its rollups.
+
+    Args:
+        data (pd.DataFrame): The flows by country, with a value column.
+        rollups (dict[str, list[str]], optional): The rollups to compute (the
+            dimensions each one keeps besides the entity). Defaults to `ROLLUPS`.
+        groups (dict[str, dict], optional): The country groups. Defaults to the
+            groups in `config.GROUPS_FILE`.
+
+    Returns:
+        dict: The rollups, keyed by the dimensions they keep. The first one is the
+        base data.
+    """
+    rollups = ROLLUPS if rollups is None else rollups
+
+    base = pd.concat(
+        [
+            data.assign(level="country"),
+            group_totals(data, groups).assign(level="group"),
+        ],
+        ignore_index=True,
+    ).pipe(to_categorical)
+    base["level"] = base["level"].astype("category")
+
+    # The base has one row per combination of the dimensions, like the rollups
+    dimensions = tuple(c for c in DIMENSIONS if c in base.columns)
+    cube = {dimensions: _sum_by(base, list(dimensions))}
+
+    grouping_sets = {
+        tuple(c for c in dimensions if c in ENTITY or c in keep)
+        for keep in rollups.values()
+    }
+
+    # Larger rollups first, so the smaller ones can be computed from them
+    for grouping_set in sorted(grouping_sets, key=len, reverse=True):
+        if grouping_set not in cube:
+            parent = cube[_smallest_containing(cube, set(grouping_set))]
+            cube[grouping_set] = _sum_by(parent, list(grouping_set))
+
+    return cube
+
+
+def query_cube(
+    cube: Cube,
+    dimensions: list[str],
+    filters: dict | None = None,
+    level: str = "country",
+) -> pd.DataFrame:
+    """Sum the flows by some dimensions, for the rows which match the filters.
+
+    Args:
+        cube (dict): A cube created with `build_cube`.
+        dimensions (list[str]): The dimensions to keep, in order.
+        filters (dict, optional): Values (or lists of values) to keep, by
+            dimension. E.g. `{"prices": "current", "year": [2021, 2022]}`.
+        level (str): 'country' for the flows by country or 'group' for the country
+            groups.
+
+    Returns:
+        pd.DataFrame: The dimensions and the summed value.
+    """
+    filters = {
+        column: values if isinstance(values, (list, tuple, set)) else [values]
+        for column, values in ({"level": level} | (filters or {})).items()
+    }
+    rollup = _smallest_containing(cube, set(dimensions) | set(filters))
+    data = cube[rollup]
+
+    mask = np.ones(len(data), dtype=bool)
+    for column, values in filters.items():
+        mask &= data[column].isin(values).to_numpy()
+
+    # If the other dimensions of the rollup are fixed by the filters, its rows are
+    # already the answer
+    summed = set(rollup) - set(dimensions)
+    if all(len(filters.get(column, [])) == 1 for column in summed):
+        return data.loc[mask, list(dimensions) + ["value"]].reset_index(drop=True)
+
+    return _sum_by(data.loc[mask], list(dimensions))
@@ -1,11 +1,10 @@
 """Debt service analysis to show historical trends and projections"""
 
+import numpy as np
 import pandas as pd
 
 from scripts.analysis.common import (
-    create_grouping_totals,
-    create_world_total,
-    add_china_as_counterpart_type,
+    add_group_totals,
     reorder_countries,
     exclude_countries_without_outflows,
     exclude_outlier_countries,
@@ -13,6 +12,21 @@ from scripts.analysis.common import (
 from scripts.config import Paths
 from scripts.data.outflows import get_debt_service_data
 
+# The periods of the average repayment charts: their label and first and last year
+PERIODS: dict[str, tuple[int, int]] = {
+    "2010-2014": (2010, 2014),
+    "2018-2022": (2018, 2022),
+    "2023-2025 (projected)": (2023, 2025),
+}
+
+COUNTERPART_KEYS: list[str] = [
+    "year",
+    "country",
+    "continent",
+    "income_level",
+    "counterpart_type",
+]
+
 
 def remove_world(df: pd.DataFrame) -> pd.DataFrame:
     """Remove 'World' (totals) from counterpart area data"""
@@ -20,17 +34,38 @@ def remove_world(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def groupby_counterpart_type(df: pd.DataFrame) -> pd.DataFrame:
-    """Group data by counterpart type"""
-    return (
-        df.groupby(
-            ["year", "country", "continent", "income_level", "counterpart_type"],
-            dropna=False,
-            observed=True,
-        )
-        .sum(numeric_only=True)
+    """Group data by counterpart type, with and without China as a counterpart type.
+
+    The data is grouped once, keeping whether the counterpart is China. Both
+    versions are built from that, stacked and marked by `china_as_type`.
+    """
+    china = (df["counterpart_area"] == "China").to_numpy(dtype=bool, na_value=False)
+
+    data = (
+        df.assign(china=china)
+        .groupby(COUNTERPART_KEYS + ["china"], dropna=False, observed=True)["value"]
+        .sum()
         .reset_index()
     )
 
+    # With China as counterpart type, its payments are moved out of their type
+    china_as_type = data.assign(
+        counterpart_type=lambda d: d["counterpart_type"]
+        .astype("object")
+        .where(~d["china"], "China")
+    )
+
+    return pd.concat(
+        [
+            variant.groupby(COUNTERPART_KEYS, dropna=False, observed=True)["value"]
+            .sum()
+            .reset_index()
+            .assign(china_as_type=as_type)
+            for as_type, variant in [(False, data), (True, china_as_type)]
+        ],
+        ignore_index=True,
+    )
+
 
 def add_africa_total(df: pd.DataFrame) -> pd.DataFrame:
     """Add a total for Africa"""
@@ -57,12 +92,40 @@ def pivot_flourish_columns(df: pd.DataFrame) -> pd.DataFrame:
     ).reset_index(drop=False)
 
 
-def calculate_mean(df: pd.DataFrame, start: int, end: int) -> pd.DataFrame:
-    df = df.query(f"year >= {start} & year <= {end}").assign(year=f"{start}-{end}")
+def period_bins(years: pd.Series, periods: dict[str, tuple[int, int]]) -> pd.DataFrame:
+    """The periods each year belongs to, with a row per year and period (periods
+    can overlap)"""
+    years = np.unique(years.dropna().to_numpy(dtype="int64"))
+    starts, ends = np.array(list(periods.values())).reshape(-1, 2).T
+
+    year, period = np.nonzero((years[:, None] >= starts) & (years[:, None] <= ends))
+
+    return pd.DataFrame(
+        {"year": years[year], "period": np.array(list(periods), dtype=object)[period]}
+    )
+
+
+def group_by_avg_payments(
+    df: pd.DataFrame, periods: dict[str, tuple[int, int]]
+) -> pd.DataFrame:
+    """Average the payments over each period (the mean of the years with data).
+
+    The years are assigned to their periods in a single join, so all the periods
+    are averaged in a single grouping.
+
+    Args:
+        df (pd.DataFrame): The payments by year.
+        periods (dict[str, tuple[int, int]]): The first and last year of each
+            period, by label.
+    """
+    bins = period_bins(df["year"], periods)
+    data = df.merge(bins, on="year", how="inner")
 
     return (
-        df.groupby(
-            [c for c in df.columns if c not in ["value"]],
+        data.drop(columns="year")
+        .rename(columns={"period": "year"})
+        .groupby(
+            ["year"] + [c for c in df.columns if c not in ["year", "value"]],
             dropna=False,
             observed=True,
         )["value"]
@@ -71,17 +134,6 @@ def calculate_mean(df: pd.DataFrame, start: int, end: int) -> pd.DataFrame:
     )
 
 
-def group_by_avg_payments(df: pd.DataFrame, groups: list[tuple[int]]) -> pd.DataFrame:
-    """Group in groups of 3 years"""
-
-    dfs = []
-
-    for start, end in groups:
-        dfs.append(df.pipe(calculate_mean, start=start, end=end))
-
-    return pd.concat(dfs, ignore_index=True)
-
-
 def remove_default_groupings(data: pd.DataFrame) -> pd.DataFrame:
     """Remove default groupings"""
 
@@ -106,64 +158,61 @@ def remove_default_groupings(data: pd.DataFrame) -> pd.DataFrame:
     return data.loc[lambda d: ~d.country.isin(default_groupings)]
 
 
-def get_preprocess_debt_service(
-    constant: bool = False, china_as_type: bool = False
-) -> pd.DataFrame:
+def get_preprocess_debt_service_variants(
+    constant: bool = False, periods: dict[str, tuple[int, int]] | None = None
+) -> dict[bool, pd.DataFrame]:
+    """The average payments by period, without and with China as a counterpart
+    type (keyed by `china_as_type`). Both are computed together.
+
+    Args:
+        constant (bool): Whether to use constant prices.
+        periods (dict[str, tuple[int, int]], optional): The first and last year of
+            each period, by label. Defaults to `PERIODS`.
+    """
+    periods = PERIODS if periods is None else periods
+
     data = (
         get_debt_service_data(constant=constant)
         .pipe(exclude_outlier_countries)
         .pipe(exclude_countries_without_outflows)
         .pipe(remove_default_groupings)
         .pipe(remove_world)
-        .pipe(create_world_total, "Developing countries")
-        .pipe(
-            create_grouping_totals,
-            group_column="continent",
-            exclude_cols=["income_level"],
-        )
-        .pipe(
-            create_grouping_totals,
-            group_column="income_level",
-            exclude_cols=["continent"],
-        )
-    )
-
-    if china_as_type:
-        data = data.pipe(add_china_as_counterpart_type)
-
-    data = (
-        data.pipe(groupby_counterpart_type)
-        .pipe(group_by_avg_payments, [(2010, 2014), (2018, 2022), (2023, 2025)])
-        .pipe(reorder_countries, True)
+        .pipe(add_group_totals)
+        .pipe(groupby_counterpart_type)
+        .pipe(group_by_avg_payments, periods)
         .drop(columns=["income_level", "continent"])
-        .replace({"year": {"2023-2025": "2023-2025 (projected)"}})
         .pipe(add_percentages)
     )
 
-    return data
+    return {
+        bool(as_type): variant.drop(columns="china_as_type").pipe(
+            reorder_countries, True
+        )
+        for as_type, variant in data.groupby("china_as_type")
+    }
+
+
+def get_preprocess_debt_service(
+    constant: bool = False, china_as_type: bool = False
+) -> pd.DataFrame:
+    """The average payments by period, with or without China as counterpart type"""
+    return get_preprocess_debt_service_variants(constant=constant)[china_as_type]
 
 
 def add_percentages(data: pd.DataFrame) -> pd.DataFrame:
-    # add percentages as column
-    data = (
-        data.groupby(["year", "country"], dropna=False, observed=True, sort=False)[
-            ["year", "country", "counterpart_type", "value"]
-        ]
-        .apply(
-            lambda x: x.assign(percent=round(100 * x["value"] / x["value"].sum(), 1)),
-            include_groups=True,
-        )
-        .reset_index(drop=True)
-    )
+    """Add the share of each counterpart type in the payments of each year (or
+    period) and country, as a percentage"""
+    keys = [c for c in ["china_as_type", "year", "country"] if c in data.columns]
+    total = data.groupby(keys, dropna=False, observed=True)["value"].transform("sum")
 
-    return data
+    return data.assign(percent=(100 * data["value"] / total).round(1))
 
 
 def avg_repayments_charts() -> None:
     """Export data for average repayment charts for flourish"""
 
-    data = get_preprocess_debt_service(constant=False, china_as_type=False)
-    data_china = get_preprocess_debt_service(constant=False, china_as_type=True)
+    variants = get_preprocess_debt_service_variants(constant=False)
+    data, data_china = variants[False], variants[True]
 
     data.to_csv(Paths.output / "avg_repayments.csv", index=False)
     data_china.to_csv(Paths.output / "avg_repayments_china.csv", index=False)
@@ -8,25 +8,26 @@ from scripts.analysis.common import (
     exclude_countries_without_outflows,
 )
 from scripts.analysis.net_flows import get_all_flows, exclude_outlier_countries
+from scripts.analysis.panel import to_panel
 from scripts.analysis.population_tools import add_population_under18
 from scripts.config import Paths
+from scripts.data.common import to_categorical
 
 
 def check_inflows_and_outflows_present(data: pd.DataFrame):
     """Check if inflows and outflows are present in the data"""
 
-    data = (
-        data.groupby(["year", "country", "indicator_type"], dropna=False, observed=True)
-        .sum(numeric_only=True)
-        .reset_index()
+    panel = to_panel(
+        data,
+        {
+            "year": ["year"],
+            "country": ["country"],
+            "indicator_type": ["indicator_type"],
+        },
+        dropna=False,
     )
-    data = data.pivot(
-        index=[c for c in data.columns if c not in ["value", "indicator_type"]],
-        columns="indicator_type",
-        values="value",
-    ).reset_index()
 
-    return data
+    return panel.to_wide("indicator_type")
 
 
 def count_negative_flows_by_year(data: pd.DataFrame) -> pd.DataFrame:
@@ -64,7 +65,7 @@ def output_pipeline(constant: bool = False, limit_to_2022: bool = True) -> None:
         .pipe(negative_flows_only)
     )
 
-    df_grouped = create_groupings(df).pipe(reorder_countries)
+    df_grouped = create_groupings(df).pipe(reorder_countries).pipe(to_categorical)
 
     # Save data
     df.reset_index(drop=True).to_parquet(
@@ -1,8 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable
+
 import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
 
 from scripts.analysis.common import (
+    combination_codes,
     create_groupings,
     reorder_countries,
     add_china_as_counterpart_type,
@@ -14,18 +17,173 @@ from scripts.analysis.net_flows import (
     rename_indicators,
     exclude_outlier_countries,
 )
+from scripts.analysis.panel import Panel, to_panel
+from scripts import config
 from scripts.config import Paths
+from scripts.data.common import to_categorical
 from scripts.data.outflows import get_debt_service_data
 
 
-def calculate_linear_trend_and_predict(
+def linear_trends(
+    series: np.ndarray, x: np.ndarray, y: np.ndarray, n_series: int | None = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit a least squares line to many series at once.
+
+    The slope and intercept of each series come from its sums of x, y, xy and x²,
+    which are computed for all the series in one pass.
+
+    Args:
+        series (np.ndarray): The series (as an integer code from 0) of each point.
+        x (np.ndarray): The x value of each point.
+        y (np.ndarray): The y value of each point.
+        n_series (int, optional): The number of series. Defaults to the largest
+            code plus one.
+
+    Returns:
+        tuple: The number of points, slope and intercept of each series. Series
+        with fewer than two distinct x values have a slope of 0.
+    """
+    if n_series is None:
+        n_series = series.max() + 1 if len(series) else 0
+
+    def sums(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(series, weights=weights, minlength=n_series)
+
+    count = np.bincount(series, minlength=n_series)
+    sum_x, sum_y = sums(x), sums(y)
+    sum_xy, sum_xx = sums(x * y), sums(x * x)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = count * sum_xx - sum_x**2
+        slope = np.where(variance > 0, (count * sum_xy - sum_x * sum_y) / variance, 0.0)
+        intercept = (sum_y - slope * sum_x) / count
+
+    return count, slope, intercept
+
+
+# Projection models. Each one takes the history of all the series as an array (one
+# row per series, one column per year up to the last observed year, with NaN for
+# missing years) and returns the projections for the next `horizons` years (NaN for
+# series it can't project).
+
+
+def linear_trend(history: np.ndarray, horizons: int) -> np.ndarray:
+    """Extend the least squares line through the observed years (at least two)"""
+    rows, columns = np.nonzero(~np.isnan(history))
+    count, slope, intercept = linear_trends(
+        rows,
+        x=(columns - (history.shape[1] - 1)).astype("float64"),
+        y=history[rows, columns],
+        n_series=len(history),
+    )
+
+    projections = intercept[:, None] + slope[:, None] * np.arange(1, horizons + 1)
+    projections[count < 2] = np.nan
+
+    return projections
+
+
+def rolling_mean(history: np.ndarray, horizons: int) -> np.ndarray:
+    """Keep the mean of the observed years"""
+    observed = ~np.isnan(history)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(observed, history, 0).sum(axis=1) / observed.sum(axis=1)
+
+    return np.repeat(mean[:, None], horizons, axis=1)
+
+
+def exponential_smoothing(
+    history: np.ndarray, horizons: int, alpha: float = 0.5
+) -> np.ndarray:
+    """Keep the exponentially weighted level of the observed years (simple
+    exponential smoothing, starting from the first observed year)"""
+    level = np.full(len(history), np.nan)
+
+    for y in history.T:
+        smoothed = np.where(np.isnan(level), y, alpha * y + (1 - alpha) * level)
+        level = np.where(np.isnan(y), level, smoothed)
+
+    return np.repeat(level[:, None], horizons, axis=1)
+
+
+def damped_trend(
+    history: np.ndarray,
+    horizons: int,
+    alpha: float = 0.5,
+    beta: float = 0.3,
+    phi: float = 0.9,
+) -> np.ndarray:
+    """Extend a trend which fades by `phi` each year (Holt's damped trend method).
+    Missing years are filled with the one-year-ahead projection."""
+    level = np.full(len(history), np.nan)
+    trend = np.zeros(len(history))
+
+    for y in history.T:
+        expected = level + phi * trend
+        new_level = np.where(np.isnan(level), y, alpha * y + (1 - alpha) * expected)
+        new_trend = np.where(
+            np.isnan(level), 0.0, beta * (new_level - level) + (1 - beta) * phi * trend
+        )
+
+        observed = ~np.isnan(y)
+        level = np.where(observed, new_level, expected)
+        trend = np.where(observed, new_trend, phi * trend)
+
+    damping = np.cumsum(phi ** np.arange(1, horizons + 1))
+
+    return level[:, None] + trend[:, None] * damping
+
+
+PROJECTION_MODELS: dict[str, Callable[[np.ndarray, int], np.ndarray]] = {
+    "linear_trend": linear_trend,
+    "rolling_mean": rolling_mean,
+    "exponential_smoothing": exponential_smoothing,
+    "damped_trend": damped_trend,
+}
+
+
+def _series_panel(
+    data: pd.DataFrame, series_keys: list[str], years: np.ndarray
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """Arrange the values of each series by year.
+
+    Returns:
+        tuple: The keys of each series and an array with one row per series and one
+        column per year (NaN where a series has no value).
+    """
+    series = data.groupby(series_keys, observed=True, dropna=False).ngroup().to_numpy()
+    _, first = np.unique(series, return_index=True)
+    keys = data[series_keys].iloc[first].reset_index(drop=True)
+
+    panel = np.full((len(keys), len(years)), np.nan)
+    columns = np.searchsorted(years, data["year"].to_numpy())
+    panel[series, columns] = data["value"].to_numpy(dtype="float64")
+
+    return keys, panel
+
+
+def calculate_trend_and_predict(
     data: pd.DataFrame,
     base_year: int,
     years_back: int = 5,
     years_forward: int = 3,
     creditors_grouping: str = "counterpart_area",
+    model: str = "linear_trend",
 ) -> pd.DataFrame:
-    """Calculate linear trend over the last n years and predict for the next m years"""
+    """Project each series over the next m years, from its last n years.
+
+    Args:
+        data (pd.DataFrame): The inflows, with year and value columns.
+        base_year (int): The last year of data used for the projections.
+        years_back (int): The number of years the projections are based on.
+        years_forward (int): The number of years to project.
+        creditors_grouping (str): The counterpart column of the series.
+        model (str): The projection model, one of `PROJECTION_MODELS`.
+
+    Returns:
+        pd.DataFrame: The data by series (summed) and the projections, which are
+        never negative.
+    """
     if creditors_grouping is None:
         creditors_grouping = ["counterpart_area"]
 
@@ -51,53 +209,27 @@ def calculate_linear_trend_and_predict(
         .reset_index()
     )
 
-    # Prepare data for regression
+    # Prepare data for the projections: one row per series, one column per year
     regress_data = data[group + ["value"]].dropna()
+    years = np.arange(base_year - years_back + 1, base_year + 1)
+    keys, history = _series_panel(
+        regress_data.loc[lambda d: d.year <= base_year],
+        series_keys=["country", "continent", "income_level"] + creditors_grouping,
+        years=years,
+    )
 
-    # Initialize the linear regression model
-    model = LinearRegression()
-
-    # Prediction years
-    future_years = np.array(
-        [base_year - years_back + 1 + years_back + i for i in range(years_forward)]
-    ).reshape(-1, 1)
-
-    # Convert to df
-    future_years_df = pd.DataFrame(future_years, columns=["year"])
-
-    # Predict for each country
-    predictions = []
-    for (
-        country,
-        continent,
-        income_level,
-        counterpart,
-    ), group in regress_data.groupby(
-        ["country", "continent", "income_level"] + creditors_grouping,
-        observed=True,
-        dropna=False,
-    ):
-        # Need at least two points to fit a line
-        if len(group) < 2:
-            continue
-
-        X = group[["year"]].reset_index(drop=True)
-        y = group["value"].reset_index(drop=True)
-        model.fit(X, y)
-        future_values = model.predict(future_years_df)
-        for year, value in zip(future_years_df["year"], future_values):
-            predictions.append(
-                {
-                    "year": year,
-                    "country": country,
-                    "continent": continent,
-                    "income_level": income_level,
-                    creditors_grouping[0]: counterpart,
-                    "value": value,
-                }
-            )
+    # Project all the years for every series (series by row, years by column)
+    values = PROJECTION_MODELS[model](history, years_forward)
+    projected = ~np.isnan(values).any(axis=1)
+    keys, values = keys.loc[projected].reset_index(drop=True), values[projected]
 
-    prediction_df = pd.DataFrame(predictions)
+    prediction_df = keys.loc[np.repeat(keys.index, years_forward)].reset_index(
+        drop=True
+    )
+    prediction_df.insert(
+        0, "year", np.tile(base_year + 1 + np.arange(years_forward), len(keys))
+    )
+    prediction_df["value"] = values.ravel()
 
     # Limit predictions to positive values (inflows cannot be negative)
     prediction_df.loc[lambda d: d.value < 0, "value"] = 0
@@ -107,34 +239,33 @@ def calculate_linear_trend_and_predict(
     )
 
 
+def calculate_linear_trend_and_predict(
+    data: pd.DataFrame,
+    base_year: int,
+    years_back: int = 5,
+    years_forward: int = 3,
+    creditors_grouping: str = "counterpart_area",
+) -> pd.DataFrame:
+    """Calculate linear trend over the last n years and predict for the next m years"""
+    return calculate_trend_and_predict(
+        data,
+        base_year=base_year,
+        years_back=years_back,
+        years_forward=years_forward,
+        creditors_grouping=creditors_grouping,
+        model="linear_trend",
+    )
+
+
 def calculate_average_inflows(data: pd.DataFrame, years: int = 2) -> pd.DataFrame:
     """Calculate average inflows over the last n years"""
 
-    data = data.loc[lambda d: d.indicator_type == "inflow"].copy()
+    data = data.loc[lambda d: d.indicator_type == "inflow"]
 
-    data = (
-        data.groupby(["year", "country"], dropna=False, observed=True)
-        .sum(numeric_only=True)
-        .reset_index()
-    )
-
-    # Add the rolling sum
-    data["rolling_inflow"] = (
-        data.fillna({"value": 0})
-        .groupby(
-            [c for c in data.columns if c not in ["year", "value"]],
-            observed=True,
-            dropna=False,
-            group_keys=False,
-            as_index=False,
-        )["value"]
-        .rolling(
-            years, min_periods=1
-        )  # min periods are 1 to avoid Nans in sparse data (when very granular)
-        .mean()["value"]
-    )
+    # Missing values count as zero, and the mean is over the last years with data
+    panel = to_panel(data, {"year": ["year"], "country": ["country"]}, dropna=False)
 
-    return data.drop(columns="value")
+    return panel.rolling_mean(years, skip_missing=True).to_long(value="rolling_inflow")
 
 
 def outflows_projections(
@@ -163,94 +294,256 @@ def projected_netflows(inflows: pd.DataFrame, outflows: pd.DataFrame) -> pd.Data
 
     data = pd.concat([inflows, outflows], ignore_index=True)
 
-    # pivot the data
+    entity = ["country", "continent", "income_level"]
+    axes = {
+        "year": ["year"],
+        "entity": entity,
+        "other": [
+            c
+            for c in data.columns
+            if c not in ["year", "value", "indicator_type"] + entity
+        ],
+        "indicator_type": ["indicator_type"],
+    }
+
+    # Sum by country (missing values count as zero)
+    totals = to_panel(data, axes, dropna=False).sum("other")
+
+    # Whether each country (and its continent and income level) has any inflow
+    observed = to_panel(data.assign(value=data["value"].notna()), axes)
+    has_inflow = observed.take("indicator_type", "inflow").sum("other").values > 0
+
+    # Projected years are kept once for each entity of the country (by name) which
+    # has an inflow projection, and removed if there is none
+    country, countries = combination_codes(totals.axes["entity"], ["country"])
+    members = np.zeros((len(country), len(countries)))
+    members[np.arange(len(country)), country] = 1
+    entities_with_inflow = (has_inflow @ members)[:, country]
+
+    projected = totals.axes["year"]["year"].to_numpy() > 2022
+    weight = np.where(projected[:, None], entities_with_inflow, 1)
+
+    values = totals.values * np.where(weight > 0, weight, np.nan)[..., None]
+
     data = (
-        data.pivot(
-            index=[c for c in data.columns if c not in ["value", "indicator_type"]],
-            columns="indicator_type",
-            values="value",
-        ).reset_index()
-        # .fillna(0)
+        Panel(values, totals.axes)
+        .to_wide("indicator_type")
+        .fillna({"inflow": 0, "outflow": 0})
     )
+    data["net_flows"] = data["inflow"] + data["outflow"]
 
-    # Create grouped data at right level to check missing projections.
-    missing_projections_groups = data.loc[lambda d: d.year > 2022].groupby(
-        ["year", "country", "continent", "income_level"], dropna=False
-    )
+    return data
 
-    # Check if inflow is missing for all values in group
-    missing_projections = (
-        missing_projections_groups["inflow"]
-        .apply(lambda x: x.isnull().all())
-        .reset_index()
-        .filter(["year", "country", "inflow"])
+
+def projection_inputs(
+    constant: bool = False, limit_to_2022: bool = True
+) -> pd.DataFrame:
+    """The inflows the projections are based on, with China as counterpart type"""
+    return (
+        get_all_flows(limit_to_2022=limit_to_2022, constant=constant)
+        .pipe(exclude_outlier_countries)
+        .pipe(exclude_countries_without_outflows)
+        .loc[lambda d: d.indicator_type == "inflow"]
+        .reset_index(drop=True)
+        .copy(deep=True)
+        .pipe(add_china_as_counterpart_type)
     )
 
-    # Merge missing projections back to data. Remove missing inflow projections
-    data = (
-        pd.merge(
-            data,
-            missing_projections,
-            on=["year", "country"],
-            how="left",
-            suffixes=("", "_m"),
+
+def _error_metrics(
+    projected: np.ndarray, actual: np.ndarray, cells: np.ndarray, n_cells: int
+) -> pd.DataFrame:
+    """Summarise the errors of the projections (NaN where a series could not be
+    projected) by cell. `cells` has the cell of each projection, twice over (for
+    its group and for 'All'), and `n_cells` is the number of groups."""
+    valid = ~np.isnan(projected)
+    error = np.where(valid, projected - actual, 0)
+
+    def sums(values: np.ndarray) -> np.ndarray:
+        return np.bincount(
+            cells.ravel(),
+            weights=np.concatenate([values, values]).ravel(),
+            minlength=n_cells * projected.shape[1],
         )
-        .loc[lambda d: d.inflow_m != True]
-        .drop(columns=["inflow_m"])
-    )
 
-    # Group by country
-    data = (
-        data.groupby(
-            ["year", "country", "continent", "income_level"],
-            dropna=False,
-            observed=True,
+    count = sums(valid.astype("float64"))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame(
+            {
+                "projections": count.astype("int64"),
+                "mae": sums(np.abs(error)) / count,
+                "rmse": np.sqrt(sums(error**2) / count),
+                "bias": sums(error) / count,
+                "wape": sums(np.abs(error)) / sums(np.where(valid, actual, 0)),
+            }
         )
-        .sum(numeric_only=True)
+
+
+def backtest_projections(
+    data: pd.DataFrame,
+    origins: Iterable[int] = range(2012, 2020),
+    models: list[str] | None = None,
+    years_back: Iterable[int] = (3, 4, 5),
+    years_forward: int = 3,
+    creditors_grouping: str = "counterpart_type",
+    group_column: str = "income_level",
+) -> pd.DataFrame:
+    """Measure how well each model would have projected the inflows.
+
+    For every origin year, each series is projected from its `years_back` years up
+    to the origin and compared with its data for the next `years_forward` years.
+    Each model projects all the origins and series in a single call. Series with no
+    data in a projected year had no inflows (zero values are not stored).
+
+    Args:
+        data (pd.DataFrame): The inflows, as returned by `projection_inputs`.
+        origins (Iterable[int]): The last years of data of the projections.
+        models (list[str], optional): The models to test. Defaults to all the
+            models in `PROJECTION_MODELS`.
+        years_back (Iterable[int]): The numbers of years to base the projections
+            on.
+        years_forward (int): The number of years to project.
+        creditors_grouping (str): The counterpart column of the series.
+        group_column (str): The column to report the errors by.
+
+    Returns:
+        pd.DataFrame: For each model, years_back, horizon (years after the origin)
+        and group (or 'All'): the number of projections, the mean absolute error,
+        root mean squared error, bias (mean of projected minus actual values) and
+        weighted absolute percentage error (absolute errors over actual values).
+    """
+    models = list(PROJECTION_MODELS) if models is None else models
+    origins = np.asarray(list(origins))
+    years_back = list(years_back)
+    series_keys = ["country", "continent", "income_level", creditors_grouping]
+
+    # One row per series, one column per year from the first year of the longest
+    # window to the last projected year
+    years = np.arange(
+        origins.min() - max(years_back) + 1, origins.max() + years_forward + 1
+    )
+    data = (
+        data.loc[lambda d: d.year.between(years[0], years[-1])]
+        .groupby(["year"] + series_keys, observed=True, dropna=False)["value"]
+        .sum()
         .reset_index()
+        .dropna()
     )
+    keys, panel = _series_panel(data, series_keys, years)
+
+    # The group of every projection (series by origin, then horizon), and again
+    # with 'All' (the last group) to sum over all the groups
+    codes, labels = pd.factorize(keys[group_column])
+    n_groups = len(labels) + 1
+    groups = np.repeat(codes, len(origins))
+    cells = np.concatenate([groups, np.full_like(groups, n_groups - 1)])[
+        :, None
+    ] * years_forward + np.arange(years_forward)
+
+    origin_columns = np.searchsorted(years, origins)
+    ahead = origin_columns[:, None] + np.arange(1, years_forward + 1)
+    actual = np.nan_to_num(panel[:, ahead].reshape(-1, years_forward))
+
+    results = []
+    for lags in years_back:
+        window = origin_columns[:, None] + np.arange(1 - lags, 1)
+        history = panel[:, window].reshape(-1, lags)
+
+        for model in models:
+            projected = np.clip(
+                PROJECTION_MODELS[model](history, years_forward), 0, None
+            )
+            metrics = _error_metrics(projected, actual, cells, n_groups)
+            results.append(
+                metrics.assign(
+                    model=model,
+                    years_back=lags,
+                    horizon=np.tile(np.arange(1, years_forward + 1), n_groups),
+                    **{group_column: np.repeat(list(labels) + ["All"], years_forward)},
+                )
+            )
 
-    data["net_flows"] = data["inflow"] + data["outflow"]
+    columns = ["model", "years_back", "horizon", group_column]
 
-    return data
+    return (
+        pd.concat(results, ignore_index=True)
+        .loc[lambda d: d.projections > 0]
+        .filter(columns + ["projections", "mae", "rmse", "bias", "wape"])
+        .reset_index(drop=True)
+    )
 
 
-def projections_pipline(
-    years_back: int = 3,
-    years_forward: int = 3,
-    constant: bool = False,
-    limit_to_2022: bool = True,
-    projected_only: bool = True,
-) -> None:
+def backtest_pipeline(constant: bool = False) -> pd.DataFrame:
+    """Backtest the projection models and save the errors"""
+    results = backtest_projections(projection_inputs(constant=constant))
+    results.to_csv(Paths.output / "projection_backtest.csv", index=False)
 
-    # Get full dataset
-    data = (
-        get_all_flows(limit_to_2022=limit_to_2022, constant=constant)
+    return results
+
+
+def projection_outflows(constant: bool = False) -> pd.DataFrame:
+    """The outflows (including the projected debt service) by counterpart type"""
+    return (
+        outflows_projections(constant=constant, creditors_grouping="counterpart_type")
         .pipe(exclude_outlier_countries)
-        .pipe(exclude_countries_without_outflows)
-        .loc[lambda d: d.indicator_type == "inflow"]
-        .reset_index(drop=True)
-        .copy(deep=True)
-        .pipe(add_china_as_counterpart_type)
+        .assign(indicator_type="outflow")
     )
 
-    # Calculate projected inflows based on 5 year trend
-    inflows = calculate_linear_trend_and_predict(
+
+def project_net_flows(
+    data: pd.DataFrame,
+    outflows: pd.DataFrame,
+    years_back: int = 3,
+    years_forward: int = 3,
+    model: str = "linear_trend",
+) -> pd.DataFrame:
+    """Project the inflows and net flows of each country.
+
+    Args:
+        data (pd.DataFrame): The inflows, as returned by `projection_inputs`.
+        outflows (pd.DataFrame): The outflows, as returned by
+            `projection_outflows`.
+        years_back (int): The number of years the projections are based on.
+        years_forward (int): The number of years to project.
+        model (str): The projection model, one of `PROJECTION_MODELS`.
+
+    Returns:
+        pd.DataFrame: The inflows, outflows and net flows by country and year.
+    """
+    # Calculate projected inflows based on the last years
+    inflows = calculate_trend_and_predict(
         data=data,
         base_year=2022,
         years_back=years_back,
         years_forward=years_forward,
         creditors_grouping="counterpart_type",
+        model=model,
     )
 
-    # Get outflows projections
-    outflows = (
-        outflows_projections(constant=constant, creditors_grouping="counterpart_type")
-        .pipe(exclude_outlier_countries)
-        .assign(indicator_type="outflow")
-    )
+    return projected_netflows(inflows=inflows, outflows=outflows).pipe(to_categorical)
 
-    projections_full = projected_netflows(inflows=inflows, outflows=outflows)
+
+def projections_pipline(
+    years_back: int = 3,
+    years_forward: int = 3,
+    constant: bool = False,
+    limit_to_2022: bool = True,
+    projected_only: bool = True,
+    model: str = "linear_trend",
+) -> None:
+
+    # Get full dataset and the outflows projections
+    data = projection_inputs(constant=constant, limit_to_2022=limit_to_2022)
+    outflows = projection_outflows(constant=constant)
+
+    projections_full = project_net_flows(
+        data,
+        outflows,
+        years_back=years_back,
+        years_forward=years_forward,
+        model=model,
+    )
 
     # Get projected net flows
     projections = projections_full.drop(columns=["inflow", "outflow"]).rename(
@@ -277,5 +570,82 @@ def projections_pipline(
     )
 
 
+# The inputs shared by the scenarios, set once in each worker process
+_scenario_inputs: tuple[pd.DataFrame, pd.DataFrame] | None = None
+
+
+def _set_scenario_inputs(data: pd.DataFrame, outflows: pd.DataFrame) -> None:
+    global _scenario_inputs
+    _scenario_inputs = (data, outflows)
+
+
+def _run_scenario(scenario: dict) -> pd.DataFrame:
+    """Project the net flows for a scenario (in a worker process)"""
+    data, outflows = _scenario_inputs
+
+    return (
+        project_net_flows(data, outflows, **scenario)
+        .loc[lambda d: d.year > 2022]
+        .assign(**scenario)
+    )
+
+
+def sweep_projections(
+    years_back: Iterable[int] = range(2, 8),
+    years_forward: Iterable[int] = range(1, 6),
+    models: Iterable[str] = ("linear_trend",),
+    constant: bool = False,
+    workers: int | None = None,
+) -> pd.DataFrame:
+    """Project the net flows for every combination of the parameters.
+
+    The inflows and outflows are prepared once. They are sent to each worker
+    process once (not with every scenario), and the scenarios are run on a
+    process pool.
+
+    Args:
+        years_back (Iterable[int]): The numbers of years to base the projections on.
+        years_forward (Iterable[int]): The numbers of years to project.
+        models (Iterable[str]): The projection models.
+        constant (bool): Whether to use constant prices.
+        workers (int, optional): The number of processes. Defaults to
+            `config.PIPELINE_WORKERS`.
+
+    Returns:
+        pd.DataFrame: The projected inflows, outflows and net flows by country and
+        year, for each scenario (model, years_back and years_forward).
+    """
+    scenarios = [
+        {"model": model, "years_back": back, "years_forward": forward}
+        for model in models
+        for back in years_back
+        for forward in years_forward
+    ]
+
+    data = projection_inputs(constant=constant)
+    outflows = projection_outflows(constant=constant)
+
+    with ProcessPoolExecutor(
+        max_workers=workers or config.PIPELINE_WORKERS,
+        initializer=_set_scenario_inputs,
+        initargs=(data, outflows),
+    ) as pool:
+        results = list(pool.map(_run_scenario, scenarios))
+
+    scenario_columns = ["model", "years_back", "years_forward"]
+    results = pd.concat(results, ignore_index=True)
+
+    return results.filter(
+        scenario_columns + [c for c in results.columns if c not in scenario_columns]
+    ).pipe(to_categorical)
+
+
+def sweep_pipeline(constant: bool = False) -> None:
+    """Run the default projections sweep and save the results"""
+    sweep_projections(constant=constant).to_parquet(
+        Paths.output / "net_flow_projection_scenarios.parquet"
+    )
+
+
 if __name__ == "__main__":
     projections_pipline()
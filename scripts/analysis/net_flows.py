@@ -1,3 +1,5 @@
+import functools
+
 import pandas as pd
 from bblocks import set_bblocks_data_path
 from bblocks.dataframe_tools.add import add_gdp_column
@@ -5,12 +7,13 @@ from bblocks.dataframe_tools.add import add_gdp_column
 from scripts.analysis.common import (
     exclude_outlier_countries,
     add_china_as_counterpart_type,
-    convert_to_net_flows,
-    summarise_by_country,
-    create_groupings,
     exclude_countries_without_outflows,
 )
+from scripts.analysis.cube import build_cube, query_cube
+from scripts.analysis.panel import to_panel
 from scripts.config import Paths
+from scripts.data.common import fill_missing, map_values, to_categorical
+from scripts.data.fetch import fetch_concurrently
 from scripts.data.inflows import get_total_inflows
 from scripts.data.outflows import get_debt_service_data
 
@@ -83,33 +86,43 @@ def rename_indicators(df: pd.DataFrame, suffix: str = "") -> pd.DataFrame:
         "other_private": f"Private - other{suffix}",
         "other": f"Private - other{suffix}",
     }
-    return df.assign(
-        indicator=lambda d: d.indicator.map(indicators).fillna(d.indicator)
-    )
+    return df.assign(indicator=lambda d: map_values(d.indicator, indicators))
 
 
-def get_all_flows(constant: bool = False, limit_to_2022: bool = True) -> pd.DataFrame:
+def get_all_flows(
+    constant: bool = False, limit_to_2022: bool = True, both_prices: bool = False
+) -> pd.DataFrame:
     """
     Retrieve all inflow and outflow data, process them, and combine into a single DataFrame.
 
     Args:
         constant (bool, optional): A flag to indicate whether to retrieve constant inflow
         and debt service data. Defaults to False.
+        both_prices (bool, optional): A flag to retrieve both current and constant
+        data (distinguished by the 'prices' column). The source data is loaded and
+        cleaned once for both. Overrides `constant`. Defaults to False.
 
     Returns:
         pd.DataFrame: The combined DataFrame of processed inflow and outflow data.
     """
 
-    # Get inflow and outflow data
-    inflows = (
-        get_total_inflows(constant=constant)
-        .pipe(prep_flows)
-        .pipe(rename_indicators, suffix="")
+    # Get inflow and outflow data (from independent sources, so concurrently)
+    fetched = fetch_concurrently(
+        {
+            "inflows": lambda: get_total_inflows(
+                constant=constant, both_prices=both_prices
+            ),
+            "outflows": lambda: get_debt_service_data(
+                constant=constant, both_prices=both_prices
+            ),
+        }
     )
 
-    # Get outflow data. NOTE: the value of outflow is negative
+    inflows = fetched["inflows"].pipe(prep_flows).pipe(rename_indicators, suffix="")
+
+    # Process outflow data. NOTE: the value of outflow is negative
     outflows = (
-        get_debt_service_data(constant=constant)
+        fetched["outflows"]
         .pipe(prep_flows)
         .assign(value=lambda d: -d.value)
         .pipe(rename_indicators, suffix="")
@@ -120,6 +133,7 @@ def get_all_flows(constant: bool = False, limit_to_2022: bool = True) -> pd.Data
         pd.concat([inflows, outflows], ignore_index=True)
         .drop(columns=["counterpart_iso_code", "iso_code"])
         .loc[lambda d: d.value != 0]
+        .pipe(to_categorical)
     )
     if limit_to_2022:
         data = data.loc[lambda d: d.year <= 2022]
@@ -142,11 +156,11 @@ def pivot_by_indicator(data: pd.DataFrame) -> pd.DataFrame:
         pd.DataFrame: The pivoted DataFrame.
     """
 
-    return data.pivot(
-        index=[c for c in data.columns if c not in ["value", "indicator_type"]],
-        columns="indicator_type",
-        values="value",
-    ).reset_index()
+    index = [c for c in data.columns if c not in ["value", "indicator_type"]]
+
+    return to_panel(
+        data, {"index": index, "indicator_type": ["indicator_type"]}
+    ).to_wide("indicator_type")
 
 
 def flip_outflow_values(df: pd.DataFrame) -> pd.DataFrame:
@@ -227,7 +241,7 @@ def create_scatter_data(data: pd.DataFrame) -> pd.DataFrame:
         )["value"]
         .sum()
         .reset_index()
-        .fillna({"income_level": "Not assessed"})
+        .assign(income_level=lambda d: fill_missing(d.income_level, "Not assessed"))
     )
 
     # Flip the sign of the outflow values
@@ -245,76 +259,74 @@ def create_scatter_data(data: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def save_pipeline(data: pd.DataFrame, suffix: str) -> None:
-
-    data_grouped = create_groupings(data)
-
-    # Save detailed data as parquet
-    data.reset_index(drop=True).to_parquet(
-        Paths.output / f"full_flows_country{suffix}.parquet"
-    )
-
-    # Saved country grouping data as parquet
-    data_grouped.reset_index(drop=True).to_parquet(
-        Paths.output / f"full_flows_grouping{suffix}.parquet"
-    )
-
-    # convert to net flows
-    data_net = convert_to_net_flows(data=data)
-    data_grouped_net = convert_to_net_flows(data=data_grouped)
-
-    # Save net flows data as parquet
-    data_net.reset_index(drop=True).to_parquet(
-        Paths.output / f"net_flows_country{suffix}.parquet"
-    )
-    data_grouped_net.reset_index(drop=True).to_parquet(
-        Paths.output / f"net_flows_grouping{suffix}.parquet"
-    )
+# Columns which are summed over in the summary files
+SUMMARY_EXCLUDED: list[str] = ["counterpart_area", "counterpart_type", "indicator"]
 
-    # Summarise data by country
-    data_summary = summarise_by_country(data=data)
-    data_grouped_summary = summarise_by_country(data=data_grouped)
-    data_net_summary = summarise_by_country(data=data_net)
-    data_grouped_net_summary = summarise_by_country(data=data_grouped_net)
 
-    # Save summary data as parquet
-    data_summary.reset_index(drop=True).to_parquet(
-        Paths.output / f"summary_flows_country{suffix}.parquet"
-    )
-    data_grouped_summary.reset_index(drop=True).to_parquet(
-        Paths.output / f"summary_flows_grouping{suffix}.parquet"
-    )
+def _as_net_flows(data: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """Label summed indicator types as net flows, with the columns in order"""
+    return data.assign(indicator_type="net_flow").filter(columns).pipe(to_categorical)
 
-    data_net_summary.reset_index(drop=True).to_parquet(
-        Paths.output / f"summary_net_flows_country{suffix}.parquet"
-    )
-    data_grouped_net_summary.reset_index(drop=True).to_parquet(
-        Paths.output / f"summary_net_flows_grouping{suffix}.parquet"
-    )
 
+def save_pipeline(data: pd.DataFrame, suffix: str) -> None:
+    """Save the full, net flows and summary files by country and by group.
 
-def all_flows_pipeline(
-    exclude_countries: bool = True, remove_countries_wo_outflows: bool = True
+    All the files are queried from a cube of the data, so each aggregate is
+    computed once (from the smallest rollup which has its dimensions).
+    """
+    data = to_categorical(data)
+    cube = build_cube(data)
+
+    keys = [c for c in data.columns if c != "value"]
+    net_keys = [c for c in keys if c != "indicator_type"]
+    summary_keys = [c for c in keys if c not in SUMMARY_EXCLUDED]
+    summary_net_keys = [c for c in summary_keys if c != "indicator_type"]
+
+    for level, name in [("country", "country"), ("group", "grouping")]:
+        files = {
+            "full_flows": query_cube(cube, keys, level=level).filter(data.columns),
+            "net_flows": query_cube(cube, net_keys, level=level).pipe(
+                _as_net_flows, net_keys + ["value", "indicator_type"]
+            ),
+            "summary_flows": query_cube(cube, summary_keys, level=level),
+            "summary_net_flows": query_cube(cube, summary_net_keys, level=level).pipe(
+                _as_net_flows, summary_keys + ["value"]
+            ),
+        }
+
+        for kind, output in files.items():
+            output.reset_index(drop=True).to_parquet(
+                Paths.output / f"{kind}_{name}{suffix}.parquet"
+            )
+
+
+def prepare_all_flows(
+    exclude_countries: bool = True,
+    remove_countries_wo_outflows: bool = True,
+    china_as_counterpart_type: bool = False,
 ) -> pd.DataFrame:
-    """Create a dataset with all flows for visualisation. It is saved as a CSV in the
-    output folder. It includes both constant and current prices.
-
-    The data is also returned as a DataFrame.
+    """Get the flows (in constant and current prices) by country, as they are
+    saved by `all_flows_pipeline`.
 
+    Args:
+        exclude_countries (bool): Whether to exclude the outlier countries.
+        remove_countries_wo_outflows (bool): Whether to exclude countries and years
+            without outflows.
+        china_as_counterpart_type (bool): Whether to show China as a counterpart
+            type (summing over the counterpart areas).
     """
 
-    # get constant and current data
-    df_const = get_all_flows(constant=False, limit_to_2022=True)
-    df_current = get_all_flows(constant=True, limit_to_2022=True)
+    # get constant and current data (loading the source data once)
+    data = get_all_flows(limit_to_2022=True, both_prices=True)
 
-    # Combine and make sure it is grouped at the right level
+    # Make sure it is grouped at the right level
     data = (
-        pd.concat([df_const, df_current], ignore_index=True)
-        .groupby(
-            [c for c in df_const.columns if c != "value"], observed=True, dropna=False
+        data.groupby(
+            [c for c in data.columns if c != "value"], observed=True, dropna=False
         )[["value"]]
         .sum()
         .reset_index()
+        .pipe(to_categorical)
     )
 
     if exclude_countries:
@@ -324,14 +336,17 @@ def all_flows_pipeline(
         # Exclude countries with incomplete data
         data = exclude_countries_without_outflows(data)
 
-    # Save the data
-    save_pipeline(data, "")
+    if china_as_counterpart_type:
+        data = _china_as_counterpart_type(data)
 
-    # separate china as counterpart type and produce a summary file
+    return data
+
+
+def _china_as_counterpart_type(data: pd.DataFrame) -> pd.DataFrame:
+    """Separate China as a counterpart type, summing over the counterpart areas"""
     data_china = data.pipe(add_china_as_counterpart_type)
 
-    # Save the data
-    data_china = (
+    return (
         data_china.groupby(
             [c for c in data_china.columns if c not in ["value", "counterpart_area"]],
             observed=True,
@@ -341,7 +356,40 @@ def all_flows_pipeline(
         .reset_index()
     )
 
-    save_pipeline(data_china, "_china_as_counterpart_type")
+
+@functools.cache
+def flows_cube(china_as_counterpart_type: bool = False) -> dict:
+    """The cube of all the flows (by country and group), built once per process.
+
+    Use `query_cube` to get any aggregate of the flows from it, e.g. the current
+    net flows by year for the income groups:
+    `query_cube(flows_cube(), ["year", "country"], {"prices": "current",
+    "income_level": [...]}, level="group")`.
+    """
+    return build_cube(
+        prepare_all_flows(china_as_counterpart_type=china_as_counterpart_type)
+    )
+
+
+def all_flows_pipeline(
+    exclude_countries: bool = True, remove_countries_wo_outflows: bool = True
+) -> pd.DataFrame:
+    """Create a dataset with all flows for visualisation. It is saved as a CSV in the
+    output folder. It includes both constant and current prices.
+
+    The data is also returned as a DataFrame.
+
+    """
+    data = prepare_all_flows(
+        exclude_countries=exclude_countries,
+        remove_countries_wo_outflows=remove_countries_wo_outflows,
+    )
+
+    # Save the data
+    save_pipeline(data, "")
+
+    # separate china as counterpart type and produce a summary file
+    save_pipeline(_china_as_counterpart_type(data), "_china_as_counterpart_type")
 
     return data
 
@@ -0,0 +1,216 @@
+"""Flows as a dense array.
+
+A panel stores long data (one row per combination of its dimensions) as a NumPy
+array with one axis per group of dimensions, e.g. entity (country, continent and
+income level), counterpart type, indicator type and year. The labels of each axis
+are kept on the side, as a DataFrame with one row per position. The year axis
+covers every year between the first and the last one, so rolling windows and
+changes between years are computed over calendar years.
+
+Once the data is in a panel, pivots, net flows, rolling means and year over year
+changes are array operations. Combinations which are not in the data are NaN.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from scripts.analysis.common import combination_codes
+
+
+@dataclass(frozen=True)
+class Panel:
+    """A dense array of values with the labels of each axis.
+
+    Attributes:
+        values (np.ndarray): The values, with one axis per item of `axes`.
+        axes (dict[str, pd.DataFrame]): The labels of each axis (one row per
+            position), by axis name.
+    """
+
+    values: np.ndarray
+    axes: dict[str, pd.DataFrame]
+
+    def _axis(self, axis: str) -> int:
+        return list(self.axes).index(axis)
+
+    def _without(self, axis: str, values: np.ndarray) -> "Panel":
+        return Panel(values, {k: v for k, v in self.axes.items() if k != axis})
+
+    def position(self, axis: str, label) -> int:
+        """The position of a label (the value of the axis' only column) on an axis"""
+        labels = self.axes[axis].iloc[:, 0]
+        positions = np.flatnonzero(labels.to_numpy() == label)
+
+        if not len(positions):
+            raise KeyError(f"{label} is not in the {axis} axis")
+
+        return positions[0]
+
+    def take(self, axis: str, label) -> "Panel":
+        """Select one label of an axis (removing the axis)"""
+        values = np.take(self.values, self.position(axis, label), axis=self._axis(axis))
+
+        return self._without(axis, values)
+
+    def sum(self, axis: str) -> "Panel":
+        """Sum over an axis. Missing values count as zero, unless they are all
+        missing (as in a groupby sum)."""
+        position = self._axis(axis)
+        present = ~np.isnan(self.values).all(axis=position)
+        total = np.nansum(self.values, axis=position)
+
+        return self._without(axis, np.where(present, total, np.nan))
+
+    def net_flows(self, axis: str = "indicator_type") -> "Panel":
+        """Sum the inflows and (negative) outflows"""
+        return self.sum(axis)
+
+    def rolling_mean(
+        self, window: int, axis: str = "year", skip_missing: bool = False
+    ) -> "Panel":
+        """The mean of the values over the last `window` positions of an axis (e.g.
+        years), skipping missing values. NaN where they are all missing.
+
+        With `skip_missing`, the window covers the last `window` values which are
+        not missing instead (like a rolling mean over the rows of long data). The
+        mean is then only computed where the value is not missing.
+        """
+        values = np.moveaxis(self.values, self._axis(axis), -1)
+        observed = ~np.isnan(values)
+
+        if skip_missing:
+            mean = _rolling_mean_of_values(values, observed, window)
+        else:
+
+            def rolling_sum(array: np.ndarray) -> np.ndarray:
+                total = np.cumsum(array, axis=-1)
+                total[..., window:] = total[..., window:] - total[..., :-window]
+                return total
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = rolling_sum(np.where(observed, values, 0)) / rolling_sum(
+                    observed.astype("float64")
+                )
+
+        return Panel(np.moveaxis(mean, -1, self._axis(axis)), self.axes)
+
+    def change(self, periods: int = 1, axis: str = "year") -> "Panel":
+        """The change of the values from `periods` positions earlier on an axis"""
+        values = np.moveaxis(self.values, self._axis(axis), -1)
+        change = np.full_like(values, np.nan)
+        change[..., periods:] = values[..., periods:] - values[..., :-periods]
+
+        return Panel(np.moveaxis(change, -1, self._axis(axis)), self.axes)
+
+    def _labels(self, axes: list[str]) -> pd.DataFrame:
+        """The labels of every combination of some axes, in the order of the array"""
+        shape = [len(self.axes[axis]) for axis in axes]
+        positions = np.unravel_index(np.arange(int(np.prod(shape))), shape)
+
+        return pd.concat(
+            [
+                self.axes[axis].iloc[position].reset_index(drop=True)
+                for axis, position in zip(axes, positions)
+            ],
+            axis=1,
+        )
+
+    def to_long(self, value: str = "value", dropna: bool = True) -> pd.DataFrame:
+        """Convert to long data: the labels of every axis and a value column"""
+        data = self._labels(list(self.axes)).assign(**{value: self.values.ravel()})
+
+        return data.dropna(subset=[value]).reset_index(drop=True) if dropna else data
+
+    def to_wide(self, axis: str) -> pd.DataFrame:
+        """Convert to wide data, with a column per label of an axis (like a pivot).
+        Combinations of the other axes which are all missing are dropped."""
+        position = self._axis(axis)
+        others = [a for a in self.axes if a != axis]
+
+        values = np.moveaxis(self.values, position, -1).reshape(
+            -1, self.values.shape[position]
+        )
+        columns = pd.Index(self.axes[axis].iloc[:, 0], name=axis)
+        wide = pd.DataFrame(values, columns=columns)
+        keep = ~np.isnan(values).all(axis=1)
+
+        return (
+            pd.concat([self._labels(others), wide], axis=1)
+            .loc[keep]
+            .reset_index(drop=True)
+            .rename_axis(columns=axis)
+        )
+
+
+def _rolling_mean_of_values(
+    values: np.ndarray, observed: np.ndarray, window: int
+) -> np.ndarray:
+    """The mean of the last `window` values which are not missing, along the last
+    axis. NaN where the value is missing."""
+    length = values.shape[-1]
+    flat_values = values.reshape(-1, length)
+    count = np.cumsum(observed, axis=-1).reshape(-1, length)
+    total = np.cumsum(np.where(observed, values, 0), axis=-1).reshape(-1, length)
+
+    # The running total of each series after each number of values
+    series, position = np.nonzero(observed.reshape(-1, length))
+    k = count[series, position]
+    by_count = np.zeros((len(flat_values), length + 1))
+    by_count[series, k] = total[series, position]
+
+    start = np.maximum(k - window, 0)
+    mean = np.full(flat_values.shape, np.nan)
+    mean[series, position] = (by_count[series, k] - by_count[series, start]) / (
+        k - start
+    )
+
+    return mean.reshape(values.shape)
+
+
+def _codes(data: pd.DataFrame, columns: list[str]) -> tuple[np.ndarray, pd.DataFrame]:
+    """Number the labels of an axis. Years are numbered from the first year, so
+    every year in between has a position."""
+    if columns == ["year"] and pd.api.types.is_integer_dtype(data["year"]):
+        years = data["year"].to_numpy()
+        first = years.min() if len(years) else 0
+        last = years.max() if len(years) else -1
+        return years - first, pd.DataFrame({"year": np.arange(first, last + 1)})
+
+    return combination_codes(data, columns)
+
+
+def to_panel(
+    data: pd.DataFrame,
+    axes: dict[str, list[str]],
+    value: str = "value",
+    dropna: bool = True,
+) -> Panel:
+    """Arrange long data as a panel.
+
+    Rows with the same labels are summed. Combinations which are not in the data
+    are NaN.
+
+    Args:
+        data (pd.DataFrame): The long data.
+        axes (dict[str, list[str]]): The columns of each axis, by axis name, e.g.
+            `{"entity": ["country", "continent", "income_level"], "year": ["year"]}`.
+        value (str): The value column.
+        dropna (bool): Whether rows with a missing value are left out. Otherwise
+            they count as zero, as in a groupby sum.
+    """
+    codes, labels = zip(*(_codes(data, columns) for columns in axes.values()))
+    shape = tuple(len(label) for label in labels)
+
+    cell = np.ravel_multi_index(codes, shape) if len(data) else np.array([], int)
+    size = int(np.prod(shape))
+
+    observed = data[value].notna().to_numpy() if dropna else np.ones(len(data))
+    weights = data[value].fillna(0).to_numpy(dtype="float64")
+    total = np.bincount(cell, weights=weights, minlength=size)
+    present = np.bincount(cell, weights=observed, minlength=size) > 0
+
+    values = np.where(present, total, np.nan).reshape(shape)
+
+    return Panel(values, dict(zip(axes, labels)))
@@ -1,10 +1,11 @@
 import pandas as pd
-from bblocks import add_iso_codes_column
 
 from scripts.analysis.common import update_key_number, exclude_outlier_countries
 from scripts.analysis.net_flows import prep_flows, rename_indicators
+from scripts.analysis.panel import to_panel
 from scripts.analysis.population_tools import population_for_countries
 from scripts.config import Paths
+from scripts.data.dimensions import add_iso_codes
 from scripts.data.inflows import get_debt_inflows
 
 KEY_NUMBERS = Paths.output / "key_numbers.json"
@@ -75,7 +76,7 @@ def negative_net_flows_counts_totals(year: int, as_billion: bool = True) -> dict
     negative_net_countries = (
         data.loc[lambda d: d.value < 0]
         .copy()
-        .pipe(add_iso_codes_column, id_column="country", id_type="regex")["iso_code"]
+        .pipe(add_iso_codes, id_column="country")["iso_code"]
         .unique()
     )
 
@@ -120,22 +121,21 @@ def change_between_years(
 ) -> dict:
     """Get the change between two years"""
 
-    # keep only latest and previous
-    df = df.loc[lambda d: d.year.isin([latest_year, previous_year])]
+    panel = to_panel(df, {"country": ["country"], "year": ["year"]})
 
     # Calculate change
-    change = df.pivot(index="country", columns="year", values="value")
-    change["change"] = round(change[latest_year] - change[previous_year], 3)
+    change = (
+        panel.change(latest_year - previous_year).take("year", latest_year).values
+    ).round(3)
 
     # As percentage
-    change["change_percentage"] = round(
-        change["change"] / change[previous_year] * 100, 1
-    )
+    previous = panel.take("year", previous_year).values
+    change_percentage = (change / previous * 100).round(1)
 
     # return as a single dictionary (indicator: value)
     return {
-        "change": change["change"].item(),
-        "change_percentage": change["change_percentage"].item(),
+        "change": change.item(),
+        "change_percentage": change_percentage.item(),
     }
 
 
@@ -144,7 +144,7 @@ def income_grouping_country_list(income_level: str) -> list[str]:
     data = (
         pd.read_parquet(Paths.output / "full_flows_country.parquet")
         .query(f"income_level == '{income_level}'")
-        .pipe(add_iso_codes_column, id_column="country", id_type="regex")["iso_code"]
+        .pipe(add_iso_codes, id_column="country")["iso_code"]
         .unique()
     )
 
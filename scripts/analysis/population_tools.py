@@ -1,26 +1,34 @@
+import functools
+import hashlib
 import json
-import time
+import os
+import uuid
+from pathlib import Path
 
 import pandas as pd
-import requests
-from bblocks import add_iso_codes_column, add_income_level_column
-from bs4 import BeautifulSoup
-
-from scripts import config
-
-from oda_data.get_data.common import get_url_selenium
 
 from scripts.config import logger, Paths
+from scripts.data.dimensions import add_income_levels, add_iso_codes
+from scripts.data.sources import ensure_source, source_mode
+from scripts.data.un_population import download_queries, download_to_parquet
 
 INDICATORS = {49: "Total Population"}
 UN_POPULATION_URL: str = "https://population.un.org/dataportalapi/api/v1/"
 UN_POPULATION_YEARS: dict = {"start_year": 2023, "end_year": 2023}
 
+# Age bands of the population cube, as (first age, last age). Bands without a last
+# age cover all ages. The single year of age data is downloaded for ages 0 to 18
+# (see `un_population_url`), so bands with a last age must be within those ages.
+AGE_BANDS: dict[str, tuple[int, int | None]] = {
+    "under_18": (0, 17),
+    "total": (0, None),
+}
 
-def _get_un_locations() -> pd.DataFrame:
+
+def _get_un_locations(base_url: str = UN_POPULATION_URL) -> pd.DataFrame:
     """Download all UN locations using API"""
 
-    locations_url = UN_POPULATION_URL + "locations/"
+    locations_url = base_url + "locations/"
 
     logger.info(f"Downloading UN locations from {locations_url}")
 
@@ -28,7 +36,11 @@ def _get_un_locations() -> pd.DataFrame:
 
 
 def un_population_url(
-    indicator: int, start_year: int, end_year: int, locations: int | list[int]
+    indicator: int,
+    start_year: int,
+    end_year: int,
+    locations: int | list[int],
+    base_url: str = UN_POPULATION_URL,
 ) -> str:
     """Create a URL to download UN population data from the API"""
 
@@ -38,48 +50,17 @@ def un_population_url(
     logger.debug(f"Downloading UN population data using API")
 
     return (
-        f"{UN_POPULATION_URL}data/indicators/{indicator}/"
+        f"{base_url}data/indicators/{indicator}/"
         f"locations/{locations}?startYear={start_year}&endYear={end_year}"
         f"&startAge=0&endAge=18&sexes=3&variants=4&pageSize=100"
     )
 
 
-def get_un_url(url: str) -> json:
-    logger.debug(f"Downloading UN population data from {url}")
-
-    page_source = get_url_selenium(url).page_source
-    soup = BeautifulSoup(page_source, "html.parser")
-    pre_tag = soup.find("pre")  # Assuming the JSON is within a <pre> tag
-
-    if pre_tag:
-        json_string = pre_tag.text
-        return json.loads(json_string)
-    else:
-        print("population data not found")
-
-
 def download_un_population_data(url: str) -> pd.DataFrame:
-    response = get_un_url(url)
-
-    df = pd.json_normalize(response["data"])
-
-    while response["nextPage"] is not None:
-        new_url = response["nextPage"]
-        try:
-            response = get_un_url(new_url)
-        except:
-            logger.error(f"Error downloading data from {new_url}")
-            time.sleep(10)
-            try:
-                response = get_un_url(new_url)
-            except:
-                logger.error(f"2 Error downloading data from {new_url}")
-                time.sleep(10)
-                response = get_un_url(new_url)
-
-        df = pd.concat([df, pd.json_normalize(response["data"])])
+    """Download all the pages of a UN population API query"""
+    logger.debug(f"Downloading UN population data from {url}")
 
-    return df
+    return download_queries([url])
 
 
 def split_list(input_list, n):
@@ -90,46 +71,84 @@ def split_list(input_list, n):
     )
 
 
-def get_data_for_ids(ids, indicator: int):
+def get_data_for_ids(ids, indicator: int, base_url: str = UN_POPULATION_URL):
     """Retrieve data for a list of IDs and return as a DataFrame"""
     url = un_population_url(
         indicator=indicator,
         start_year=UN_POPULATION_YEARS["start_year"],
         end_year=UN_POPULATION_YEARS["end_year"],
         locations=ids,
+        base_url=base_url,
     )
     return download_un_population_data(url)
 
 
-def download_all_population(indicator: int = 49) -> None:
-    """Update the raw UN population data"""
+def download_all_population(
+    indicator: int = 49, base_url: str = UN_POPULATION_URL
+) -> None:
+    """Update the raw UN population data.
 
-    locations = _get_un_locations()
+    The locations are split into three parts, which are downloaded concurrently
+    (with their pages). If the 'un_population' source is mirrored, the files are
+    copied from the mirror instead.
+
+    Args:
+        indicator (int): The UN population indicator.
+        base_url (str): The base URL of the API (e.g. a local server for testing).
+    """
+
+    if source_mode("un_population") == "mirror":
+        ensure_source("un_population")
+        return
+
+    locations = _get_un_locations(base_url=base_url)
     ids = locations["id"].to_list()
 
     # Split the IDs into three parts
     split_ids = list(split_list(ids, 3))
 
-    # Create DataFrames for each part and collect them in a list
-    dfs = [get_data_for_ids(part, indicator=indicator) for part in split_ids]
-
-    df = pd.concat(dfs, ignore_index=True)
+    urls = [
+        un_population_url(
+            indicator=indicator,
+            start_year=UN_POPULATION_YEARS["start_year"],
+            end_year=UN_POPULATION_YEARS["end_year"],
+            locations=part,
+            base_url=base_url,
+        )
+        for part in split_ids
+    ]
 
-    file_path = Paths.raw_data / f"un_population_raw_{indicator}.csv"
+    file_path = Paths.raw_data / f"un_population_raw_{indicator}.parquet"
 
-    df.to_csv(file_path, index=False)
+    download_to_parquet(urls, file_path)
 
     logger.info(f"Downloaded UN population data to {file_path}")
 
 
-def raw_un_population_data(indicator: int = 47) -> pd.DataFrame:
-    """Read the raw UN population data"""
+def raw_un_population_data(
+    indicator: int = 47, columns: list[str] | None = None
+) -> pd.DataFrame:
+    """Read the raw UN population data.
+
+    Data downloaded with `download_all_population` is stored as Parquet. Older
+    downloads stored as CSV are read if there is no Parquet file.
+
+    Args:
+        indicator (int): The UN population indicator.
+        columns (list[str], optional): The columns to read. Defaults to all.
+    """
+
+    ensure_source("un_population")
+    file_path = Paths.raw_data / f"un_population_raw_{indicator}.parquet"
 
-    file_path = Paths.raw_data / f"un_population_raw_{indicator}.csv"
+    if not file_path.exists():
+        file_path = file_path.with_suffix(".csv")
+        logger.debug(f"Read UN population data from {file_path}")
+        return pd.read_csv(file_path, usecols=columns)
 
     logger.debug(f"Read UN population data from {file_path}")
 
-    return pd.read_csv(file_path)
+    return pd.read_parquet(file_path, columns=columns)
 
 
 def filter_total_population(data: pd.DataFrame) -> pd.DataFrame:
@@ -169,82 +188,213 @@ def clean_population_data(data: pd.DataFrame) -> pd.DataFrame:
 
 def un_population_data() -> pd.DataFrame:
     """Clean dataset containing the median estimates for all available countries"""
-    return raw_un_population_data().pipe(clean_population_data)
+    columns = ["location", "iso3", "indicatorId", "timeLabel", "sex", "value"]
 
+    return raw_un_population_data(columns=columns + ["variantLabel"]).pipe(
+        clean_population_data
+    )
 
-def add_population_under18(data: pd.DataFrame, country_col: str = None) -> pd.DataFrame:
+
+def _cube_file() -> Path:
+    """The file of the population cube, keyed by the state of the raw files it is
+    built from and the age bands"""
+    ensure_source("un_population")
+    sources = [
+        (file.name, file.stat().st_size, file.stat().st_mtime_ns)
+        for indicator in [47, 49]
+        for file in Paths.raw_data.glob(f"un_population_raw_{indicator}.*")
+    ]
+    key = json.dumps([sorted(sources), AGE_BANDS], default=str).encode()
+
+    return (
+        Paths.cache / f"population_cube_{hashlib.sha256(key).hexdigest()[:16]}.parquet"
+    )
+
+
+def build_population_cube() -> pd.DataFrame:
+    """Build the population cube: population by ISO3 code, year, age band and sex.
+
+    Age bands with an end age are summed from the single year of age data
+    (indicator 47), if it covers all the ages in the band. Bands without an end age
+    (all ages) come from the total population data (indicator 49).
+    """
+    keys = ["iso3", "timeLabel", "sex"]
+
+    single_ages = raw_un_population_data(
+        indicator=47, columns=keys + ["variant", "ageStart", "value"]
+    ).loc[lambda d: (d.variant == "Median") & d.iso3.notna()]
+    ages = set(single_ages["ageStart"].astype("int32"))
+
+    bands = []
+    for band, (start, end) in AGE_BANDS.items():
+        if end is None:
+            rows = raw_un_population_data(
+                indicator=49, columns=keys + ["variant", "value"]
+            ).loc[lambda d: (d.variant == "Median") & d.iso3.notna()]
+        elif set(range(start, end + 1)) <= ages:
+            rows = single_ages.loc[lambda d: d.ageStart.between(start, end)]
+        else:
+            logger.warning(f"The UN population data does not cover the ages of {band}")
+            continue
+
+        bands.append(
+            rows.groupby(keys, observed=True)["value"]
+            .sum()
+            .reset_index()
+            .assign(age_band=band)
+        )
+
+    return (
+        pd.concat(bands, ignore_index=True)
+        .rename(
+            columns={"iso3": "iso_code", "timeLabel": "year", "value": "population"}
+        )
+        .astype(
+            {
+                "iso_code": "category",
+                "year": "int16",
+                "age_band": pd.CategoricalDtype(list(AGE_BANDS)),
+                "sex": "category",
+                "population": "float64",
+            }
+        )
+        .filter(["iso_code", "year", "age_band", "sex", "population"])
+        .sort_values(["iso_code", "year", "age_band", "sex"], ignore_index=True)
+    )
+
+
+@functools.cache
+def population_cube() -> pd.DataFrame:
+    """The population cube (see `build_population_cube`).
+
+    It is built once from the raw UN files and stored in `Paths.cache`, so later
+    runs read a small columnar table instead of the raw files.
+    """
+    file = _cube_file()
+
+    try:
+        return pd.read_parquet(file)
+    except FileNotFoundError:
+        pass
+
+    cube = build_population_cube()
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    cube.to_parquet(tmp)
+    os.replace(tmp, file)
+
+    return cube
+
+
+def add_population(
+    data: pd.DataFrame,
+    bands: str | list[str] = "total",
+    sex: str = "Both sexes",
+    year: int | None = None,
+    iso_column: str = "iso_code",
+) -> pd.DataFrame:
+    """Add the population of one or more age bands to a DataFrame, in one merge.
+
+    Args:
+        data (pd.DataFrame): The data, with a column of ISO3 codes.
+        bands (str | list[str]): The age bands (keys of `AGE_BANDS`). Each band
+            is added as a `population_<band>` column.
+        sex (str): 'Both sexes', 'Male' or 'Female'.
+        year (int, optional): The year of the population. Defaults to the latest
+            year in the cube.
+        iso_column (str): The column with the ISO3 codes.
+
+    Raises:
+        ValueError: If a band is not in the population cube (it is not one of
+            `AGE_BANDS`, or the data does not cover its ages).
+    """
+    if isinstance(bands, str):
+        bands = [bands]
+
+    cube = population_cube()
+    year = year or cube["year"].max()
+
+    missing = set(bands) - set(cube["age_band"].unique())
+    if missing:
+        raise ValueError(f"The population cube has no data for {sorted(missing)}")
 
     population = (
-        raw_un_population_data()
-        .astype({"ageStart": "int32[pyarrow]"})
-        .loc[lambda d: d.ageStart < 18]
-        .groupby(["iso3"], dropna=False, observed=True)["value"]
-        .sum()
-        .reset_index()
-        .rename(columns={"iso3": "iso_code", "value": "population"})
+        cube.loc[lambda d: (d.sex == sex) & (d.year == year) & d.age_band.isin(bands)]
+        .pivot(index="iso_code", columns="age_band", values="population")
+        .reindex(columns=bands)
+        .rename(columns=lambda band: f"population_{band}")
     )
+    population.columns.name = None
+    population.index = population.index.astype("object")
 
-    if country_col is not None:
-        data = data.pipe(add_iso_codes_column, id_column=country_col, id_type="regex")
+    return data.merge(population, left_on=iso_column, right_index=True, how="left")
+
+
+def add_population_under18(data: pd.DataFrame, country_col: str = None) -> pd.DataFrame:
 
-    data = data.merge(population, on=["iso_code"], how="left")
+    if country_col is not None:
+        data = data.pipe(add_iso_codes, id_column=country_col)
 
-    return data
+    return data.pipe(add_population, bands="under_18").rename(
+        columns={"population_under_18": "population"}
+    )
 
 
 def get_population() -> pd.DataFrame:
     # get population
     return (
-        raw_un_population_data(indicator=49)
+        raw_un_population_data(
+            indicator=49, columns=["iso3", "sex", "variant", "value"]
+        )
         .query("sex == 'Both sexes' and variant=='Median'")
         .filter(["iso3", "value"])
-        .pipe(add_income_level_column, id_column="iso3", id_type="ISO3")
+        .pipe(add_income_levels, iso_column="iso3")
     )
 
 
-def population_for_income(income_level: str | list[str]) -> pd.DataFrame:
-    if isinstance(income_level, str):
-        income_level = [income_level]
+@functools.cache
+def population_index() -> tuple[pd.Series, pd.Series, float]:
+    """Load the total population once and index it for lookups.
 
+    Returns:
+        tuple: The population by ISO3 code, the population by income level, and
+        the total population (of all the locations in the data).
+    """
     population = get_population()
 
-    return population.loc[lambda d: d.income_level.isin(income_level)].value.sum()
+    by_country = population.groupby("iso3", observed=True)["value"].sum()
+    by_income = population.groupby("income_level", observed=True)["value"].sum()
 
+    return by_country, by_income, population["value"].sum()
 
-def population_for_countries(countries: list[str]) -> pd.DataFrame:
-    population = get_population()
-
-    return population.loc[lambda d: d.iso3.isin(countries)].value.sum()
 
+def _total_for(index: pd.Series, keys: str | list[str]) -> float:
+    """Sum an indexed population series for a set of keys (ignoring missing keys)"""
+    if isinstance(keys, str):
+        keys = [keys]
 
-def population_as_share_for_countries(countries: list[str]) -> float:
-    # Get population
-    population = get_population()
+    return index.reindex(pd.unique(pd.Series(keys, dtype="object"))).sum()
 
-    # Total population
-    total_population = population["value"].sum()
 
-    # income level population
-    country_population = population_for_countries(countries)
+def population_for_income(income_level: str | list[str]) -> float:
+    return _total_for(population_index()[1], income_level)
 
-    return round(country_population / total_population * 100, 1)
 
+def population_for_countries(countries: list[str]) -> float:
+    return _total_for(population_index()[0], countries)
 
-def population_as_share(income_level: str | list[str]) -> float:
 
-    if isinstance(income_level, str):
-        income_level = [income_level]
+def population_as_share_for_countries(countries: list[str]) -> float:
+    total_population = population_index()[2]
 
-    # Get population
-    population = get_population()
+    return round(population_for_countries(countries) / total_population * 100, 1)
 
-    # Total population
-    total_population = population["value"].sum()
 
-    # income level population
-    income_level_population = population_for_income(income_level)
+def population_as_share(income_level: str | list[str]) -> float:
+    total_population = population_index()[2]
 
-    return round(income_level_population / total_population * 100, 1)
+    return round(population_for_income(income_level) / total_population * 100, 1)
 
 
 if __name__ == "__main__":
@@ -9,12 +9,43 @@ class Paths:
     raw_data = project / "raw_data"
     output = project / "output"
     scripts = project / "scripts"
+    cache = project / "cache"
+    dimensions = cache / "dimensions"
 
 
 CONSTANT_BASE_YEAR: int = 2022
 PRICES_SOURCE: str = "imf"
 ANALYSIS_YEARS: tuple = (2000, 2022)
 
+# The country groups whose totals are computed (see scripts/analysis/common.py)
+GROUPS_FILE: Path = Paths.raw_data / "country_groups.json"
+
+# Cache the output of the data stage loaders on disk (see scripts/data/cache.py)
+USE_CACHE: bool = True
+CACHE_MAX_SIZE_MB: int = 1024
+
+# Number of threads used to fetch independent data sources (see scripts/data/fetch.py)
+FETCH_WORKERS: int = 3
+
+# Concurrent requests to the UN population API (see scripts/data/un_population.py)
+DOWNLOAD_WORKERS: int = 4
+
+# Number of processes used to run independent stages (see scripts/pipeline.py) and
+# projection scenarios (see scripts/analysis/net_flow_projections.py)
+PIPELINE_WORKERS: int = 4
+
+# Where each data source comes from: "live" (downloaded), "mirror" (copied from
+# MIRROR_PATH/<source>), "cache" (UN API responses recorded and revalidated) or
+# "replay" (recorded UN API responses only). See scripts/data/sources.py
+SOURCE_MODES: dict = {
+    "ids": "live",
+    "oecd_dac": "live",
+    "prices": "live",
+    "weo": "live",
+    "un_population": "live",
+}
+MIRROR_PATH: Path = Paths.project / "mirror"
+
 # Create a root logger
 logger = logging.getLogger(__name__)
 
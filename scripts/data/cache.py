@@ -0,0 +1,306 @@
+"""Disk cache for the DataFrames produced by the data stage.
+
+The loaders in `inflows.py` and `outflows.py` download, clean and deflate the same
+data every time they are called. Decorating them with `disk_cache` stores their
+output as Parquet in `Paths.cache`, keyed by a fingerprint of the arguments, the
+relevant settings in `config`, the code of the data layer and either the raw sources
+they depend on (as hashed in the manifest, see `manifest.py`) or, if they don't
+declare them, the state of the files in `raw_data`.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import config
+from scripts.config import logger
+
+# Seconds after which a lock file is considered abandoned by a crashed process
+LOCK_TIMEOUT: int = 600
+
+# The code the cached data is built with (relative to Paths.scripts): the cleaning
+# functions, name overrides and price conversions. Like `DATA_CODE` in pipeline.py.
+CODE: tuple = ("config.py", "data/*.py")
+
+
+def raw_data_signature(path: Path | None = None) -> list[tuple[str, int, int]]:
+    """Return the relative path, size and modification time of every raw data file.
+
+    Hidden files and folders are ignored.
+
+    Args:
+        path (Path, optional): The folder to scan. Defaults to `Paths.raw_data`.
+    """
+    path = Path(path or config.Paths.raw_data)
+
+    signature = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for file in sorted(files):
+            if file.startswith("."):
+                continue
+            stat = os.stat(os.path.join(root, file))
+            relative = os.path.relpath(os.path.join(root, file), path)
+            signature.append((relative, stat.st_size, stat.st_mtime_ns))
+
+    return signature
+
+
+@functools.cache
+def code_hash() -> str:
+    """A hash of the contents of the data layer code (`CODE`). It is computed once
+    per process, since the code which runs does not change after it is imported."""
+    files = sorted(
+        {path for pattern in CODE for path in config.Paths.scripts.glob(pattern)}
+    )
+
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(str(file.relative_to(config.Paths.scripts)).encode())
+        digest.update(hashlib.sha256(file.read_bytes()).digest())
+
+    return digest.hexdigest()
+
+
+def fingerprint(name: str, arguments: dict, sources: list[str] | None = None) -> str:
+    """Create a fingerprint for a call to a cached loader.
+
+    The fingerprint covers the loader name and its arguments, the analysis years,
+    constant prices settings, the data layer code (so edits to the cleaning code
+    rebuild the data) and the raw data: the hashes of the given sources or, if
+    there are none, the state of the raw data folder.
+
+    Args:
+        name (str): The qualified name of the loader.
+        arguments (dict): The arguments the loader was called with.
+        sources (list[str], optional): The raw sources (as named in the manifest)
+            the loader depends on.
+    """
+    if sources is None:
+        raw_data = raw_data_signature()
+    else:
+        from scripts.data.manifest import source_hashes
+
+        raw_data = source_hashes(sources)
+
+    payload = {
+        "name": name,
+        "arguments": arguments,
+        "analysis_years": list(config.ANALYSIS_YEARS),
+        "constant_base_year": config.CONSTANT_BASE_YEAR,
+        "prices_source": config.PRICES_SOURCE,
+        "code": code_hash(),
+        "raw_data": raw_data,
+    }
+
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _cache_file(key: str) -> Path:
+    return config.Paths.cache / f"{key}.parquet"
+
+
+@contextmanager
+def cache_lock(timeout: float = LOCK_TIMEOUT):
+    """Acquire an exclusive, cross-process lock on the cache folder.
+
+    The lock is a file created atomically. Locks older than `LOCK_TIMEOUT` are
+    assumed to belong to a process which died and are removed.
+    """
+    config.Paths.cache.mkdir(parents=True, exist_ok=True)
+    lock = config.Paths.cache / ".lock"
+    start = time.monotonic()
+
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > LOCK_TIMEOUT:
+                    logger.debug("Removing stale cache lock")
+                    os.remove(lock)
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f"Could not acquire the cache lock at {lock}")
+            time.sleep(0.1)
+
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            pass
+
+
+def read_cached(key: str) -> pd.DataFrame | None:
+    """Read a cached DataFrame. Returns None if there is no entry for the key."""
+    file = _cache_file(key)
+
+    try:
+        data = pd.read_parquet(file)
+    except (FileNotFoundError, OSError):
+        return None
+
+    # Mark as recently used, for eviction
+    try:
+        os.utime(file)
+    except OSError:
+        pass
+
+    return data
+
+
+def evict(max_size_mb: float | None = None) -> None:
+    """Remove the least recently used entries until the cache fits its size limit.
+
+    Must be called while holding `cache_lock`.
+    """
+    if max_size_mb is None:
+        max_size_mb = config.CACHE_MAX_SIZE_MB
+
+    max_bytes = max_size_mb * 1024**2
+
+    entries = []
+    for file in config.Paths.cache.glob("*.parquet"):
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file))
+
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, file in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        try:
+            file.unlink()
+            total -= size
+            logger.debug(f"Evicted {file.name} from the cache")
+        except OSError:
+            continue
+
+
+def write_cached(key: str, data: pd.DataFrame) -> None:
+    """Store a DataFrame in the cache and enforce the size limit.
+
+    The data is written to a temporary file first and then moved in place, so
+    other processes never read a partially written file.
+    """
+    config.Paths.cache.mkdir(parents=True, exist_ok=True)
+    tmp = config.Paths.cache / f".{key}.{uuid.uuid4().hex}.tmp"
+
+    try:
+        data.to_parquet(tmp)
+        with cache_lock():
+            os.replace(tmp, _cache_file(key))
+            evict()
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def clear_cache() -> None:
+    """Remove all the entries in the cache"""
+    with cache_lock():
+        for file in config.Paths.cache.glob("*.parquet"):
+            file.unlink(missing_ok=True)
+
+
+def disk_cache(func=None, *, sources: Callable[[], list[str]] | None = None):
+    """Decorator to cache the DataFrame returned by a data loader on disk.
+
+    Caching can be switched off with `config.USE_CACHE`.
+
+    Args:
+        sources (Callable, optional): A function returning the raw sources the
+            loader depends on. Without it, the cache depends on all of raw_data.
+    """
+    if func is None:
+        return functools.partial(disk_cache, sources=sources)
+
+    name = f"{func.__module__}.{func.__qualname__}"
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not config.USE_CACHE:
+            return func(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+
+        def key() -> str:
+            return fingerprint(name, arguments, sources() if sources else None)
+
+        cached = read_cached(key())
+        if cached is not None:
+            logger.debug(f"Loaded {func.__name__} from the cache")
+            return cached
+
+        data = func(*args, **kwargs)
+
+        # The loader may have downloaded new files to raw_data. Fingerprinting
+        # after the call means the next run finds this entry.
+        write_cached(key(), data)
+
+        return data
+
+    return wrapper
+
+
+def cached_parts(
+    name: str,
+    parts: dict[str, list[str]],
+    build: Callable[[list[str]], dict[str, pd.DataFrame]],
+) -> dict[str, pd.DataFrame]:
+    """Cache the parts of a data set separately, by the sources each one uses.
+
+    Only the parts which are not in the cache (because one of their sources, or
+    the data layer code, changed) are built, with a single call to `build`.
+
+    Args:
+        name (str): The name of the data set.
+        parts (dict): The names of the parts and the sources each one depends on.
+        build (Callable): A function which builds a list of parts and returns them
+            as a dictionary of part name to DataFrame.
+
+    Returns:
+        dict: The parts, in the same order as `parts`.
+    """
+    if not config.USE_CACHE:
+        return build(list(parts))
+
+    def key(part: str) -> str:
+        return fingerprint(f"{name}.{part}", {}, parts[part])
+
+    found = {part: read_cached(key(part)) for part in parts}
+    missing = [part for part, data in found.items() if data is None]
+
+    if missing:
+        logger.debug(f"Building {name} parts: {missing}")
+        built = build(missing)
+        for part in missing:
+            write_cached(key(part), built[part])
+            found[part] = built[part]
+
+    return found
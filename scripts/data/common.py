@@ -1,12 +1,56 @@
+import functools
 import logging
+import re
 
+import numpy as np
 import pandas as pd
-from bblocks import convert_id, DebtIDS
 
 from scripts import config
 
 logging.getLogger("country_converter").setLevel(logging.ERROR)
 
+# As in country_converter, anything after these words is ignored when matching
+# (e.g. 'China excluding Hong Kong' is matched as 'China')
+EXCLUDE_PREFIX = re.compile(r"excl\w.*|without|w/o")
+
+# Dimension columns which are stored as categoricals (dictionary encoded in Parquet)
+CATEGORICAL_COLUMNS: list[str] = [
+    "country",
+    "counterpart_area",
+    "continent",
+    "income_level",
+    "indicator",
+    "indicator_type",
+    "counterpart_type",
+    "prices",
+]
+
+# Official counterparts which are not in the oda_data donor groupings
+OTHER_OFFICIAL_COUNTERPARTS: dict[int, str] = {
+    1038: "UN Institute for Disarmament Research",
+    962: "UN Conference on Trade and Development",
+    1039: "UN Capital Development Fund",
+    1045: "North American Development Bank",
+    1401: "International Trade Centre",
+    1406: "UN Industrial Development Organization",
+    910: "Central American Bank for Economic Integration",
+    1046: "UN Women",
+    1047: "UN COVID-19 Response and Recovery Multi-Partner Trust Fund",
+    1048: "Joint Sustainable Development Goals Fund",
+    1049: "International Commission on Missing Persons",
+    1050: "WHO Strategic Preparedness and Response Plan",
+    1054: "World Organisation for Animal Health",
+    915: "Asian Forest Cooperation Organisation",
+    1055: "CGIAR",
+}
+
+
+MATCH_COLUMNS: dict[str, str] = {
+    "ISO3": "iso_code",
+    "name_short": "name_short",
+    "continent": "continent",
+}
+
 
 def multilateral_mapping() -> dict:
     """
@@ -234,33 +278,187 @@ def multilateral_mapping() -> dict:
     }
 
 
-def clean_debtors(df: pd.DataFrame, column) -> pd.DataFrame:
+def to_categorical(df: pd.DataFrame) -> pd.DataFrame:
+    """Store the dimension columns in `CATEGORICAL_COLUMNS` as categoricals.
+
+    Columns which are already categorical are left as they are. This needs to be
+    applied again after concatenating or assigning new values, since pandas
+    falls back to object columns when the categories don't match.
     """
-    Clean debtors names by converting to ISO3 and continent, and by
-    creating a new column with the short name (from bblocks)
+    columns = {
+        c: "category"
+        for c in CATEGORICAL_COLUMNS
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype)
+    }
+
+    return df.astype(columns) if columns else df
+
+
+def category_contains(series: pd.Series, pattern: str) -> np.ndarray:
+    """Check which values contain a pattern. For categorical series, the pattern is
+    only searched in the categories."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype("category")
+
+    categories = series.cat.categories
+    matches = categories[categories.astype(str).str.contains(pattern)]
+
+    return series.isin(matches).to_numpy()
+
+
+def map_values(series: pd.Series, mapping: dict) -> pd.Series:
+    """Replace values through a mapping, keeping the values which aren't in it.
+
+    For categorical series only the categories are mapped. The result is still
+    categorical, with sorted categories.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.map(mapping).fillna(series)
+
+    mapped = [mapping.get(c, c) for c in series.cat.categories]
+    new_codes, new_categories = pd.factorize(pd.Index(mapped), sort=True)
+
+    # Missing values have code -1, which picks the -1 added at the end
+    codes = np.append(new_codes, -1)[series.cat.codes.to_numpy()]
+
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=new_categories),
+        index=series.index,
+        name=series.name,
+    )
+
+
+def fill_missing(series: pd.Series, value) -> pd.Series:
+    """Fill missing values. Categorical series get the value as a new category."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if value not in series.cat.categories:
+            series = series.cat.add_categories([value])
+
+    return series.fillna(value)
+
+
+@functools.cache
+def country_patterns() -> tuple[re.Pattern, list[re.Pattern], pd.DataFrame]:
+    """Compile the country_converter regular expressions.
+
+    The expressions are compiled one by one, in the order of the country table,
+    and into a single pattern where each expression is a named group (`c0`, `c1`,
+    ...), so the group which matched gives the position of the country in the
+    returned table. The table has the ISO3 code, short name and continent of each
+    country, plus an empty last row for names which are not matched.
     """
-    df[column] = df[column].astype("string[pyarrow]")
-
-    df["iso_code"] = convert_id(
-        df[column],
-        from_type="regex",
-        to_type="ISO3",
-        not_found=pd.NA,
-        additional_mapping={"Macau (China)": "MAC"},
+    import country_converter as coco
+
+    data = coco.CountryConverter().data
+
+    pattern = re.compile(
+        "|".join(f"(?P<c{i}>{regex})" for i, regex in enumerate(data["regex"])),
+        re.IGNORECASE,
     )
-    df["continent"] = convert_id(
-        df[column],
-        from_type="regex",
-        to_type="continent",
-        additional_mapping={"Macau (China)": "Asia"},
+    regexes = [re.compile(regex, re.IGNORECASE) for regex in data["regex"]]
+
+    table = (
+        data.filter(MATCH_COLUMNS)
+        .rename(columns=MATCH_COLUMNS)
+        .assign(
+            iso_code=lambda d: d.iso_code.str.split("|")
+            .str[0]
+            .str.replace(r"[\W_]", "", regex=True)
+            .str.upper()
+        )
+        .reset_index(drop=True)
     )
-    df[f"{column}"] = convert_id(
-        df[column],
-        from_type="regex",
-        to_type="name_short",
-        additional_mapping={"Macau (China)": "Macau"},
+
+    return pattern, regexes, table.reindex(range(len(table) + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def _match_position(name: str) -> int:
+    """Position of a name in the country table, or -1 if no expression matches.
+
+    Like country_converter, the first expression in table order which matches
+    wins. The single pattern finds a matching expression (the one matching
+    earliest in the name), so only the expressions before it are tried one by one.
+    """
+    pattern, regexes, _ = country_patterns()
+
+    name = EXCLUDE_PREFIX.split(name)[0]
+    match = pattern.search(name)
+    if not match:
+        return -1
+
+    position = int(match.lastgroup[1:])
+
+    return next(
+        (i for i, regex in enumerate(regexes[:position]) if regex.search(name)),
+        position,
     )
 
+
+def match_names(
+    names: pd.Series | np.ndarray | list,
+    mappings: dict[str, dict] | None = None,
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """Resolve an array of names to ISO3 codes, short names and continents.
+
+    Names are matched with the country_converter regular expressions, compiled
+    into a single pattern. Each distinct name is matched once (and remembered for
+    later calls). Where two expressions match the same name, the first one in the
+    country_converter table is used.
+
+    Args:
+        names: The names to resolve.
+        mappings (dict, optional): Exact mappings by output column (e.g.
+            `{"iso_code": {"Macau (China)": "MAC"}}`). They take precedence over
+            the regular expressions. Names which are in the mappings of all the
+            requested columns are not matched at all.
+        columns (list[str], optional): The output columns. Defaults to iso_code,
+            name_short and continent.
+
+    Returns:
+        pd.DataFrame: One row per name, in the same order. Names which can't be
+        resolved are NaN.
+    """
+    mappings = mappings or {}
+    columns = columns or list(MATCH_COLUMNS.values())
+    _, _, table = country_patterns()
+
+    codes, uniques = pd.factorize(pd.Series(names, dtype="object"))
+
+    # Exact mappings first. Only names without a mapping for every column go
+    # through the regular expressions.
+    exact = {
+        column: pd.Series(uniques, dtype="object").map(mappings.get(column, {}))
+        for column in columns
+    }
+    needs_match = ~pd.concat(exact, axis=1).notna().all(axis=1).to_numpy()
+
+    positions = np.full(len(uniques) + 1, -1, dtype=np.intp)
+    positions[:-1][needs_match] = [_match_position(n) for n in uniques[needs_match]]
+
+    resolved = table.iloc[positions][columns].reset_index(drop=True)
+    for column in columns:
+        mapped = np.append(exact[column].to_numpy(dtype=object), np.nan)
+        resolved[column] = np.where(pd.notna(mapped), mapped, resolved[column])
+
+    # Missing names have code -1, which picks the empty row at the end
+    return resolved.iloc[codes].reset_index(drop=True)
+
+
+def clean_debtors(df: pd.DataFrame, column) -> pd.DataFrame:
+    """
+    Clean debtors names by converting to ISO3 and continent, and by
+    creating a new column with the short name (from bblocks)
+    """
+    from scripts.data.dimensions import resolve_names
+
+    names = resolve_names(df[column], role="country")
+
+    df["iso_code"] = names["iso_code"].astype("string[pyarrow]")
+    df["continent"] = names["continent"].astype("category")
+    df[f"{column}"] = names["name_short"].astype("category")
+
     return df.set_index(["iso_code", f"{column}", "continent"]).reset_index()
 
 
@@ -269,31 +467,12 @@ def clean_creditors(df: pd.DataFrame, column) -> pd.DataFrame:
     Clean creditors names by converting to ISO3 and by creating a new column
     with the short name (from bblocks)
     """
-    additional_iso = {
-        "Korea, D.P.R. of": "PRK",
-        "German Dem. Rep.": "DEU",
-        "Neth. Antilles": "ANT",
-        "Yugoslavia": "YUG",
-    }
-    additional_names = {
-        "Korea, D.P.R. of": "North Korea",
-        "German Dem. Rep.": "Germany",
-        "Neth. Antilles": "Netherlands Antilles",
-    }
-    df[column] = df[column].astype("string[pyarrow]")
+    from scripts.data.dimensions import resolve_names
 
-    df["counterpart_iso_code"] = convert_id(
-        df[column],
-        from_type="regex",
-        to_type="ISO3",
-        additional_mapping=multilateral_mapping() | additional_iso,
-    )
-    df[column] = convert_id(
-        df[column],
-        from_type="regex",
-        to_type="name_short",
-        additional_mapping=multilateral_mapping() | additional_names,
-    )
+    names = resolve_names(df[column], role="creditor")
+
+    df["counterpart_iso_code"] = names["iso_code"].astype("string[pyarrow]")
+    df[column] = names["name_short"].astype("category")
 
     return df
 
@@ -301,23 +480,19 @@ def clean_creditors(df: pd.DataFrame, column) -> pd.DataFrame:
 def add_oecd_names(df: pd.DataFrame) -> pd.DataFrame:
     """
     Add the OECD names for the donor and recipient. This is done by
-    merging on the donor and recipient codes from the DAC2a data set.
+    merging on the donor and recipient codes from the DAC dimension tables
+    (which are built from the DAC2a data set).
 
     Args:
         - df (pd.DataFrame): The data frame to add the names to.
     """
-    # import the required functions
-    from oda_data import set_data_path, read_dac2a
-
-    # set a path to the raw data
-    set_data_path(config.Paths.raw_data)
+    from scripts.data.dimensions import dac_donors, dac_recipients
 
-    # read the DAC2a data set
-    dac2a = read_dac2a(years=range(2010, 2023))
-
-    # Create two dataframes, one with donors and one with recipients
-    donors = dac2a.filter(["donor_code", "donor"]).drop_duplicates()
-    recipients = dac2a.filter(["recipient_code", "recipient"]).drop_duplicates()
+    # Read the code and name pairs for donors and recipients
+    donors = dac_donors(columns=["donor_code", "donor"]).dropna(subset=["donor"])
+    recipients = dac_recipients(columns=["recipient_code", "recipient"]).dropna(
+        subset=["recipient"]
+    )
 
     # Merge donors (by codes to get the names), and then merge recipients
     df = df.merge(donors, on=["donor_code"], how="left")
@@ -356,29 +531,25 @@ def remove_counterpart_totals(df: pd.DataFrame) -> pd.DataFrame:
     """
     Remove counterpart totals from the data.
     """
-    return df[
-        lambda d: ~d["counterpart_area"]
-        .astype("string[pyarrow]")
-        .str.contains(", Total")
-    ]
+    return df[~category_contains(df["counterpart_area"], ", Total")]
 
 
 def remove_recipient_totals(df: pd.DataFrame) -> pd.DataFrame:
     """
     Remove recipient totals from the data.
     """
-    return df[~df["country"].str.contains(", Total")]
+    return df[~category_contains(df["country"], ", Total")]
 
 
 def remove_groupings_and_totals_from_recipients(df: pd.DataFrame) -> pd.DataFrame:
     """
     Remove regional groupings and totals from the data.
     """
-    # import the required functions
-    from oda_data import recipient_groupings
+    from scripts.data.dimensions import dac_recipients
 
     # Select only the codes for the developing countries and regions
-    groupings = recipient_groupings()["all_developing_countries_regions"]
+    recipients = dac_recipients(columns=["recipient_code", "developing"])
+    groupings = recipients.loc[lambda d: d.developing, "recipient_code"]
 
     # Keep only the rows that are not in the groupings
     return df[df["recipient_code"].isin(groupings)]
@@ -394,33 +565,12 @@ def remove_non_official_counterparts(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The data frame with the non-official counterparts removed.
     """
-    # import the required functions
-    from oda_data import donor_groupings
-
-    # Select only the codes for the official counterparts
-    official = donor_groupings()["all_official"]
-
-    # Add other official counterparts
-    other_official = {
-        1038: "UN Institute for Disarmament Research",
-        962: "UN Conference on Trade and Development",
-        1039: "UN Capital Development Fund",
-        1045: "North American Development Bank",
-        1401: "International Trade Centre",
-        1406: "UN Industrial Development Organization",
-        910: "Central American Bank for Economic Integration",
-        1046: "UN Women",
-        1047: "UN COVID-19 Response and Recovery Multi-Partner Trust Fund",
-        1048: "Joint Sustainable Development Goals Fund",
-        1049: "International Commission on Missing Persons",
-        1050: "WHO Strategic Preparedness and Response Plan",
-        1054: "World Organisation for Animal Health",
-        915: "Asian Forest Cooperation Organisation",
-        1055: "CGIAR",
-    }
+    from scripts.data.dimensions import dac_donors
 
-    # Combine the official counterparts
-    official = official | other_official
+    # Select only the codes for the official counterparts (including the
+    # OTHER_OFFICIAL_COUNTERPARTS)
+    donors = dac_donors(columns=["donor_code", "official"])
+    official = donors.loc[lambda d: d.official, "donor_code"]
 
     # Keep only the rows that are in the official counterparts
     return df[df["donor_code"].isin(official)]
@@ -437,38 +587,28 @@ def filter_and_assign_indicator(df: pd.DataFrame, indicator: str) -> pd.DataFram
 
 
 def get_concessional_non_concessional(
-    start_year: int,
-    end_year: int,
+    ids: dict[str, pd.DataFrame],
     total_indicator: str,
     concessional_indicator: str,
     indicator_prefix: str,
 ) -> pd.DataFrame:
     """
-    Get the concessional and non-concessional data for a given range of years,
-    using the specified indicators and indicator prefix.
+    Get the concessional and non-concessional data using the specified
+    indicators and indicator prefix.
 
     Args:
-        - start_year (int): The start year of the data range.
-        - end_year (int): The end year of the data range.
+        - ids (dict[str, pd.DataFrame]): The IDS data, as returned by
+          `load_ids_indicators`. It must include both indicators.
         - total_indicator (str): The indicator for total data.
         - concessional_indicator (str): The indicator for concessional data.
         - indicator_prefix (str): The prefix to use for the indicator columns.
 
     """
-    # Load indicators
-    ids = DebtIDS().load_data(
-        indicators=[total_indicator, concessional_indicator],
-        start_year=start_year,
-        end_year=end_year,
-    )
-
     # Get total data and rename column
-    total = ids.get_data(total_indicator).rename(
-        columns={"value": f"{indicator_prefix}_total"}
-    )
+    total = ids[total_indicator].rename(columns={"value": f"{indicator_prefix}_total"})
 
     # Get concessional data and rename column
-    concessional = ids.get_data(concessional_indicator).rename(
+    concessional = ids[concessional_indicator].rename(
         columns={"value": f"{indicator_prefix}_concessional"}
     )
 
@@ -0,0 +1,388 @@
+"""Country, creditor and DAC dimension tables.
+
+Debtor and creditor names are resolved (to ISO3 codes, short names and continents)
+only once per distinct name. The results are stored in `Paths.cache/dimensions`, so
+later runs resolve names with a hash lookup instead of running regular expressions
+over every row. The stored table is keyed by a hash of what the resolution depends
+on (the overrides, the multilateral mapping and the country_converter version), so
+names are resolved again when any of them changes.
+
+The DAC donor and recipient codes, names and groupings used for the grants data are
+stored in the same folder, once per vintage of the OECD DAC data.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts import config
+from scripts.config import logger
+from scripts.data.common import (
+    OTHER_OFFICIAL_COUNTERPARTS,
+    match_names,
+    multilateral_mapping,
+)
+from scripts.data.fetch import set_data_paths
+from scripts.data.sources import ensure_source
+
+NAME_COLUMNS: list[str] = [
+    "name_id",
+    "role",
+    "name",
+    "iso_code",
+    "name_short",
+    "continent",
+]
+
+# Mappings for names which country_converter does not resolve as needed
+COUNTRY_OVERRIDES: dict = {
+    "iso_code": {"Macau (China)": "MAC"},
+    "continent": {"Macau (China)": "Asia"},
+    "name_short": {"Macau (China)": "Macau"},
+}
+
+CREDITOR_OVERRIDES: dict = {
+    "iso_code": {
+        "Korea, D.P.R. of": "PRK",
+        "German Dem. Rep.": "DEU",
+        "Neth. Antilles": "ANT",
+        "Yugoslavia": "YUG",
+    },
+    "name_short": {
+        "Korea, D.P.R. of": "North Korea",
+        "German Dem. Rep.": "Germany",
+        "Neth. Antilles": "Netherlands Antilles",
+    },
+}
+
+_lock = threading.Lock()
+_table: pd.DataFrame | None = None
+
+
+@functools.cache
+def resolution_hash() -> str:
+    """A hash of what name resolution depends on: the overrides, the multilateral
+    mapping and the version of country_converter (whose regular expressions are
+    used)."""
+    import country_converter
+
+    payload = {
+        "country_overrides": COUNTRY_OVERRIDES,
+        "creditor_overrides": CREDITOR_OVERRIDES,
+        "multilaterals": multilateral_mapping(),
+        "country_converter": country_converter.__version__,
+    }
+    encoded = json.dumps(payload, sort_keys=True).encode()
+
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def names_file() -> Path:
+    """The stored table of resolved names, for the current resolution inputs"""
+    return config.Paths.dimensions / f"names_{resolution_hash()}.parquet"
+
+
+@functools.cache
+def creditor_mappings() -> dict:
+    """Exact creditor name mappings: the multilateral institutions (which keep
+    their harmonised name as ISO3 code) plus the creditor overrides."""
+    multilaterals = multilateral_mapping()
+
+    return {
+        column: multilaterals | CREDITOR_OVERRIDES[column]
+        for column in ["iso_code", "name_short"]
+    }
+
+
+def _resolve_countries(names: pd.Series) -> pd.DataFrame:
+    """Resolve country (debtor) names to ISO3 codes, continents and short names.
+    Names which can't be resolved keep their name as short name and continent."""
+    resolved = match_names(names, mappings=COUNTRY_OVERRIDES)
+
+    return resolved.assign(
+        name=names.to_numpy(),
+        name_short=lambda d: d.name_short.fillna(d.name),
+        continent=lambda d: d.continent.fillna(d.name),
+    )
+
+
+def _resolve_creditors(names: pd.Series) -> pd.DataFrame:
+    """Resolve creditor names to ISO3 codes and short names. Names which can't be
+    resolved are passed through unchanged."""
+    resolved = match_names(
+        names, mappings=creditor_mappings(), columns=["iso_code", "name_short"]
+    )
+
+    return resolved.assign(
+        name=names.to_numpy(),
+        iso_code=lambda d: d.iso_code.fillna(d.name),
+        name_short=lambda d: d.name_short.fillna(d.name),
+        continent=pd.NA,
+    )
+
+
+RESOLVERS: dict = {"country": _resolve_countries, "creditor": _resolve_creditors}
+
+
+@functools.cache
+def income_levels() -> dict:
+    """World Bank income levels by ISO3 code (from bblocks)"""
+    from bblocks.other_tools.dictionaries import income_levels as bb_income_levels
+
+    return dict(bb_income_levels())
+
+
+def _map_unique(series: pd.Series, mapping: dict) -> pd.Series:
+    """Map a series through a dictionary, looking up each distinct value once"""
+    codes, uniques = pd.factorize(series)
+
+    # Missing values have code -1, which picks the NaN added at the end
+    mapped = np.append(pd.Series(uniques).map(mapping).to_numpy(dtype=object), np.nan)
+
+    return pd.Series(mapped[codes], index=series.index, dtype="object")
+
+
+def _read_name_table() -> pd.DataFrame:
+    try:
+        return pd.read_parquet(names_file())
+    except FileNotFoundError:
+        return pd.DataFrame({c: pd.Series(dtype="object") for c in NAME_COLUMNS})
+
+
+def _save_name_table(new: pd.DataFrame) -> pd.DataFrame:
+    """Add new names to the stored table and return the full table.
+
+    The stored table is read again before saving, so names added by another process
+    in the meantime are kept. Tables stored for other resolution inputs are removed.
+    """
+    from scripts.data.cache import cache_lock
+
+    file = names_file()
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    with cache_lock():
+        table = pd.concat([_read_name_table(), new], ignore_index=True)
+        table = table.drop_duplicates(subset=["role", "name"], keep="first")
+        table = table.reset_index(drop=True).assign(name_id=lambda d: d.index)
+
+        tmp = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        table[NAME_COLUMNS].astype({"name_id": "int32"}).to_parquet(tmp)
+        os.replace(tmp, file)
+
+        for old in file.parent.glob("names_*.parquet"):
+            if old != file:
+                old.unlink(missing_ok=True)
+
+    return table
+
+
+def name_table() -> pd.DataFrame:
+    """The stored dimension table of resolved debtor and creditor names"""
+    global _table
+
+    if _table is None:
+        _table = _read_name_table()
+
+    return _table
+
+
+def _lookup(uniques: pd.Index, role: str) -> pd.DataFrame:
+    """Return the rows of the name table for the given names, in the same order.
+    Names which are not in the table yet are resolved and stored."""
+    global _table
+
+    with _lock:
+        known = name_table().loc[lambda d: d.role == role]
+        positions = pd.Index(known["name"]).get_indexer(uniques)
+
+        if (positions == -1).any():
+            missing = pd.Series(uniques[positions == -1], dtype="object")
+            logger.debug(f"Resolving {len(missing)} new {role} names")
+
+            new = RESOLVERS[role](missing.reset_index(drop=True)).assign(role=role)
+            _table = _save_name_table(new)
+
+            known = _table.loc[lambda d: d.role == role]
+            positions = pd.Index(known["name"]).get_indexer(uniques)
+
+    return known.iloc[positions].reset_index(drop=True)
+
+
+def resolve_names(names: pd.Series, role: str) -> pd.DataFrame:
+    """Resolve a series of debtor or creditor names using the dimension table.
+
+    Each distinct name is looked up once. The rows are then joined back to the
+    series by integer position. Income levels are not stored in the table (they are
+    updated separately), so they are looked up from the ISO3 codes.
+
+    Args:
+        names (pd.Series): The names to resolve.
+        role (str): Either 'country' (for debtors and other countries) or
+            'creditor'.
+
+    Returns:
+        pd.DataFrame: A DataFrame aligned to `names` with the name_id, iso_code,
+        name_short, continent and income_level columns.
+    """
+    if role not in RESOLVERS:
+        raise ValueError(f"role must be one of {list(RESOLVERS)}")
+
+    codes, uniques = pd.factorize(names)
+
+    # Missing names have code -1, which picks the empty row added at the end
+    rows = (
+        pd.concat(
+            [_lookup(pd.Index(uniques, dtype="object"), role), pd.DataFrame(index=[0])],
+            ignore_index=True,
+        )
+        .iloc[codes]
+        .drop(columns=["role", "name"])
+        .set_axis(names.index)
+    )
+
+    rows["income_level"] = _map_unique(rows["iso_code"], income_levels()).to_numpy()
+
+    return rows
+
+
+def add_income_levels(
+    df: pd.DataFrame, iso_column: str, target_column: str = "income_level"
+) -> pd.DataFrame:
+    """Add a World Bank income level column, based on a column of ISO3 codes"""
+    df[target_column] = _map_unique(df[iso_column], income_levels())
+
+    return df
+
+
+def add_iso_codes(
+    df: pd.DataFrame, id_column: str, target_column: str = "iso_code"
+) -> pd.DataFrame:
+    """Add an ISO3 column based on a column of country names.
+
+    Names which can't be resolved are passed through unchanged.
+    """
+    iso_codes = resolve_names(df[id_column], role="country")["iso_code"]
+    df[target_column] = iso_codes.fillna(df[id_column])
+
+    return df
+
+
+def dac_vintage() -> str:
+    """The vintage of the OECD DAC data, as tracked in `raw_data/data_updates.json`"""
+    try:
+        with open(config.Paths.raw_data / "data_updates.json", "r") as f:
+            return json.load(f).get("OECD DAC", "unknown")
+    except FileNotFoundError:
+        return "unknown"
+
+
+def _dac_table_file(kind: str) -> Path:
+    return config.Paths.dimensions / f"dac_{kind}_{dac_vintage()}.parquet"
+
+
+def _with_flags(names: pd.DataFrame, code_column: str, flags: dict) -> pd.DataFrame:
+    """Add boolean flag columns to a table of code and name pairs.
+
+    Codes which are in a grouping but not in the names table are added (with a
+    missing name), so the flags don't depend on which codes DAC2a includes.
+    """
+    codes = set(names[code_column].dropna())
+    for grouping in flags.values():
+        codes |= set(grouping)
+
+    table = pd.DataFrame({code_column: sorted(codes)}).astype(
+        {code_column: names[code_column].dtype}
+    )
+    table = table.merge(names, on=code_column, how="left")
+
+    for flag, grouping in flags.items():
+        table[flag] = table[code_column].isin(list(grouping))
+
+    return table
+
+
+def _write_dac_table(kind: str, table: pd.DataFrame) -> None:
+    """Store a DAC table for the current vintage and remove older vintages"""
+    file = _dac_table_file(kind)
+
+    tmp = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    table.to_parquet(tmp)
+    os.replace(tmp, file)
+
+    for old in config.Paths.dimensions.glob(f"dac_{kind}_*.parquet"):
+        if old != file:
+            old.unlink(missing_ok=True)
+
+
+def build_dac_tables() -> None:
+    """Build the DAC donor and recipient tables.
+
+    The code and name pairs come from the DAC2a data set, and the groupings from
+    oda_data. Donors are flagged as official and/or bilateral, and recipients as
+    developing countries and regions.
+    """
+    from oda_data import donor_groupings, read_dac2a, recipient_groupings
+
+    set_data_paths()
+    ensure_source("oecd_dac")
+    config.Paths.dimensions.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Building the DAC dimension tables ({dac_vintage()})")
+
+    dac2a = read_dac2a(years=range(2010, 2023))
+    donor_names = dac2a.filter(["donor_code", "donor"]).drop_duplicates()
+    recipient_names = dac2a.filter(["recipient_code", "recipient"]).drop_duplicates()
+
+    donors = donor_groupings()
+    donors = _with_flags(
+        donor_names,
+        "donor_code",
+        {
+            "official": donors["all_official"] | OTHER_OFFICIAL_COUNTERPARTS,
+            "bilateral": donors["all_bilateral"],
+        },
+    )
+
+    recipients = _with_flags(
+        recipient_names,
+        "recipient_code",
+        {"developing": recipient_groupings()["all_developing_countries_regions"]},
+    )
+
+    _write_dac_table("donors", donors)
+    _write_dac_table("recipients", recipients)
+
+
+def _read_dac_table(kind: str, columns: list[str] | None) -> pd.DataFrame:
+    """Read a DAC table, building the tables first if needed"""
+    if not _dac_table_file(kind).exists():
+        with _lock:
+            if not _dac_table_file(kind).exists():
+                build_dac_tables()
+
+    return pd.read_parquet(_dac_table_file(kind), columns=columns)
+
+
+def dac_donors(columns: list[str] | None = None) -> pd.DataFrame:
+    """The DAC donors table: donor_code, donor, official and bilateral.
+
+    Args:
+        columns (list[str], optional): The columns to read. Defaults to all.
+    """
+    return _read_dac_table("donors", columns)
+
+
+def dac_recipients(columns: list[str] | None = None) -> pd.DataFrame:
+    """The DAC recipients table: recipient_code, recipient and developing.
+
+    Args:
+        columns (list[str], optional): The columns to read. Defaults to all.
+    """
+    return _read_dac_table("recipients", columns)
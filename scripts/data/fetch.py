@@ -0,0 +1,69 @@
+"""Fetch independent data sources concurrently.
+
+The ODA grants, IDS disbursements and IDS debt service data come from different
+sources and are mostly I/O bound (downloads and reading files), so they are fetched
+on a thread pool. bblocks, oda_data and pydeflate each keep their data path in a
+global setting; `set_data_paths` sets all of them once, under a lock, before any
+thread starts, so threads never change them while another one is reading.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from scripts import config
+from scripts.config import logger
+
+_lock = threading.Lock()
+_paths_set: bool = False
+
+
+def set_data_paths() -> None:
+    """Point bblocks, oda_data and pydeflate to `Paths.raw_data`.
+
+    This only changes the global settings of those packages the first time it is
+    called, so it is safe to call from any module or thread.
+    """
+    global _paths_set
+
+    with _lock:
+        if _paths_set:
+            return
+
+        from bblocks import set_bblocks_data_path
+        from oda_data import set_data_path
+        from pydeflate import set_pydeflate_path
+
+        set_bblocks_data_path(config.Paths.raw_data)
+        set_data_path(config.Paths.raw_data)
+        set_pydeflate_path(config.Paths.raw_data)
+
+        _paths_set = True
+
+
+def fetch_concurrently(tasks: dict[str, Callable[[], Any]]) -> dict[str, Any]:
+    """Run independent data loaders on a thread pool.
+
+    The number of threads is set by `config.FETCH_WORKERS`. With a single worker,
+    the loaders run one after the other. Errors are raised once all the loaders
+    have finished.
+
+    Args:
+        tasks (dict): A dictionary of names and functions (without arguments).
+
+    Returns:
+        dict: A dictionary of the same names and what each function returned.
+    """
+    set_data_paths()
+
+    workers = min(config.FETCH_WORKERS, len(tasks))
+
+    if workers <= 1:
+        return {name: task() for name, task in tasks.items()}
+
+    logger.debug(f"Fetching {', '.join(tasks)} on {workers} threads")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(task) for name, task in tasks.items()}
+
+    return {name: future.result() for name, future in futures.items()}
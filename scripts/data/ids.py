@@ -0,0 +1,580 @@
+"""Load indicators from the World Bank's International Debt Statistics (IDS)
+
+bblocks downloads each indicator to a feather file in `raw_data/ids_data`. The data
+stage reads the indicators from a single Parquet dataset in `raw_data/ids_dataset`,
+partitioned by indicator (`indicator=<code>/data.parquet`). Within a partition the
+rows are sorted by year and country and each year is a separate row group, so
+filters on the years only read the row groups they need.
+
+Files downloaded at different times can hold different IDS releases (vintages), even
+for the same years. The date each file was downloaded is recorded as its vintage in
+`raw_data/ids_data/vintages.json`. A file is only reused for other years than its
+own, or merged with other files, if its vintage is known. Files stored before
+vintages were recorded are given one by comparing their data with the other files
+of the indicator (see `_seed_vintages`).
+"""
+
+import datetime
+import json
+import os
+import re
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from bblocks import DebtIDS
+from pyarrow import fs
+
+from scripts import config
+from scripts.config import logger
+from scripts.data.cache import cache_lock
+from scripts.data.sources import OfflineError, ensure_source, is_offline
+
+# Marks the vintages inferred for files stored before vintages were recorded
+SEEDED: str = "seeded"
+
+# The columns of the IDS data (as returned by `DebtIDS`)
+IDS_COLUMNS: list[str] = [
+    "country",
+    "counterpart_area",
+    "series",
+    "year",
+    "value",
+    "series_code",
+]
+
+
+def ids_data_path() -> Path:
+    """The folder where bblocks stores the IDS feather files"""
+    return config.Paths.raw_data / "ids_data"
+
+
+def ids_dataset_path() -> Path:
+    """The folder of the partitioned IDS dataset"""
+    return config.Paths.raw_data / "ids_dataset"
+
+
+def indicator_codes(indicators: dict, exclude: list[str] | None = None) -> list[str]:
+    """Flatten a dictionary of IDS indicators into a list of unique codes.
+
+    Values can be a single code or a tuple of (total, concessional) codes.
+
+    Args:
+        indicators (dict): A dictionary of indicators, like `outflow_indicators`.
+        exclude (list[str], optional): Keys of the dictionary to leave out.
+    """
+    exclude = exclude or []
+
+    codes = []
+    for key, value in indicators.items():
+        if key in exclude:
+            continue
+        for code in value if isinstance(value, tuple) else (value,):
+            if code not in codes:
+                codes.append(code)
+
+    return codes
+
+
+def stored_files(indicator: str) -> list[tuple[int, int, Path]]:
+    """List the stored files for an indicator as (start_year, end_year, path),
+    sorted by start year."""
+    pattern = re.compile(rf"^{re.escape(indicator)}_(\d{{4}})-(\d{{4}})\.feather$")
+
+    files = []
+    for file in ids_data_path().glob(f"{indicator}_*.feather"):
+        if match := pattern.match(file.name):
+            files.append((int(match[1]), int(match[2]), file))
+
+    return sorted(files)
+
+
+def vintages_file() -> Path:
+    """The file which records the vintage of each stored file"""
+    return ids_data_path() / "vintages.json"
+
+
+def file_vintages() -> dict[str, str]:
+    """The recorded vintage (download date) of the stored files, by file name"""
+    try:
+        with open(vintages_file(), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def file_vintage(file: Path) -> str | None:
+    """The recorded vintage of a stored file (None if it is not known)"""
+    return file_vintages().get(file.name)
+
+
+def _record_vintages(vintages: dict[str, str | None]) -> None:
+    """Record the vintage of stored files (None removes the record).
+
+    Indicators can be downloaded concurrently (see `fetch.py`), so the records are
+    read, updated and written back while holding the cache lock.
+    """
+    with cache_lock():
+        recorded = file_vintages()
+        for name, vintage in vintages.items():
+            if vintage is None:
+                recorded.pop(name, None)
+            else:
+                recorded[name] = vintage
+
+        file = vintages_file()
+        tmp = file.parent / f".{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(recorded, f, indent=4, sort_keys=True)
+        os.replace(tmp, file)
+
+
+def _vintage_key(vintage: str | None) -> tuple[str, bool]:
+    """Sort key for vintages: by date, with recorded vintages above the seeded ones
+    of the same date. Unknown vintages sort first."""
+    if not vintage:
+        return "", False
+
+    return vintage[:10], SEEDED not in vintage
+
+
+def _same_data(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    """Whether two stored files of an indicator hold the same data for the years
+    they share"""
+    years = set(a.year.dt.year) & set(b.year.dt.year)
+    columns = ["country", "counterpart_area", "year", "value"]
+
+    def shared(data: pd.DataFrame) -> pd.DataFrame:
+        return (
+            data.loc[lambda d: d.year.dt.year.isin(years), columns]
+            .sort_values(columns)
+            .reset_index(drop=True)
+        )
+
+    return shared(a).equals(shared(b))
+
+
+def _seed_vintages(indicator: str) -> None:
+    """Infer the vintage of the stored files of an indicator which have none.
+
+    A file gets the vintage of the files it overlaps if it holds the same data for
+    the years they share. Files which don't match any vintage form new ones, dated
+    by the oldest modification time of their files and marked as seeded, so files
+    of different releases are never merged or used for each other's years.
+    """
+    vintages = file_vintages()
+    files = stored_files(indicator)
+    unknown = [f for f in files if f[2].name not in vintages]
+    if not unknown:
+        return
+
+    logger.info(f"Inferring the vintage of {len(unknown)} stored {indicator} files")
+    data = {file: pd.read_feather(file) for _, _, file in files}
+
+    groups = {}
+    for start, end, file in files:
+        if file.name in vintages:
+            groups.setdefault(vintages[file.name], []).append((start, end, file))
+
+    # Widest first, so narrower files are compared with the files covering them
+    new_groups = []
+    for start, end, file in sorted(unknown, key=lambda f: f[0] - f[1]):
+        for group in list(groups.values()) + new_groups:
+            overlapping = [g for g in group if g[0] <= end and start <= g[1]]
+            if overlapping and all(
+                _same_data(data[file], data[g[2]]) for g in overlapping
+            ):
+                group.append((start, end, file))
+                break
+        else:
+            new_groups.append([(start, end, file)])
+
+    seeded = {
+        file.name: vintage
+        for vintage, group in groups.items()
+        for _, _, file in group
+        if file.name not in vintages
+    }
+
+    used = set(groups)
+    for group in new_groups:
+        modified = min(file.stat().st_mtime for _, _, file in group)
+        base = f"{datetime.date.fromtimestamp(modified).isoformat()}-{SEEDED}"
+        vintage, n = base, 1
+        while vintage in used:
+            n += 1
+            vintage = f"{base}-{n}"
+        used.add(vintage)
+        seeded |= {file.name: vintage for _, _, file in group}
+
+    _record_vintages(seeded)
+
+
+def _stored_file(indicator: str, start_year: int, end_year: int) -> Path | None:
+    """Find the stored file to read the requested years from.
+
+    A file for exactly the requested years is used if there is one (as bblocks
+    would). Otherwise, the narrowest file of the most recent vintage which covers
+    them. Covering files without a recorded vintage get one first (see
+    `_seed_vintages`), since a wider file can hold a different release.
+    """
+    files = stored_files(indicator)
+
+    for start, end, file in files:
+        if (start, end) == (start_year, end_year):
+            return file
+
+    covering = [f for f in files if f[0] <= start_year and end_year <= f[1]]
+
+    vintages = file_vintages()
+    if any(file.name not in vintages for _, _, file in covering):
+        _seed_vintages(indicator)
+        vintages = file_vintages()
+
+    if not covering:
+        return None
+
+    return max(
+        covering, key=lambda f: (_vintage_key(vintages.get(f[2].name)), f[0] - f[1])
+    )[2]
+
+
+def _download_indicator(indicator: str, start_year: int, end_year: int) -> None:
+    """Download an indicator, covering at least the requested years.
+
+    The download is extended to cover any stored files of the same vintage (downloaded
+    on the same day) which overlap or touch the requested years. The new file
+    supersedes them, so they are removed. Files of other vintages are kept.
+    """
+    vintage = datetime.date.today().isoformat()
+    start, end = start_year, end_year
+    superseded = set()
+
+    same_vintage = [f for f in stored_files(indicator) if file_vintage(f[2]) == vintage]
+
+    # Extend the range until no other stored file of the vintage overlaps it
+    extended = True
+    while extended:
+        extended = False
+        for s, e, file in same_vintage:
+            if file not in superseded and s <= end + 1 and e >= start - 1:
+                start, end = min(start, s), max(end, e)
+                superseded.add(file)
+                extended = True
+
+    logger.info(f"Downloading {indicator} for {start}-{end}")
+    DebtIDS().load_data(indicators=indicator, start_year=start, end_year=end)
+
+    new_file = ids_data_path() / f"{indicator}_{start}-{end}.feather"
+    for file in superseded - {new_file}:
+        file.unlink(missing_ok=True)
+
+    _record_vintages(
+        {file.name: None for file in superseded - {new_file}} | {new_file.name: vintage}
+    )
+
+
+def _partition_file(indicator: str) -> Path:
+    return ids_dataset_path() / f"indicator={indicator}" / "data.parquet"
+
+
+def partition_metadata(indicator: str) -> dict | None:
+    """The metadata of the dataset partition of an indicator, if there is one: the
+    years it covers and the stored file (its vintage and modification time) it was
+    built from"""
+    try:
+        metadata = pq.read_schema(_partition_file(indicator)).metadata
+    except FileNotFoundError:
+        return None
+
+    return {k.decode(): v.decode() for k, v in metadata.items() if k != b"pandas"}
+
+
+def _is_newer(file: Path | None, vintage: str | None) -> bool:
+    """Whether a stored file holds a more recent vintage than the given one"""
+    return file is not None and _vintage_key(file_vintage(file)) > _vintage_key(vintage)
+
+
+def _is_current(indicator: str, start_year: int, end_year: int) -> bool:
+    """Whether the partition of an indicator covers the requested years, its stored
+    file has not changed and no stored file covering them holds a newer vintage.
+
+    A partition can cover more years than requested (and its stored file can be
+    another one than the file for exactly these years), so loads of different year
+    ranges share it.
+    """
+    metadata = partition_metadata(indicator)
+    if metadata is None:
+        return False
+
+    if (
+        not int(metadata["start_year"])
+        <= start_year
+        <= end_year
+        <= int(metadata["end_year"])
+    ):
+        return False
+
+    if "source_file" not in metadata:
+        return False
+
+    # A partition whose stored file was removed is still valid
+    source = ids_data_path() / metadata["source_file"]
+    if source.exists() and (
+        file_vintage(source) or "",
+        str(source.stat().st_mtime_ns),
+    ) != (metadata.get("source_vintage"), metadata.get("source_mtime")):
+        return False
+
+    file = _stored_file(indicator, start_year, end_year)
+
+    return not _is_newer(file, metadata.get("source_vintage"))
+
+
+def _write_partition(
+    indicator: str, table: pa.Table, start_year: int, end_year: int, source: Path
+) -> None:
+    """Write the data of an indicator as its dataset partition, sorted by year and
+    country, with one row group per year"""
+    file = _partition_file(indicator)
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    table = table.select(IDS_COLUMNS).sort_by(
+        [("year", "ascending"), ("country", "ascending")]
+    )
+    schema = table.schema.with_metadata(
+        {
+            "start_year": str(start_year),
+            "end_year": str(end_year),
+            "source_file": source.name,
+            "source_vintage": file_vintage(source) or "",
+            "source_mtime": str(source.stat().st_mtime_ns),
+        }
+    )
+
+    # Positions where the year changes, which split the table into row groups
+    years = pc.year(table["year"]).to_numpy(zero_copy_only=False)
+    bounds = np.flatnonzero(np.diff(years)) + 1
+
+    # Hidden, so the dataset never picks up a partially written file
+    tmp = file.parent / f".{uuid.uuid4().hex}.tmp"
+    with pq.ParquetWriter(tmp, schema) as writer:
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(years)]):
+            writer.write_table(table.slice(start, end - start))
+    os.replace(tmp, file)
+
+
+def _ingest_file(indicator: str, file: Path) -> None:
+    """Write a stored feather file as the dataset partition of an indicator"""
+    start, end = map(int, file.stem.split("_")[-1].split("-"))
+
+    logger.debug(f"Adding {file.name} to the IDS dataset")
+    _write_partition(indicator, feather.read_table(file), start, end, source=file)
+
+
+def _ingest_indicator(indicator: str, start_year: int, end_year: int) -> None:
+    """Add an indicator to the dataset from the stored feather file which covers the
+    requested years, downloading it first if there isn't one.
+
+    The partition keeps the years it already covers: the file covers both those
+    and the requested years. If no stored file does (or the file for the requested
+    years holds a newer vintage), the combined years are downloaded. Offline, only
+    the requested years are kept.
+    """
+    start, end = start_year, end_year
+    if (metadata := partition_metadata(indicator)) is not None:
+        start = min(start, int(metadata["start_year"]))
+        end = max(end, int(metadata["end_year"]))
+
+    file = _stored_file(indicator, start, end)
+    requested = _stored_file(indicator, start_year, end_year)
+
+    if file is None or _is_newer(requested, file_vintage(file)):
+        if is_offline("ids"):
+            if requested is None:
+                raise OfflineError(
+                    f"The IDS mirror has no file for {indicator} "
+                    f"({start_year}-{end_year})"
+                )
+            file = requested
+        else:
+            _download_indicator(indicator, start, end)
+            file = _stored_file(indicator, start, end)
+
+    _ingest_file(indicator, file)
+
+
+def reingest_indicator(indicator: str) -> None:
+    """Add an indicator to the dataset again, for the years of its partition (e.g.
+    after a new release was downloaded). Indicators which are not in the dataset
+    yet are added when they are loaded."""
+    metadata = partition_metadata(indicator)
+    if metadata is None:
+        return
+
+    file = _stored_file(
+        indicator, int(metadata["start_year"]), int(metadata["end_year"])
+    )
+    if file is not None:
+        _ingest_file(indicator, file)
+
+
+def ids_dataset() -> ds.Dataset:
+    """Open the IDS dataset. The files are memory-mapped, not read into memory."""
+    return ds.dataset(
+        ids_dataset_path(),
+        format="parquet",
+        partitioning="hive",
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def _read_indicator(
+    dataset: ds.Dataset, indicator: str, start_year: int, end_year: int
+) -> pa.Table:
+    """Read the requested years of an indicator from the dataset"""
+    start = pa.scalar(datetime.datetime(start_year, 1, 1), type=pa.timestamp("ns"))
+    end = pa.scalar(datetime.datetime(end_year + 1, 1, 1), type=pa.timestamp("ns"))
+
+    return dataset.to_table(
+        columns=IDS_COLUMNS,
+        filter=(ds.field("indicator") == indicator)
+        & (ds.field("year") >= start)
+        & (ds.field("year") < end),
+    )
+
+
+def load_ids_indicators(
+    indicators: list[str], start_year: int, end_year: int
+) -> dict[str, pd.DataFrame]:
+    """Load several IDS indicators in a single pass.
+
+    Indicators which are not in the dataset (or don't cover the requested years, or
+    whose stored file changed since) are added to it first, from the stored feather
+    files or by downloading them (through bblocks). If the 'ids' source is mirrored,
+    the feather files are copied from the mirror instead. The requested years of
+    each indicator are then read from the dataset, with the filters pushed down to
+    the row groups, and all the indicators are converted to pandas in one go. Each
+    indicator is returned as a slice of that single DataFrame, so no data is copied
+    per indicator.
+
+    The data follows the `DebtIDS` format: country, counterpart_area, series,
+    year (as datetime), value and series_code.
+
+    Args:
+        indicators (list[str]): The IDS codes to load.
+        start_year (int): The first year to include in the data.
+        end_year (int): The last year to include in the data.
+
+    Returns:
+        dict[str, pd.DataFrame]: A dictionary of indicator code to its data.
+    """
+    ensure_source("ids")
+
+    for indicator in indicators:
+        if not _is_current(indicator, start_year, end_year):
+            _ingest_indicator(indicator, start_year, end_year)
+
+    dataset = ids_dataset()
+    tables = [_read_indicator(dataset, i, start_year, end_year) for i in indicators]
+
+    data = pa.concat_tables(tables, promote_options="default").to_pandas()
+
+    # Rows for each indicator are contiguous, in the order they were requested
+    offsets = np.cumsum([0] + [t.num_rows for t in tables])
+
+    return {
+        indicator: data.iloc[offsets[i] : offsets[i + 1]]
+        for i, indicator in enumerate(indicators)
+    }
+
+
+def _overlapping_groups(
+    files: list[tuple[int, int, Path]],
+) -> list[list[tuple[int, int, Path]]]:
+    """Group files (sorted by start year) whose year ranges overlap or touch"""
+    groups = []
+    for file in files:
+        if groups and file[0] <= max(f[1] for f in groups[-1]) + 1:
+            groups[-1].append(file)
+        else:
+            groups.append([file])
+
+    return groups
+
+
+def _merge_files(indicator: str, files: list[tuple[int, int, Path]]) -> None:
+    """Merge several stored files of the same vintage into a single file.
+
+    Files of the same vintage hold the same data for the years they share, so each
+    year is taken from the widest file which covers it.
+    """
+    vintage = file_vintage(files[0][2])
+    start = min(f[0] for f in files)
+    end = max(f[1] for f in files)
+    target = ids_data_path() / f"{indicator}_{start}-{end}.feather"
+
+    if target.exists() and target not in [f[2] for f in files]:
+        logger.warning(f"Not merging into {target.name}: it holds another vintage")
+        return
+
+    ordered = sorted(files, key=lambda f: f[1] - f[0], reverse=True)
+
+    # Unless the first file already covers all the years, build the merged file
+    if ordered[0][2] != target:
+        frames, covered = [], set()
+        for s, e, file in ordered:
+            years = set(range(s, e + 1)) - covered
+            if years:
+                data = pd.read_feather(file)
+                frames.append(data.loc[lambda d: d.year.dt.year.isin(years)])
+                covered |= years
+
+        tmp = target.with_suffix(".tmp")
+        pd.concat(frames, ignore_index=True).to_feather(tmp)
+        os.replace(tmp, target)
+
+    for _, _, file in files:
+        if file != target:
+            file.unlink(missing_ok=True)
+
+    _record_vintages(
+        {file.name: None for _, _, file in files if file != target}
+        | {target.name: vintage}
+    )
+
+    logger.info(f"Merged {len(files)} files into {target.name}")
+
+
+def compact_ids_data() -> None:
+    """Merge overlapping stored files of the same vintage into a single file.
+
+    Files without a recorded vintage get one first (see `_seed_vintages`). Files of
+    different vintages are left as they are, since they can hold different data for
+    the same years. Files whose year ranges do not overlap (or touch) are also left
+    as they are, so a file name never claims years it does not contain.
+    """
+    indicators = {f.name.split("_")[0] for f in ids_data_path().glob("*.feather")}
+
+    for indicator in sorted(indicators):
+        _seed_vintages(indicator)
+        vintages = file_vintages()
+
+        by_vintage = {}
+        for file in stored_files(indicator):
+            by_vintage.setdefault(vintages[file[2].name], []).append(file)
+
+        for files in by_vintage.values():
+            for group in _overlapping_groups(files):
+                if len(group) > 1:
+                    _merge_files(indicator, group)
+
+
+if __name__ == "__main__":
+    compact_ids_data()
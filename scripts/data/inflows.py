@@ -1,11 +1,10 @@
 """ DEBT INFLOWS FROM IDS AND GRANTS INFLOWS FROM ODA DATA"""
 
 import pandas as pd
-from bblocks import set_bblocks_data_path, DebtIDS, add_income_level_column
-from oda_data import ODAData, set_data_path, donor_groupings
-from pydeflate import deflate, set_pydeflate_path
+from oda_data import ODAData
 
 from scripts import config
+from scripts.data.cache import cached_parts, disk_cache
 from scripts.data.common import (
     clean_debtors,
     clean_creditors,
@@ -16,12 +15,23 @@ from scripts.data.common import (
     filter_and_assign_indicator,
     get_concessional_non_concessional,
     add_counterpart_type,
+    to_categorical,
 )
+from scripts.data.dimensions import add_income_levels, dac_donors
+from scripts.data.fetch import fetch_concurrently, set_data_paths
+from scripts.data.ids import indicator_codes, load_ids_indicators
+from scripts.data.manifest import ids_source, prices_source
+from scripts.data.prices import (
+    add_constant_prices,
+    assign_prices,
+    constant_column,
+    split_prices,
+    to_constant_prices,
+)
+from scripts.data.sources import ensure_source
 
 # set the path for the raw data
-set_bblocks_data_path(config.Paths.raw_data)
-set_data_path(config.Paths.raw_data)
-set_pydeflate_path(config.Paths.raw_data)
+set_data_paths()
 
 # this dictionary contains the IDS codes. When a tuple, it's the total and concessional
 disbursements_indicators: dict = {
@@ -34,33 +44,6 @@ disbursements_indicators: dict = {
 }
 
 
-def to_constant_prices(data: pd.DataFrame, base_year: int) -> pd.DataFrame:
-    """
-    This method takes in a pandas DataFrame 'data' and an integer 'base_year' as input parameters.
-    It returns a new pandas DataFrame with constant prices.
-
-    Parameters:
-    - data (pd.DataFrame): The  DataFrame containing the data to be converted to constant prices.
-    - base_year (int): The base year against which the prices will be deflated.
-
-    Returns:
-    - pd.DataFrame: A new DataFrame with constant prices.
-
-    """
-
-    # Pass the data to the deflate function and assign a prices column
-    data = deflate(
-        df=data,
-        base_year=base_year,
-        deflator_source=config.PRICES_SOURCE,
-        deflator_method="gdp",
-        exchange_source=config.PRICES_SOURCE,
-        date_column="year",
-    ).assign(prices="constant")
-
-    return data
-
-
 def clean_debt_output(data: pd.DataFrame) -> pd.DataFrame:
     """
     Cleans the output data frame by replacing bad characters and
@@ -84,7 +67,7 @@ def clean_debt_output(data: pd.DataFrame) -> pd.DataFrame:
     data.year = data.year.dt.year
 
     # add income level
-    data = add_income_level_column(data, id_column="iso_code", id_type="ISO3")
+    data = add_income_levels(data, iso_column="iso_code")
 
     # drop missing values and values which are zero
     data = data.dropna(subset=["value"]).loc[lambda d: d.value != 0]
@@ -92,7 +75,7 @@ def clean_debt_output(data: pd.DataFrame) -> pd.DataFrame:
     # add counterpart type
     data = add_counterpart_type(data)
 
-    return data
+    return to_categorical(data)
 
 
 def clean_grants_inflows_output(data: pd.DataFrame) -> pd.DataFrame:
@@ -135,79 +118,102 @@ def clean_grants_inflows_output(data: pd.DataFrame) -> pd.DataFrame:
                 "prices",
                 "indicator",
                 "value",
+                constant_column(config.CONSTANT_BASE_YEAR),
             ]
         )
         .rename(columns={"donor": "counterpart_area", "recipient": "country"})
         .pipe(remove_counterpart_totals)
-        .assign(value=lambda d: d.value * 1e6)  # to units
-        .pipe(add_income_level_column, id_column="iso_code", id_type="ISO3")
+        .pipe(_to_units)
+        .pipe(add_income_levels, iso_column="iso_code")
+        .pipe(to_categorical)
     )
 
     return data
 
 
-def get_debt_inflows(constant: bool = False) -> pd.DataFrame:
-    """
-    Retrieve debt inflows data to bilateral, multilateral,
-    bonds, banks, and other private entities.
+def _to_units(data: pd.DataFrame) -> pd.DataFrame:
+    """Convert the value columns (including constant prices, if present) from
+    millions to units"""
+    columns = [c for c in data.columns if c == "value" or c.startswith("value_")]
 
-    Note: this is disbursements data, not debt stocks or new commitments.
-    """
-    # get bilateral data, split by concessional and non-concessional
-    bilateral = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1],
-        total_indicator=disbursements_indicators["bilateral"][0],
-        concessional_indicator=disbursements_indicators["bilateral"][1],
-        indicator_prefix="bilateral",
-    )
+    return data.assign(**{c: data[c] * 1e6 for c in columns})
 
-    # get multilateral data, split by concessional and non-concessional
-    multilateral = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1],
-        total_indicator=disbursements_indicators["multilateral"][0],
-        concessional_indicator=disbursements_indicators["multilateral"][1],
-        indicator_prefix="multilateral",
-    )
 
-    # Load bonds, banks, and other private
-    ids = DebtIDS().load_data(
-        indicators=[
-            disbursements_indicators["bonds"],
-            disbursements_indicators["banks"],
-            disbursements_indicators["other_private"],
-        ],
+def _debt_inflows_part(ids: dict[str, pd.DataFrame], part: str) -> pd.DataFrame:
+    """Get a part of the debt inflows data from the IDS indicators"""
+    indicators = disbursements_indicators[part]
+
+    # bilateral and multilateral, split by concessional and non-concessional
+    if isinstance(indicators, tuple):
+        return get_concessional_non_concessional(
+            ids=ids,
+            total_indicator=indicators[0],
+            concessional_indicator=indicators[1],
+            indicator_prefix=part,
+        )
+
+    # bonds, banks and other private
+    return ids[indicators].pipe(filter_and_assign_indicator, part)
+
+
+def _build_debt_inflows_parts(parts: list[str]) -> dict[str, pd.DataFrame]:
+    """Load the IDS indicators for some parts (in a single pass) and clean them"""
+    ids = load_ids_indicators(
+        indicators=indicator_codes(
+            {part: disbursements_indicators[part] for part in parts}
+        ),
         start_year=config.ANALYSIS_YEARS[0],
         end_year=config.ANALYSIS_YEARS[1],
     )
 
-    # Get bonds data
-    bonds = ids.get_data(disbursements_indicators["bonds"]).pipe(
-        filter_and_assign_indicator, "bonds"
-    )
+    return {
+        part: _debt_inflows_part(ids, part).pipe(clean_debt_output) for part in parts
+    }
 
-    # Get banks data
-    banks = ids.get_data(disbursements_indicators["banks"]).pipe(
-        filter_and_assign_indicator, "banks"
-    )
 
-    # Get other private data
-    other_private = ids.get_data(disbursements_indicators["other_private"]).pipe(
-        filter_and_assign_indicator, "other_private"
+def _debt_inflows_sources() -> list[str]:
+    codes = indicator_codes(disbursements_indicators, exclude=["total"])
+
+    return [ids_source(code) for code in codes] + [prices_source(), "income_levels"]
+
+
+def _grants_inflows_sources() -> list[str]:
+    return ["oecd_dac", prices_source("oecd_dac"), "income_levels"]
+
+
+@disk_cache(sources=_debt_inflows_sources)
+def get_debt_inflows(constant: bool = False, both_prices: bool = False) -> pd.DataFrame:
+    """
+    Retrieve debt inflows data to bilateral, multilateral,
+    bonds, banks, and other private entities.
+
+    Note: this is disbursements data, not debt stocks or new commitments.
+
+    Each part of the data (e.g. bilateral) is cleaned and cached separately, so
+    only the parts whose IDS indicators changed are loaded and cleaned again.
+
+    Args:
+        constant (bool): Whether to retrieve the data in constant or current prices.
+        both_prices (bool): Whether to retrieve both current and constant prices
+            (overrides `constant`).
+    """
+    parts = cached_parts(
+        "debt_inflows",
+        {
+            part: [ids_source(code) for code in indicator_codes({part: codes})]
+            + ["income_levels"]
+            for part, codes in disbursements_indicators.items()
+            if part != "total"
+        },
+        _build_debt_inflows_parts,
     )
 
     # combine
-    data = pd.concat(
-        [bilateral, multilateral, bonds, banks, other_private], ignore_index=True
-    ).pipe(clean_debt_output)
+    data = pd.concat(parts.values(), ignore_index=True).pipe(to_categorical)
 
-    if constant:
-        data = to_constant_prices(data, config.CONSTANT_BASE_YEAR)
-    else:
-        data = data.assign(prices="current")
+    data = assign_prices(data, constant=constant, both_prices=both_prices)
 
-    return data
+    return to_categorical(data)
 
 
 def assign_grants_indicator(data: pd.DataFrame) -> pd.DataFrame:
@@ -222,7 +228,10 @@ def assign_grants_indicator(data: pd.DataFrame) -> pd.DataFrame:
 
     """
     # Get the donor_codes that are bilateral
-    bilateral = {c: "grants_bilateral" for c in donor_groupings()["all_bilateral"]}
+    donors = dac_donors(columns=["donor_code", "bilateral"])
+    bilateral = {
+        c: "grants_bilateral" for c in donors.loc[lambda d: d.bilateral, "donor_code"]
+    }
 
     # Map bilateral donors to "grants_bilateral" and fill the rest with "grants_multilateral"
     data = data.assign(
@@ -232,35 +241,61 @@ def assign_grants_indicator(data: pd.DataFrame) -> pd.DataFrame:
     return data
 
 
-def get_grants_inflows(constant: bool = False) -> pd.DataFrame:
+@disk_cache(sources=_grants_inflows_sources)
+def get_grants_inflows(
+    constant: bool = False, both_prices: bool = False
+) -> pd.DataFrame:
     """
     Retrieve grants inflows from OECD ODA data.
 
     Args:
         - constant (bool): Whether to retrieve the data in constant or current prices.
+        - both_prices (bool): Whether to retrieve both current and constant prices
+          (overrides `constant`).
 
     Returns:
         pd.DataFrame: DataFrame containing grants inflows data.
     """
 
-    # Create an object with the basic settings
+    ensure_source("oecd_dac")
+
+    # Create an object with the basic settings. The data is always loaded in
+    # current prices, and deflated with the DAC deflators (by donor) if needed.
     oda = ODAData(
         years=range(config.ANALYSIS_YEARS[0], config.ANALYSIS_YEARS[1] + 1),
         include_names=False,
-        base_year=config.CONSTANT_BASE_YEAR if constant else None,
-        prices="constant" if constant else "current",
+        prices="current",
     )
 
     # Load the data
     oda.load_indicator("recipient_grants_flow")
+    data = oda.get_data()
+
+    # The DAC deflators are applied in millions, before cleaning
+    dac_prices = {"source": "oecd_dac", "id_column": "donor_code"}
+
+    if both_prices:
+        data = add_constant_prices(
+            data, config.CONSTANT_BASE_YEAR, use_source_codes=True, **dac_prices
+        )
+    elif constant:
+        data = to_constant_prices(
+            data, config.CONSTANT_BASE_YEAR, use_source_codes=True, **dac_prices
+        )
 
-    # Retrieve and clean the data
-    data = oda.get_data().pipe(clean_grants_inflows_output)
+    # Clean the data
+    data = data.pipe(clean_grants_inflows_output)
+
+    if both_prices:
+        data = split_prices(data, config.CONSTANT_BASE_YEAR).pipe(to_categorical)
 
     return data
 
 
-def get_total_inflows(constant: bool = False) -> pd.DataFrame:
+@disk_cache(sources=lambda: _grants_inflows_sources() + _debt_inflows_sources())
+def get_total_inflows(
+    constant: bool = False, both_prices: bool = False
+) -> pd.DataFrame:
     """
     Get total inflows data.
 
@@ -270,19 +305,28 @@ def get_total_inflows(constant: bool = False) -> pd.DataFrame:
 
     Parameters:
         constant (bool, optional): Flag to convert to constant values. Default is False.
+        both_prices (bool, optional): Flag to return both current and constant values,
+            loading the data only once. Overrides `constant`. Default is False.
 
     Returns:
         pd.DataFrame: Combined inflows data with an additional column indicating the indicator type.
 
     """
-    # Get grants data
-    grants = get_grants_inflows(constant)
-
-    # Get debt data
-    debt = get_debt_inflows(constant)
+    # Get grants and debt data (from independent sources, so concurrently)
+    fetched = fetch_concurrently(
+        {
+            "grants": lambda: get_grants_inflows(constant, both_prices),
+            "debt": lambda: get_debt_inflows(constant, both_prices),
+        }
+    )
+    grants, debt = fetched["grants"], fetched["debt"]
 
     # Combine the data and assign indicator type
-    data = pd.concat([grants, debt], ignore_index=True).assign(indicator_type="inflow")
+    data = (
+        pd.concat([grants, debt], ignore_index=True)
+        .assign(indicator_type="inflow")
+        .pipe(to_categorical)
+    )
 
     return data
 
@@ -0,0 +1,279 @@
+"""Manifest of the raw data sources.
+
+`raw_data/sources_manifest.json` records, for each raw source (each IDS indicator,
+the OECD DAC tables, the deflator source files and the UN population files), its
+files, a hash of their contents, its vintage and its number of rows.
+
+The disk cache uses the hashes of the sources a loader depends on, instead of the
+state of the whole raw data folder, so a change to one source only invalidates the
+cleaned data which depends on it. Run this module to refresh the data: it records
+which sources changed, adds the changed IDS indicators to the IDS dataset again and
+rebuilds only the cleaned data which depends on them.
+"""
+
+import datetime
+import functools
+import hashlib
+import json
+import os
+import re
+import uuid
+from pathlib import Path
+
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from scripts import config
+from scripts.config import logger
+from scripts.data.sources import ensure_source
+
+# Not 'manifest.json': pydeflate 2.2 to 2.4 keep their own manifest with that name in
+# their data folder, which is raw_data
+MANIFEST_FILE = config.Paths.raw_data / "sources_manifest.json"
+
+# Sources stored as files in raw_data, as glob patterns. IDS indicators are added
+# by `raw_sources` as 'ids/<indicator>'. pydeflate 2.1 adds the download date to the
+# name of its files, 2.2 to 2.4 use a fixed name and 2.5 stores them in 'bulk'.
+FILE_SOURCES: dict[str, list[str]] = {
+    "oecd_dac": ["dac1*.feather", "dac2a*", "table1*", "table2a*"],
+    "prices/weo": ["weo_????-??-??.parquet", "imf_weo.parquet", "bulk/imf_weo.parquet"],
+    "prices/wb": ["wb_????-??-??.parquet", "wb.parquet", "bulk/wb.parquet"],
+    "prices/dac": ["dac_????-??-??.parquet", "dac.parquet", "bulk/dac.parquet"],
+    "un_population/47": ["un_population_raw_47.*"],
+    "un_population/49": ["un_population_raw_49.*"],
+    "income_levels": ["income_levels.csv"],
+}
+
+
+def ids_source(indicator: str) -> str:
+    """The name of the source of an IDS indicator"""
+    return f"ids/{indicator}"
+
+
+def prices_source(source: str | None = None) -> str:
+    """The name of the source of a deflator source (defaults to
+    `config.PRICES_SOURCE`)"""
+    from scripts.data.prices import SOURCES, _source
+
+    return f"prices/{SOURCES[_source(source)][1]}"
+
+
+def ensure_sources(names: list[str]) -> None:
+    """Copy mirrored sources into raw_data before they are described. A source like
+    'ids/<indicator>' or 'prices/weo' belongs to the 'ids' or 'prices' source of
+    `config.SOURCE_MODES`."""
+    for source in sorted({name.split("/")[0] for name in names}):
+        if source in config.SOURCE_MODES:
+            ensure_source(source)
+
+
+def raw_sources() -> dict[str, list[Path]]:
+    """List the files of each raw source which is in raw_data"""
+    from scripts.data.ids import ids_data_path
+
+    sources = {}
+
+    for file in sorted(ids_data_path().glob("*.feather")):
+        sources.setdefault(ids_source(file.name.split("_")[0]), []).append(file)
+
+    for name, patterns in FILE_SOURCES.items():
+        files = sorted(
+            {
+                file
+                for pattern in patterns
+                for file in config.Paths.raw_data.glob(pattern)
+            }
+        )
+        if files:
+            sources[name] = files
+
+    return sources
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _row_count(path: Path) -> int | None:
+    if path.suffix == ".parquet":
+        return pq.ParquetFile(path).metadata.num_rows
+    if path.suffix == ".feather":
+        return feather.read_table(path, memory_map=True).num_rows
+    if path.suffix == ".csv":
+        with open(path, "rb") as f:
+            return max(sum(1 for _ in f) - 1, 0)
+
+    return None
+
+
+def _vintage(name: str, files: list[Path]) -> str:
+    """The vintage of a source: the date the OECD DAC data was updated, the date in
+    the name of deflator source files (if it has one), or else the date the files
+    were modified."""
+    if name == "oecd_dac":
+        from scripts.data.dimensions import dac_vintage
+
+        return dac_vintage()
+
+    if name.startswith("prices/"):
+        dates = [file.stem.split("_")[-1] for file in files]
+        dates = sorted(d for d in dates if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d))
+        if dates:
+            return dates[-1]
+
+    modified = max(file.stat().st_mtime for file in files)
+
+    return datetime.date.fromtimestamp(modified).isoformat()
+
+
+def read_manifest() -> dict:
+    """Read the stored manifest (empty if there isn't one)"""
+    try:
+        with open(MANIFEST_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(manifest: dict) -> None:
+    tmp = MANIFEST_FILE.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp, MANIFEST_FILE)
+
+
+@functools.lru_cache(maxsize=None)
+def _describe_file(path: str, size: int, mtime: int) -> dict:
+    """Hash a file and count its rows (once per size and modification time)"""
+    file = config.Paths.raw_data / path
+
+    return {
+        "path": path,
+        "size": size,
+        "mtime": mtime,
+        "hash": _file_hash(file),
+        "rows": _row_count(file),
+    }
+
+
+def _source_entry(name: str, files: list[Path], stored: dict | None) -> dict:
+    """Describe a source. The hash and rows of files which have the same size and
+    modification time as in the stored entry are reused."""
+    known = {f["path"]: f for f in (stored or {}).get("files", [])}
+
+    described = []
+    for file in files:
+        stat = file.stat()
+        path = str(file.relative_to(config.Paths.raw_data))
+        previous = known.get(path, {})
+
+        if (previous.get("size"), previous.get("mtime")) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            described.append(previous)
+        else:
+            described.append(_describe_file(path, stat.st_size, stat.st_mtime_ns))
+
+    content = json.dumps([(f["path"], f["hash"]) for f in described]).encode()
+    rows = [f["rows"] for f in described]
+
+    return {
+        "hash": hashlib.sha256(content).hexdigest(),
+        "vintage": _vintage(name, files),
+        "rows": sum(rows) if None not in rows else None,
+        "files": described,
+    }
+
+
+def build_manifest(stored: dict | None = None) -> dict:
+    """Describe all the raw sources (reusing the hashes in the stored manifest for
+    files which have not changed)"""
+    stored = read_manifest() if stored is None else stored
+
+    return {
+        name: _source_entry(name, files, stored.get(name))
+        for name, files in raw_sources().items()
+    }
+
+
+def source_hashes(names: list[str]) -> dict[str, str | None]:
+    """The current content hash of each source (None if it is not in raw_data).
+
+    Only the requested sources are described, so this is cheap to call for the
+    cache fingerprints.
+    """
+    ensure_sources(names)
+    stored = read_manifest()
+    files = raw_sources()
+
+    return {
+        name: (
+            _source_entry(name, files[name], stored.get(name))["hash"]
+            if name in files
+            else None
+        )
+        for name in sorted(set(names))
+    }
+
+
+def changed_sources(old: dict, new: dict) -> list[str]:
+    """The sources which were added, removed or whose content changed"""
+    return sorted(
+        name
+        for name in set(old) | set(new)
+        if old.get(name, {}).get("hash") != new.get(name, {}).get("hash")
+    )
+
+
+def update_manifest() -> list[str]:
+    """Describe the raw sources, store the manifest and return the sources which
+    changed since it was last stored."""
+    ensure_sources(list(config.SOURCE_MODES))
+    stored = read_manifest()
+    manifest = build_manifest(stored)
+    changed = changed_sources(stored, manifest)
+
+    if changed or manifest != stored:
+        write_manifest(manifest)
+
+    return changed
+
+
+def refresh() -> list[str]:
+    """Re-ingest and re-clean the sources which changed.
+
+    IDS indicators whose files changed are added to the IDS dataset again. If the
+    cache is on, the cleaned data is then loaded (in current and constant prices),
+    which rebuilds the cached data only for the parts which depend on a changed
+    source.
+
+    Returns:
+        list[str]: The sources which changed.
+    """
+    from scripts.data.ids import reingest_indicator
+    from scripts.data.inflows import get_total_inflows
+    from scripts.data.outflows import get_debt_service_data
+
+    changed = update_manifest()
+    logger.info(f"Changed sources: {changed or 'none'}")
+
+    for name in changed:
+        if name.startswith("ids/"):
+            reingest_indicator(name.removeprefix("ids/"))
+
+    if config.USE_CACHE:
+        for both_prices in [False, True]:
+            get_total_inflows(both_prices=both_prices)
+            get_debt_service_data(both_prices=both_prices)
+
+    return changed
+
+
+if __name__ == "__main__":
+    refresh()
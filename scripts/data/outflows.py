@@ -1,17 +1,22 @@
 """DEBT SERVICE OUTFLOWS FROM IDS"""
 
 import pandas as pd
-from bblocks import set_bblocks_data_path, DebtIDS
 
 from scripts import config
+from scripts.data.cache import cached_parts, disk_cache
 from scripts.data.common import (
     filter_and_assign_indicator,
     get_concessional_non_concessional,
+    to_categorical,
 )
-from scripts.data.inflows import clean_debt_output, to_constant_prices
+from scripts.data.fetch import set_data_paths
+from scripts.data.ids import indicator_codes, load_ids_indicators
+from scripts.data.inflows import clean_debt_output
+from scripts.data.manifest import ids_source, prices_source
+from scripts.data.prices import assign_prices
 
 # set the path for the raw data
-set_bblocks_data_path(config.Paths.raw_data)
+set_data_paths()
 
 outflow_indicators: dict = {
     "total_amt": "DT.AMT.DPPG.CD",
@@ -29,107 +34,103 @@ outflow_indicators: dict = {
 }
 
 
-def get_debt_service_data(constant: bool = False) -> pd.DataFrame:
-    """
-    Retrieve debt service data to bilateral, multilateral,
-    bonds, banks, and other private entities.
+# The parts of the debt service data (cleaned and cached separately), and the IDS
+# indicators each one uses
+debt_service_parts: dict = {
+    "bilateral_amt": outflow_indicators["bilateral_amt"],
+    "bilateral_int": outflow_indicators["bilateral_int"],
+    "multilateral_amt": outflow_indicators["multilateral_amt"],
+    "multilateral_int": outflow_indicators["multilateral_int"],
+    "bonds": (outflow_indicators["bonds_amt"], outflow_indicators["bonds_int"]),
+    "banks": (outflow_indicators["banks_amt"], outflow_indicators["banks_int"]),
+    "other_private": (
+        outflow_indicators["other_private_amt"],
+        outflow_indicators["other_private_int"],
+    ),
+}
 
-    Note: debt service combines principal and interest payments.
 
-    Returns:
-        pd.DataFrame: DataFrame containing debt service data.
+def _debt_service_part(ids: dict[str, pd.DataFrame], part: str) -> pd.DataFrame:
+    """Get a part of the debt service data from the IDS indicators"""
+    indicators = debt_service_parts[part]
 
-    """
-    # get bilateral amt data, split by concessional and non-concessional
-    bilateral_amt = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1] + 3,
-        total_indicator=outflow_indicators["bilateral_amt"][0],
-        concessional_indicator=outflow_indicators["bilateral_amt"][1],
-        indicator_prefix="bilateral",
-    )
-    # get bilateral int data, split by concessional and non-concessional
-    bilateral_int = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1] + 3,
-        total_indicator=outflow_indicators["bilateral_int"][0],
-        concessional_indicator=outflow_indicators["bilateral_int"][1],
-        indicator_prefix="bilateral",
-    )
+    # bilateral and multilateral, split by concessional and non-concessional
+    if part.endswith(("_amt", "_int")):
+        return get_concessional_non_concessional(
+            ids=ids,
+            total_indicator=indicators[0],
+            concessional_indicator=indicators[1],
+            indicator_prefix=part.rsplit("_", 1)[0],
+        )
 
-    # get multilateral amt data, split by concessional and non-concessional
-    multilateral_amt = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1] + 3,
-        total_indicator=outflow_indicators["multilateral_amt"][0],
-        concessional_indicator=outflow_indicators["multilateral_amt"][1],
-        indicator_prefix="multilateral",
-    )
-    # get multilateral int data, split by concessional and non-concessional
-    multilateral_int = get_concessional_non_concessional(
-        start_year=config.ANALYSIS_YEARS[0],
-        end_year=config.ANALYSIS_YEARS[1] + 3,
-        total_indicator=outflow_indicators["multilateral_int"][0],
-        concessional_indicator=outflow_indicators["multilateral_int"][1],
-        indicator_prefix="multilateral",
+    # bonds, banks and other private (principal and interest)
+    return pd.concat([ids[i] for i in indicators], ignore_index=True).pipe(
+        filter_and_assign_indicator, part
     )
 
-    # Load bonds, banks, and other private
-    ids = DebtIDS().load_data(
-        indicators=[
-            outflow_indicators["bonds_amt"],
-            outflow_indicators["banks_amt"],
-            outflow_indicators["other_private_amt"],
-            outflow_indicators["bonds_int"],
-            outflow_indicators["banks_int"],
-            outflow_indicators["other_private_int"],
-        ],
+
+def _build_debt_service_parts(parts: list[str]) -> dict[str, pd.DataFrame]:
+    """Load the IDS indicators for some parts (in a single pass) and clean them"""
+    ids = load_ids_indicators(
+        indicators=indicator_codes({part: debt_service_parts[part] for part in parts}),
         start_year=config.ANALYSIS_YEARS[0],
         end_year=config.ANALYSIS_YEARS[1] + 3,
     )
 
-    # Get bonds data
-    bonds = ids.get_data(
-        [outflow_indicators["bonds_amt"], outflow_indicators["bonds_int"]]
-    ).pipe(filter_and_assign_indicator, "bonds")
+    return {
+        part: _debt_service_part(ids, part)
+        .pipe(clean_debt_output)
+        .assign(indicator_type="outflow")
+        for part in parts
+    }
 
-    # Get banks data
-    banks = ids.get_data(
-        [outflow_indicators["banks_amt"], outflow_indicators["banks_int"]]
-    ).pipe(filter_and_assign_indicator, "banks")
 
-    # Get other private data
-    other_private = ids.get_data(
-        [
-            outflow_indicators["other_private_amt"],
-            outflow_indicators["other_private_int"],
-        ]
-    ).pipe(filter_and_assign_indicator, "other_private")
+def _debt_service_sources() -> list[str]:
+    return [ids_source(code) for code in indicator_codes(debt_service_parts)] + [
+        prices_source(),
+        "income_levels",
+    ]
 
-    # combine
-    data = (
-        pd.concat(
-            [
-                bilateral_amt,
-                bilateral_int,
-                multilateral_amt,
-                multilateral_int,
-                bonds,
-                banks,
-                other_private,
-            ],
-            ignore_index=True,
-        )
-        .pipe(clean_debt_output)
-        .assign(indicator_type="outflow")
+
+@disk_cache(sources=_debt_service_sources)
+def get_debt_service_data(
+    constant: bool = False, both_prices: bool = False
+) -> pd.DataFrame:
+    """
+    Retrieve debt service data to bilateral, multilateral,
+    bonds, banks, and other private entities.
+
+    Note: debt service combines principal and interest payments.
+
+    Each part of the data (e.g. bilateral principal payments) is cleaned and
+    cached separately, so only the parts whose IDS indicators changed are
+    loaded and cleaned again.
+
+    Args:
+        constant (bool): Whether to retrieve the data in constant or current prices.
+        both_prices (bool): Whether to retrieve both current and constant prices
+            (overrides `constant`).
+
+    Returns:
+        pd.DataFrame: DataFrame containing debt service data.
+
+    """
+    parts = cached_parts(
+        "debt_service",
+        {
+            part: [ids_source(code) for code in indicator_codes({part: codes})]
+            + ["income_levels"]
+            for part, codes in debt_service_parts.items()
+        },
+        _build_debt_service_parts,
     )
 
-    if constant:
-        data = to_constant_prices(data, config.CONSTANT_BASE_YEAR)
-    else:
-        data = data.assign(prices="current")
+    # combine
+    data = pd.concat(parts.values(), ignore_index=True).pipe(to_categorical)
+
+    data = assign_prices(data, constant=constant, both_prices=both_prices)
 
-    return data
+    return to_categorical(data)
 
 
 if __name__ == "__main__":
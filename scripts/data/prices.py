@@ -0,0 +1,363 @@
+"""Deflator tables to convert current prices to constant prices.
+
+pydeflate combines a price deflator and exchange rates into a single deflator for
+each country (or DAC donor) and year. Instead of running pydeflate over the data for
+every constant prices request, the deflators are stored as a small table per source,
+base year and currency in `Paths.cache`. Converting to constant prices is then a
+lookup on (entity, year) and a division, and several base years (or currencies) can
+be added to the same data as extra value columns.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+from importlib.metadata import version
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts import config
+from scripts.config import logger
+from scripts.data.fetch import set_data_paths
+from scripts.data.manifest import FILE_SOURCES, prices_source
+from scripts.data.sources import ensure_source
+
+set_data_paths()
+
+# pydeflate source class and the prefix of the files it stores in raw_data
+SOURCES: dict[str, tuple[str, str]] = {
+    "imf": ("IMF", "weo"),
+    "wb": ("WorldBank", "wb"),
+    "world_bank": ("WorldBank", "wb"),
+    "oecd_dac": ("DAC", "dac"),
+    "dac": ("DAC", "dac"),
+}
+
+DEFLATOR_COLUMNS: list[str] = ["year", "entity", "deflator"]
+
+# The pydeflate versions (from, up to but excluding) whose deflator data is read by
+# `_pydeflate_deflators`. pydeflate is pinned to this range in pyproject.toml.
+PYDEFLATE_VERSIONS: tuple[tuple[int, int], tuple[int, int]] = ((2, 1), (2, 6))
+
+
+def _source(source: str | None) -> str:
+    source = (source or config.PRICES_SOURCE).lower()
+    if source not in SOURCES:
+        raise ValueError(f"source must be one of {list(SOURCES)}")
+
+    return source
+
+
+def pydeflate_files(source: str) -> list[Path]:
+    """The data files pydeflate stored in raw_data for a source (as listed for its
+    source in the manifest, for every supported pydeflate version)"""
+    patterns = FILE_SOURCES[prices_source(source)]
+
+    return sorted(
+        {file for pattern in patterns for file in config.Paths.raw_data.glob(pattern)}
+    )
+
+
+def source_vintage(source: str) -> str:
+    """The vintage of the data pydeflate uses for a source: a hash of the pydeflate
+    version and the names and modification times of its data files (pydeflate 2.2
+    and later keep the same file name when the data is updated).
+
+    Returns 'none', and logs a warning, if pydeflate has no data for it yet.
+    """
+    files = pydeflate_files(source)
+
+    if not files:
+        logger.warning(
+            f"No pydeflate data for {source} in {config.Paths.raw_data}, so the "
+            "deflators can't be matched to its vintage"
+        )
+        return "none"
+
+    state = [version("pydeflate")] + [
+        (str(file.relative_to(config.Paths.raw_data)), file.stat().st_mtime_ns)
+        for file in files
+    ]
+
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()[:16]
+
+
+def _deflator_file(
+    source: str, base_year: int, currency: str, use_source_codes: bool
+) -> Path:
+    entity = "code" if use_source_codes else "iso3"
+    name = f"{source}_{base_year}_{currency}_{entity}_{source_vintage(source)}"
+
+    return config.Paths.cache / "deflators" / f"{name}.parquet"
+
+
+def _check_pydeflate_version() -> None:
+    """Raise an error if the installed pydeflate is not one of `PYDEFLATE_VERSIONS`"""
+    installed = version("pydeflate")
+    major_minor = tuple(int(part) for part in installed.split(".")[:2])
+    first, last = PYDEFLATE_VERSIONS
+
+    if not first <= major_minor < last:
+        raise RuntimeError(
+            f"pydeflate {installed} is not supported. Install "
+            f"pydeflate>={'.'.join(map(str, first))},<{'.'.join(map(str, last))} "
+            "(as in pyproject.toml)."
+        )
+
+
+def _pydeflate_deflators(
+    source: str, base_year: int, currency: str, use_source_codes: bool
+) -> pd.DataFrame:
+    """The deflator data pydeflate computes for a source (from US dollars to the
+    target currency).
+
+    pydeflate only exposes functions which deflate a DataFrame, so the deflators
+    are read from its `BaseDeflate.pydeflate_data`. That is not part of its public
+    API, so the installed version is checked first.
+    """
+    _check_pydeflate_version()
+
+    from pydeflate.core import source as sources
+    from pydeflate.core.api import BaseDeflate
+
+    source_class = getattr(sources, SOURCES[source][0])
+
+    deflator = BaseDeflate(
+        base_year=base_year,
+        deflator_source=source_class(),
+        exchange_source=source_class(),
+        source_currency="USD",
+        target_currency=currency,
+        price_kind="NGDP_D",
+        use_source_codes=use_source_codes,
+    )
+
+    entity = "pydeflate_entity_code" if use_source_codes else "pydeflate_iso3"
+
+    return deflator.pydeflate_data.filter(
+        ["pydeflate_year", entity, "pydeflate_deflator"]
+    )
+
+
+def _build_deflator_table(
+    source: str, base_year: int, currency: str, use_source_codes: bool
+) -> pd.DataFrame:
+    """Compute the deflators with pydeflate (from US dollars to the target currency)"""
+    logger.info(f"Building {source} deflators ({base_year}, {currency})")
+
+    return (
+        _pydeflate_deflators(source, base_year, currency, use_source_codes)
+        .set_axis(DEFLATOR_COLUMNS, axis=1)
+        .astype({"year": "int32", "deflator": "float64"})
+        .drop_duplicates(subset=["year", "entity"])
+        .reset_index(drop=True)
+    )
+
+
+def deflator_table(
+    base_year: int,
+    source: str | None = None,
+    currency: str = "USD",
+    use_source_codes: bool = False,
+) -> pd.DataFrame:
+    """Get the deflators for a source, base year and currency.
+
+    The table is computed once and stored, keyed by the vintage of the source data.
+
+    Args:
+        base_year (int): The base year of the constant prices.
+        source (str, optional): The deflator and exchange source. Defaults to
+            `config.PRICES_SOURCE`.
+        currency (str): The target currency (e.g. 'USD' or 'LCU'). The data is
+            assumed to be in US dollars.
+        use_source_codes (bool): Whether the entities are the source's own codes
+            (e.g. DAC donor codes) instead of ISO3 codes.
+
+    Returns:
+        pd.DataFrame: A DataFrame with year, entity and deflator columns.
+    """
+    source = _source(source)
+    ensure_source("prices")
+
+    # Without pydeflate data there is no vintage, so nothing can be stored for it
+    if pydeflate_files(source):
+        try:
+            return pd.read_parquet(
+                _deflator_file(source, base_year, currency, use_source_codes)
+            )
+        except FileNotFoundError:
+            pass
+
+    table = _build_deflator_table(source, base_year, currency, use_source_codes)
+
+    # pydeflate may have downloaded the source data, which changes the vintage
+    file = _deflator_file(source, base_year, currency, use_source_codes)
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    table.to_parquet(tmp)
+    os.replace(tmp, file)
+
+    return table
+
+
+def constant_column(base_year: int, currency: str = "USD") -> str:
+    """The name of the value column for constant prices in a base year and currency"""
+    suffix = "" if currency == "USD" else f"_{currency.lower()}"
+
+    return f"value_constant_{base_year}{suffix}"
+
+
+def _entity_keys(values: pd.Series, use_source_codes: bool) -> np.ndarray:
+    if use_source_codes:
+        return pd.to_numeric(values, errors="coerce").to_numpy(dtype="float64")
+
+    return values.to_numpy(dtype="object")
+
+
+def add_constant_prices(
+    data: pd.DataFrame,
+    base_years: int | list[int] | None = None,
+    currencies: list[str] | None = None,
+    source: str | None = None,
+    id_column: str = "iso_code",
+    use_source_codes: bool = False,
+    value_column: str = "value",
+) -> pd.DataFrame:
+    """Add constant prices value columns to data in current US dollars.
+
+    The (entity, year) keys of the data are matched to each deflator table once,
+    and each value column is computed as `value / deflator`. Rows without a
+    deflator get a missing value (as with pydeflate).
+
+    Args:
+        data (pd.DataFrame): The data, with a 'year' column (as integer).
+        base_years (int | list[int], optional): The base years. Defaults to
+            `config.CONSTANT_BASE_YEAR`.
+        currencies (list[str], optional): The target currencies. Defaults to USD.
+            Include 'LCU' for local currency units.
+        source (str, optional): The deflator source. Defaults to
+            `config.PRICES_SOURCE`.
+        id_column (str): The column with the entity (ISO3 code or source code).
+        use_source_codes (bool): Whether `id_column` has the source's own codes.
+        value_column (str): The column with the current prices values.
+
+    Returns:
+        pd.DataFrame: The data with one column per base year and currency, named by
+        `constant_column`.
+    """
+    if base_years is None:
+        base_years = [config.CONSTANT_BASE_YEAR]
+    elif isinstance(base_years, int):
+        base_years = [base_years]
+
+    currencies = currencies or ["USD"]
+
+    keys = pd.MultiIndex.from_arrays(
+        [
+            _entity_keys(data[id_column], use_source_codes),
+            data["year"].to_numpy(dtype="int64"),
+        ]
+    )
+    values = data[value_column].to_numpy(dtype="float64")
+
+    columns = {}
+    for base_year in base_years:
+        for currency in currencies:
+            table = deflator_table(base_year, source, currency, use_source_codes)
+            positions = pd.MultiIndex.from_arrays(
+                [
+                    _entity_keys(table["entity"], use_source_codes),
+                    table["year"].to_numpy(dtype="int64"),
+                ]
+            ).get_indexer(keys)
+
+            # Keys without a deflator have position -1, which picks the NaN
+            deflators = np.append(table["deflator"].to_numpy(), np.nan)[positions]
+
+            columns[constant_column(base_year, currency)] = np.round(
+                values / deflators, 6
+            )
+
+    return data.assign(**columns)
+
+
+def to_constant_prices(
+    data: pd.DataFrame,
+    base_year: int,
+    source: str | None = None,
+    id_column: str = "iso_code",
+    use_source_codes: bool = False,
+) -> pd.DataFrame:
+    """Convert the value column of data in current US dollars to constant prices.
+
+    Args:
+        data (pd.DataFrame): The data, with 'year' and 'value' columns.
+        base_year (int): The base year against which the prices will be deflated.
+        source (str, optional): The deflator source. Defaults to
+            `config.PRICES_SOURCE`.
+        id_column (str): The column with the entity (ISO3 code or source code).
+        use_source_codes (bool): Whether `id_column` has the source's own codes.
+
+    Returns:
+        pd.DataFrame: The data in constant prices, with prices set to 'constant'.
+    """
+    data = add_constant_prices(
+        data,
+        base_years=base_year,
+        source=source,
+        id_column=id_column,
+        use_source_codes=use_source_codes,
+    )
+    data["value"] = data.pop(constant_column(base_year))
+
+    return data.assign(prices="constant")
+
+
+def split_prices(data: pd.DataFrame, base_year: int) -> pd.DataFrame:
+    """Split data with current prices in 'value' and constant prices in the
+    `constant_column` of the base year into rows with a 'prices' column."""
+    column = constant_column(base_year)
+
+    current = data.drop(columns=column).assign(prices="current")
+    constant = (
+        data.drop(columns="value")
+        .rename(columns={column: "value"})
+        .filter(current.columns)
+        .assign(prices="constant")
+    )
+
+    return pd.concat([current, constant], ignore_index=True)
+
+
+def assign_prices(
+    data: pd.DataFrame,
+    constant: bool = False,
+    both_prices: bool = False,
+    base_year: int | None = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """Return data in current US dollars in current prices, constant prices or both.
+
+    Args:
+        data (pd.DataFrame): The data, in current US dollars.
+        constant (bool): Whether to convert to constant prices.
+        both_prices (bool): Whether to return both current and constant prices (as
+            rows, with a 'prices' column). The deflators are applied in one pass.
+            Overrides `constant`.
+        base_year (int, optional): The base year. Defaults to
+            `config.CONSTANT_BASE_YEAR`.
+        **kwargs: Passed to `add_constant_prices` (source, id_column, etc).
+    """
+    base_year = base_year or config.CONSTANT_BASE_YEAR
+
+    if both_prices:
+        data = add_constant_prices(data, base_years=base_year, **kwargs)
+        return split_prices(data, base_year)
+
+    if constant:
+        return to_constant_prices(data, base_year, **kwargs)
+
+    return data.assign(prices="current")
@@ -0,0 +1,212 @@
+"""Registry of where each data source comes from.
+
+Each source (IDS, OECD DAC, deflators, WEO and UN population) can be:
+
+- "live": downloaded by the library which handles it (bblocks, oda_data, pydeflate)
+  or from the UN API.
+- "mirror": copied from a local folder, `config.MIRROR_PATH/<source>`, instead of
+  downloaded. The files in the folder are copied into `raw_data` keeping their
+  relative paths (so `mirror/ids/ids_data/...` ends up in `raw_data/ids_data/...`).
+  Nothing is downloaded, so the pipeline can run offline.
+- "cache": for the sources requested over HTTP by this project (the UN API), every
+  response is recorded in `Paths.cache/http`. Later requests are revalidated with
+  the ETag and Last-Modified headers, and the recorded response is reused when the
+  server says it has not changed.
+- "replay": like "cache", but only the recorded responses are used (offline).
+
+The mode of each source is set in `config.SOURCE_MODES`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+import requests
+
+from scripts import config
+from scripts.config import logger
+
+MODES: list[str] = ["live", "mirror", "cache", "replay"]
+
+# Sources which are requested over HTTP by this project (so they can be cached)
+HTTP_SOURCES: list[str] = ["un_population"]
+
+_lock = threading.Lock()
+_synced: set[str] = set()
+
+
+class OfflineError(RuntimeError):
+    """Raised when a source would need to be downloaded in an offline mode"""
+
+
+def source_mode(source: str) -> str:
+    """The mode of a source, as set in `config.SOURCE_MODES` (defaults to 'live')"""
+    mode = config.SOURCE_MODES.get(source, "live")
+
+    if mode not in MODES:
+        raise ValueError(f"The mode of {source} must be one of {MODES}")
+    if mode in ["cache", "replay"] and source not in HTTP_SOURCES:
+        raise ValueError(f"{source} is not requested over HTTP, so it can't be cached")
+
+    return mode
+
+
+def is_offline(source: str) -> bool:
+    """Whether a source must not be downloaded"""
+    return source_mode(source) in ["mirror", "replay"]
+
+
+def mirror_path(source: str) -> Path:
+    return Path(config.MIRROR_PATH) / source
+
+
+def _is_copy_of(target: Path, file: Path) -> bool:
+    """Whether a file was already copied: it has the same size and modification
+    time (which the copy keeps)"""
+    try:
+        copied = target.stat()
+    except FileNotFoundError:
+        return False
+
+    original = file.stat()
+
+    return (copied.st_size, copied.st_mtime_ns) == (
+        original.st_size,
+        original.st_mtime_ns,
+    )
+
+
+def _sync_mirror(source: str) -> None:
+    """Copy the files of a source from its mirror folder into raw_data. Files which
+    are already there (see `_is_copy_of`) are not copied again."""
+    folder = mirror_path(source)
+
+    if not folder.exists():
+        raise OfflineError(f"There is no mirror for {source} at {folder}")
+
+    copied = 0
+    for file in folder.rglob("*"):
+        if not file.is_file():
+            continue
+
+        target = config.Paths.raw_data / file.relative_to(folder)
+        if _is_copy_of(target, file):
+            continue
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.parent / f".{target.name}.{uuid.uuid4().hex}.tmp"
+        shutil.copy2(file, tmp)
+        os.replace(tmp, target)
+        copied += 1
+
+    logger.debug(f"Copied {copied} files for {source} from {folder}")
+
+
+def ensure_source(source: str) -> None:
+    """Make a source available in raw_data before it is read.
+
+    In "mirror" mode, the mirror folder is copied into raw_data (once per process).
+    In the other modes, this does nothing: the files are downloaded when they are
+    needed.
+    """
+    if source_mode(source) != "mirror":
+        return
+
+    with _lock:
+        if source not in _synced:
+            _sync_mirror(source)
+            _synced.add(source)
+
+
+def _entry_file(url: str) -> Path:
+    return config.Paths.cache / "http" / f"{hashlib.sha256(url.encode()).hexdigest()}"
+
+
+def _read_entry(url: str) -> dict | None:
+    try:
+        with open(_entry_file(url).with_suffix(".json"), "r") as f:
+            entry = json.load(f)
+        entry["content"] = _entry_file(url).with_suffix(".body").read_bytes()
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    return entry
+
+
+def _write_entry(url: str, response: requests.Response) -> None:
+    file = _entry_file(url)
+    file.parent.mkdir(parents=True, exist_ok=True)
+
+    entry = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_type": response.headers.get("Content-Type"),
+    }
+
+    # The body is written first, so an entry is never found without it
+    for suffix, content in [
+        (".body", response.content),
+        (".json", json.dumps(entry).encode()),
+    ]:
+        tmp = file.parent / f".{file.name}.{uuid.uuid4().hex}.tmp"
+        tmp.write_bytes(content)
+        os.replace(tmp, file.with_suffix(suffix))
+
+
+def _recorded_response(url: str, entry: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = entry["content"]
+    if entry.get("content_type"):
+        response.headers["Content-Type"] = entry["content_type"]
+
+    return response
+
+
+def http_get(
+    session: requests.Session, url: str, source: str, timeout: float | None = None
+) -> requests.Response:
+    """Request a URL for a source, following its mode.
+
+    In "cache" mode, a recorded response is revalidated (with If-None-Match and
+    If-Modified-Since) and reused if the server answers 304 Not Modified. New
+    successful responses are recorded. In "replay" mode, only recorded responses
+    are used.
+
+    Raises:
+        OfflineError: In "replay" mode, if the response was not recorded.
+    """
+    mode = source_mode(source)
+
+    if mode == "live":
+        return session.get(url, timeout=timeout)
+
+    entry = _read_entry(url)
+
+    if is_offline(source):
+        if entry is None:
+            raise OfflineError(f"No recorded response for {url}")
+        return _recorded_response(url, entry)
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url, timeout=timeout, headers=headers)
+
+    if response.status_code == 304 and entry is not None:
+        return _recorded_response(url, entry)
+
+    if response.status_code == 200:
+        _write_entry(url, response)
+
+    return response
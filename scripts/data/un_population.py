@@ -0,0 +1,299 @@
+"""Download paged JSON data from the UN Population Data Portal API.
+
+The API returns the data in pages. The first page of each query says how many pages
+there are, so the other pages are requested concurrently (on a pooled HTTP session,
+with at most `config.DOWNLOAD_WORKERS` requests in flight). Failed requests are
+retried with exponential backoff.
+
+Every page is stored as a checkpoint in `raw_data/.un_population` as soon as it is
+downloaded. If a download is interrupted, running it again only requests the pages
+which are missing. The checkpoints of a query are removed once its data is saved.
+
+Population data is streamed to Parquet: each page is converted to an Arrow record
+batch with a fixed schema (only the columns the analysis reads) and appended to the
+file, so the pages are never held in memory all at once.
+
+The responses can be recorded and replayed offline, by setting the mode of the
+'un_population' source in `config.SOURCE_MODES` (see `scripts.data.sources`).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import uuid
+from pathlib import Path
+from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+from requests.adapters import HTTPAdapter
+
+from scripts import config
+from scripts.config import logger
+from scripts.data.sources import http_get
+
+CHECKPOINTS = config.Paths.raw_data / ".un_population"
+
+MAX_RETRIES: int = 5
+BACKOFF_SECONDS: float = 1.0
+TIMEOUT_SECONDS: float = 60.0
+
+# Responses which are worth retrying (rate limits and server errors)
+RETRY_STATUS: set[int] = {429, 500, 502, 503, 504}
+
+# The columns of the population data which are stored (the API returns about 30)
+POPULATION_SCHEMA = pa.schema(
+    [
+        ("locationId", pa.int32()),
+        ("location", pa.string()),
+        ("iso3", pa.string()),
+        ("indicatorId", pa.int32()),
+        ("indicator", pa.string()),
+        ("variant", pa.string()),
+        ("variantLabel", pa.string()),
+        ("timeLabel", pa.int32()),
+        ("sex", pa.string()),
+        ("ageStart", pa.int32()),
+        ("ageEnd", pa.int32()),
+        ("value", pa.float64()),
+    ]
+)
+
+
+def create_session(pool_size: int | None = None) -> requests.Session:
+    """Create an HTTP session with a connection pool for concurrent requests.
+
+    If the `UN_POPULATION_TOKEN` environment variable is set, it is sent as a
+    bearer token.
+    """
+    pool_size = pool_size or config.DOWNLOAD_WORKERS
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json"})
+
+    if token := os.environ.get("UN_POPULATION_TOKEN"):
+        session.headers.update({"Authorization": f"Bearer {token}"})
+
+    return session
+
+
+def page_url(url: str, page: int) -> str:
+    """Set the page number of a query URL"""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query)) | {"pageNumber": str(page)}
+
+    return urlunsplit(parts._replace(query=urlencode(query, safe=",")))
+
+
+def total_pages(response: dict) -> int | None:
+    """The number of pages of a query, if the response says so"""
+    for key in ["pages", "totalPages"]:
+        if response.get(key) is not None:
+            return int(response[key])
+
+    return None
+
+
+def _checkpoint_folder(url: str) -> Path:
+    return CHECKPOINTS / hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+def _read_checkpoint(folder: Path, page: int) -> dict | None:
+    try:
+        with open(folder / f"{page}.json", "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_checkpoint(folder: Path, page: int, response: dict) -> None:
+    folder.mkdir(parents=True, exist_ok=True)
+
+    tmp = folder / f".{page}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(response, f)
+    os.replace(tmp, folder / f"{page}.json")
+
+
+async def fetch_json(
+    session: requests.Session, url: str, semaphore: asyncio.Semaphore
+) -> dict:
+    """Request a URL and return the JSON response, retrying failed requests.
+
+    The request runs on a thread (as the session is blocking). Connection errors
+    and the status codes in `RETRY_STATUS` are retried up to `MAX_RETRIES` times,
+    waiting `BACKOFF_SECONDS` (with jitter) twice as long after each attempt.
+
+    Depending on the mode of the 'un_population' source, the response may come
+    from the HTTP cache (see `scripts.data.sources`).
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with semaphore:
+                response = await asyncio.to_thread(
+                    http_get, session, url, "un_population", TIMEOUT_SECONDS
+                )
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response.json()
+            error = requests.HTTPError(f"{response.status_code} for {url}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt == MAX_RETRIES - 1:
+            raise error
+
+        delay = BACKOFF_SECONDS * 2**attempt * (1 + random.random())
+        logger.warning(f"Retrying {url} in {delay:.1f}s ({error})")
+        await asyncio.sleep(delay)
+
+
+async def _get_page(
+    session: requests.Session,
+    url: str,
+    page: int,
+    folder: Path,
+    semaphore: asyncio.Semaphore,
+) -> dict:
+    """Get a page from its checkpoint or, if there isn't one, from the API"""
+    if (response := _read_checkpoint(folder, page)) is not None:
+        return response
+
+    response = await fetch_json(session, url, semaphore)
+    _write_checkpoint(folder, page, response)
+
+    return response
+
+
+async def download_pages(
+    session: requests.Session,
+    url: str,
+    semaphore: asyncio.Semaphore,
+    write: Callable[[list[dict]], None],
+) -> int:
+    """Download all the pages of a query and pass their data records to `write`.
+
+    The pages are requested concurrently, but written in order, each as soon as it
+    and the pages before it have arrived. If the first page does not say how many
+    pages there are, the pages are followed one by one through their `nextPage`
+    links.
+
+    Returns:
+        int: The number of pages.
+    """
+    folder = _checkpoint_folder(url)
+
+    page = await _get_page(session, url, 1, folder, semaphore)
+    write(page["data"])
+    count = 1
+
+    if (pages := total_pages(page)) is not None:
+        tasks = [
+            asyncio.ensure_future(
+                _get_page(session, page_url(url, n), n, folder, semaphore)
+            )
+            for n in range(2, pages + 1)
+        ]
+        try:
+            for task in tasks:
+                write((await task)["data"])
+                count += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+    else:
+        while page.get("nextPage"):
+            count += 1
+            page = await _get_page(session, page["nextPage"], count, folder, semaphore)
+            write(page["data"])
+
+    logger.debug(f"Downloaded {count} pages from {url}")
+
+    return count
+
+
+def _clear_checkpoints(urls: list[str]) -> None:
+    for url in urls:
+        shutil.rmtree(_checkpoint_folder(url), ignore_errors=True)
+
+
+async def _download_all(
+    urls: list[str], write: Callable[[list[dict]], None]
+) -> list[int]:
+    semaphore = asyncio.Semaphore(config.DOWNLOAD_WORKERS)
+
+    with create_session() as session:
+        return await asyncio.gather(
+            *(download_pages(session, url, semaphore, write) for url in urls)
+        )
+
+
+def download_queries(urls: list[str]) -> pd.DataFrame:
+    """Download several paged queries concurrently and return all their records.
+
+    Use this for small queries (like the list of locations). Population data should
+    be streamed to a file with `download_to_parquet`.
+
+    Args:
+        urls (list[str]): The query URLs (for the first page).
+    """
+    records = []
+    asyncio.run(_download_all(urls, records.extend))
+
+    data = pd.json_normalize(records)
+    _clear_checkpoints(urls)
+
+    return data
+
+
+def to_record_batch(records: list[dict], schema: pa.Schema) -> pa.RecordBatch:
+    """Convert data records to a record batch with a fixed schema.
+
+    Fields which are not in the schema are dropped and missing fields are null.
+    """
+    arrays = [
+        pa.array([record.get(field.name) for record in records]).cast(field.type)
+        for field in schema
+    ]
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def download_to_parquet(
+    urls: list[str], path: Path, schema: pa.Schema = POPULATION_SCHEMA
+) -> None:
+    """Download several paged queries concurrently, streaming them to a Parquet file.
+
+    Each page is appended to the file as a record batch. The file is written under
+    a temporary name and moved in place once all the pages have been written.
+
+    Args:
+        urls (list[str]): The query URLs (for the first page).
+        path (Path): The Parquet file to write.
+        schema (pa.Schema): The columns (and types) to keep.
+    """
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+
+    try:
+        with pq.ParquetWriter(tmp, schema) as writer:
+
+            def write(records: list[dict]) -> None:
+                if records:
+                    writer.write_batch(to_record_batch(records, schema))
+
+            asyncio.run(_download_all(urls, write))
+
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    _clear_checkpoints(urls)
@@ -0,0 +1,406 @@
+"""Run the analysis stages in order, in parallel and only when needed.
+
+Each output of the project is produced by a stage: a function (usually the body of
+one of the `__main__` blocks) with the files it reads from `Paths.output`, the files
+it writes there and the code it depends on. The runner:
+
+- works out the order of the stages from their inputs and outputs, and runs the
+  stages which don't depend on each other at the same time, on a process pool;
+- skips stages whose fingerprint (their code, their input files and, for the stages
+  which load data, the state of `raw_data`) has not changed since they last ran,
+  as long as their outputs still exist;
+- records each stage as soon as it finishes, so after a failure the next run starts
+  again from the stages which did not complete.
+
+Usage:
+    python -m scripts.pipeline                 # run everything that is out of date
+    python -m scripts.pipeline charts_1        # a stage (and what it depends on)
+    python -m scripts.pipeline --force         # run every stage again
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from scripts import config
+from scripts.config import logger
+
+STATE_FILE = config.Paths.cache / "pipeline_state.json"
+
+# Code used by the stages which load and clean the data (relative to Paths.scripts)
+DATA_CODE: tuple = ("config.py", "data/*.py", "analysis/common.py")
+
+# The code of the stages which use net_flows.py (and the modules it imports)
+NET_FLOWS_CODE: tuple = (
+    "analysis/net_flows.py",
+    "analysis/cube.py",
+    "analysis/panel.py",
+)
+
+
+def _load_data() -> None:
+    """Record which raw sources changed and fill the disk cache with the data the
+    analysis stages load, so they don't each clean it at the same time."""
+    from scripts.data.manifest import refresh
+
+    refresh()
+
+
+def _debt_inflows() -> None:
+    from scripts.data.inflows import export_debt_inflows
+
+    export_debt_inflows(constant=False)
+
+
+def _net_flows() -> None:
+    from scripts.analysis.net_flows import all_flows_pipeline, create_scatter_data
+
+    create_scatter_data(all_flows_pipeline())
+
+
+def _net_flow_projections() -> None:
+    from scripts.analysis.net_flow_projections import projections_pipline
+
+    projections_pipline()
+
+
+def _negative_net_flows() -> None:
+    from scripts.analysis.negative_net_flows import output_pipeline
+
+    output_pipeline()
+
+
+def _debt_service() -> None:
+    from scripts.analysis.debt_service import avg_repayments_charts
+
+    avg_repayments_charts()
+
+
+def _charts_1() -> None:
+    from scripts.charts_1 import chart_1_1, chart_1_2
+
+    chart_1_1()
+    chart_1_2()
+
+
+def _chart_2_1() -> None:
+    # The module name starts with a digit, so it can't be imported with `import`
+    module = importlib.import_module("scripts.analysis.2_1_negative_net_flows")
+
+    data = module.get_parquet(file_name="full_flows_country.parquet")
+    chart = module.flourish_1_beeswarm_pipeline(df=data)
+    chart.to_csv(config.Paths.output / "chart_2_1.csv", index=False)
+
+
+def _key_numbers() -> None:
+    from scripts.analysis import paper_key_numbers as numbers
+
+    numbers.net_flows_dev_countries_summary()
+    numbers.upper_middle_income_nt_numbers()
+    numbers.lower_middle_income_nt_projection_numbers()
+    numbers.negative_nt_counts_numbers()
+    numbers.debt_service_numbers()
+    numbers.china_lending_numbers()
+    numbers.private_lending_numbers()
+
+
+_NET_FLOWS_FILES = [
+    f"{kind}_{level}{suffix}.parquet"
+    for kind in ["full_flows", "net_flows", "summary_flows", "summary_net_flows"]
+    for level in ["country", "grouping"]
+    for suffix in ["", "_china_as_counterpart_type"]
+]
+
+# The stages of the analysis.
+# - run: the function which runs the stage.
+# - code: the files (or glob patterns) in Paths.scripts the stage depends on.
+# - inputs / outputs: the files in Paths.output the stage reads and writes.
+# - raw_data: whether the stage loads data (so it depends on the state of raw_data).
+# - after: other stages which must run first, besides those producing its inputs.
+STAGES: dict[str, dict] = {
+    "data": {
+        "run": _load_data,
+        "code": DATA_CODE,
+        "raw_data": True,
+    },
+    "debt_inflows": {
+        "run": _debt_inflows,
+        "code": DATA_CODE,
+        "outputs": ["debt_inflows_country.parquet"],
+        "raw_data": True,
+        "after": ["data"],
+    },
+    "net_flows": {
+        "run": _net_flows,
+        "code": DATA_CODE + NET_FLOWS_CODE,
+        "outputs": _NET_FLOWS_FILES + ["scatter_totals.csv"],
+        "raw_data": True,
+        "after": ["data"],
+    },
+    "net_flow_projections": {
+        "run": _net_flow_projections,
+        "code": DATA_CODE + NET_FLOWS_CODE + ("analysis/net_flow_projections.py",),
+        "outputs": [
+            "net_flow_projections_group.parquet",
+            "net_flow_projections_country.parquet",
+            "inflows_outflows_projected_country.parquet",
+        ],
+        "raw_data": True,
+        "after": ["data"],
+    },
+    "negative_net_flows": {
+        "run": _negative_net_flows,
+        "code": DATA_CODE
+        + NET_FLOWS_CODE
+        + (
+            "analysis/negative_net_flows.py",
+            "analysis/population_tools.py",
+        ),
+        "outputs": [
+            "net_negative_flows_country.parquet",
+            "net_negative_flows_group.parquet",
+        ],
+        "raw_data": True,
+        "after": ["data"],
+    },
+    "debt_service": {
+        "run": _debt_service,
+        "code": DATA_CODE + ("analysis/debt_service.py",),
+        "outputs": ["avg_repayments.csv", "avg_repayments_china.csv"],
+        "raw_data": True,
+        "after": ["data"],
+    },
+    "charts_1": {
+        "run": _charts_1,
+        "code": ("config.py", "charts_1.py"),
+        "inputs": [
+            "net_flows_grouping.parquet",
+            "net_flows_country.parquet",
+            "net_flow_projections_group.parquet",
+            "net_flow_projections_country.parquet",
+            "full_flows_grouping.parquet",
+            "full_flows_country.parquet",
+        ],
+        "outputs": ["chart_1_1.csv", "chart_1_2.csv"],
+    },
+    "chart_2_1": {
+        "run": _chart_2_1,
+        "code": DATA_CODE + ("analysis/panel.py", "analysis/2_1_negative_net_flows.py"),
+        "inputs": [
+            "full_flows_country.parquet",
+            "net_flow_projections_country.parquet",
+        ],
+        "outputs": ["chart_2_1.csv"],
+        "raw_data": True,
+    },
+    "key_numbers": {
+        "run": _key_numbers,
+        "code": DATA_CODE
+        + NET_FLOWS_CODE
+        + (
+            "analysis/paper_key_numbers.py",
+            "analysis/population_tools.py",
+        ),
+        "inputs": [
+            "net_flows_grouping.parquet",
+            "net_flows_country.parquet",
+            "net_flow_projections_group.parquet",
+            "net_flow_projections_country.parquet",
+            "full_flows_country.parquet",
+            "debt_inflows_country.parquet",
+            "inflows_outflows_projected_country.parquet",
+        ],
+        "outputs": ["key_numbers.json"],
+        "raw_data": True,
+    },
+}
+
+
+def dependencies(name: str) -> set[str]:
+    """The stages which must complete before a stage can run"""
+    stage = STAGES[name]
+    producers = {
+        output: other
+        for other, spec in STAGES.items()
+        for output in spec.get("outputs", [])
+    }
+
+    return {
+        producers[file] for file in stage.get("inputs", []) if file in producers
+    } | set(stage.get("after", []))
+
+
+def _with_dependencies(names: list[str]) -> set[str]:
+    """The stages and all the stages they depend on"""
+    selected, pending = set(), list(names)
+
+    while pending:
+        name = pending.pop()
+        if name not in STAGES:
+            raise ValueError(f"Unknown stage '{name}'. Stages: {list(STAGES)}")
+        if name not in selected:
+            selected.add(name)
+            pending.extend(dependencies(name))
+
+    return selected
+
+
+def _file_hash(path: Path) -> str | None:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def stage_fingerprint(name: str) -> str:
+    """Create a fingerprint of everything a stage depends on.
+
+    The fingerprint covers the contents of the stage's code and input files, the
+    analysis settings in `config` and, for stages which load data, the state of the
+    raw data folder.
+    """
+    from scripts.data.cache import raw_data_signature
+
+    stage = STAGES[name]
+
+    code = sorted(
+        {
+            str(path.relative_to(config.Paths.scripts))
+            for pattern in stage["code"]
+            for path in config.Paths.scripts.glob(pattern)
+        }
+    )
+
+    payload = {
+        "stage": name,
+        "code": {file: _file_hash(config.Paths.scripts / file) for file in code},
+        "inputs": {
+            file: _file_hash(config.Paths.output / file)
+            for file in stage.get("inputs", [])
+        },
+        "analysis_years": list(config.ANALYSIS_YEARS),
+        "constant_base_year": config.CONSTANT_BASE_YEAR,
+        "prices_source": config.PRICES_SOURCE,
+        "raw_data": raw_data_signature() if stage.get("raw_data") else None,
+    }
+
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def read_state() -> dict:
+    """The fingerprint of each stage when it last completed"""
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_state(state: dict) -> None:
+    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = STATE_FILE.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(tmp, STATE_FILE)
+
+
+def is_up_to_date(name: str, state: dict) -> bool:
+    """Whether a stage has completed with its current fingerprint and all its
+    outputs still exist"""
+    outputs = STAGES[name].get("outputs", [])
+
+    return state.get(name) == stage_fingerprint(name) and all(
+        (config.Paths.output / file).exists() for file in outputs
+    )
+
+
+def _run_stage(name: str) -> None:
+    """Run a stage (in a worker process)"""
+    from scripts.data.fetch import set_data_paths
+
+    set_data_paths()
+    STAGES[name]["run"]()
+
+
+def run_pipeline(
+    stages: list[str] | None = None, force: bool = False, workers: int | None = None
+) -> None:
+    """Run the stages which are out of date, in order.
+
+    Stages whose dependencies have completed are submitted to a process pool as soon
+    as possible. Each stage is recorded (with its fingerprint) when it completes, so
+    if a stage fails, the next run only runs it and the stages after it.
+
+    Args:
+        stages (list[str], optional): The stages to run (with the stages they
+            depend on). Defaults to all the stages.
+        force (bool): Whether to run the stages even if they are up to date.
+        workers (int, optional): The number of processes. Defaults to
+            `config.PIPELINE_WORKERS`.
+    """
+    pending = _with_dependencies(stages or list(STAGES))
+    state = read_state()
+    done, failed, running = set(), set(), {}
+
+    with ProcessPoolExecutor(max_workers=workers or config.PIPELINE_WORKERS) as pool:
+        while pending or running:
+            progress = False
+            for name in sorted(pending):
+                if dependencies(name) & failed:
+                    logger.warning(f"Skipping {name}: a stage it depends on failed")
+                    pending.discard(name)
+                    failed.add(name)
+                    progress = True
+                elif dependencies(name) <= done:
+                    pending.discard(name)
+                    progress = True
+                    if not force and is_up_to_date(name, state):
+                        logger.info(f"{name} is up to date")
+                        done.add(name)
+                    else:
+                        logger.info(f"Running {name}")
+                        running[pool.submit(_run_stage, name)] = name
+
+            if not running:
+                if not progress:
+                    raise RuntimeError(f"Stages with circular inputs: {pending}")
+                # Stages skipped as up to date may have unblocked others
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    logger.error(f"{name} failed: {error!r}")
+                    failed.add(name)
+                    continue
+
+                # Fingerprint after the run, as it may have downloaded new raw data
+                state[name] = stage_fingerprint(name)
+                _write_state(state)
+                done.add(name)
+                logger.info(f"{name} completed")
+
+    if failed:
+        raise RuntimeError(f"Stages which did not complete: {sorted(failed)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the net flows analysis")
+    parser.add_argument("stages", nargs="*", help=f"Stages to run: {list(STAGES)}")
+    parser.add_argument("--force", action="store_true", help="Run up to date stages")
+    parser.add_argument("--workers", type=int, help="Number of processes")
+    args = parser.parse_args()
+
+    run_pipeline(stages=args.stages, force=args.force, workers=args.workers)